@@ -0,0 +1,405 @@
+'''Benchmark cases shared by the standalone runner and the pytest-benchmark tests
+
+Each case is a context manager that takes a BenchContext, does any setup, and yields the
+callable to time.
+'''
+from __future__ import annotations
+
+from collections.abc import (
+    Callable,
+    Iterator,
+)
+import contextlib
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+import math
+import os
+import tempfile
+from typing import Any
+
+import panda3d.core as p3d
+
+import simplepbr
+from simplepbr import _ibl_funcs_cpu as iblfuncs
+from simplepbr import _lightselection as lightselection
+from simplepbr import _shaderutils as shaderutils
+from simplepbr import _shadows as shadows
+from simplepbr import _skinning as skinning
+from simplepbr import utils
+
+
+ROOTDIR = os.path.join(os.path.dirname(__file__), '..')
+ASSETDIR = p3d.Filename.from_os_specific(os.path.join(ROOTDIR, 'tests', 'assets'))
+CUBEMAP_PATH = ASSETDIR / 'hdri' / 'cubemap_#.hdr'
+ENV_V1_PATH = ASSETDIR / 'hdri' / 'cubemap.env'
+SDR_LUT_PATH = p3d.Filename.from_os_specific(os.path.join(ROOTDIR, 'tests', 'lut.png'))
+
+PRC_BASE = '''
+window-type offscreen
+framebuffer-hardware false
+audio-library-name null
+'''
+
+
+@dataclass
+class BenchContext:
+    showbase: Any = None
+
+
+@dataclass
+class Case:
+    name: str
+    factory: Callable[[BenchContext], AbstractContextManager[Callable[[], Any]]]
+    needs_showbase: bool = False
+
+
+CASES: dict[str, Case] = {}
+
+
+def register(
+    name: str,
+    factory: Callable[..., Iterator[Callable[[], Any]]],
+    needs_showbase: bool = False,
+    **kwargs: Any,
+) -> None:
+    def make(ctx: BenchContext) -> AbstractContextManager[Callable[[], Any]]:
+        return contextlib.contextmanager(factory)(ctx, **kwargs)
+    CASES[name] = Case(name, make, needs_showbase)
+
+
+@contextlib.contextmanager
+def numpy_backend(use_numpy: bool) -> Iterator[None]:
+    iblfuncs_np = iblfuncs.iblfuncs_np
+    if not use_numpy:
+        iblfuncs.iblfuncs_np = None
+    try:
+        yield
+    finally:
+        iblfuncs.iblfuncs_np = iblfuncs_np
+
+
+def has_numpy() -> bool:
+    return iblfuncs.iblfuncs_np is not None
+
+
+def load_cubemap() -> p3d.Texture:
+    return p3d.TexturePool.load_cube_map(CUBEMAP_PATH)
+
+
+def sh_projection(_ctx: BenchContext, use_numpy: bool) -> Iterator[Callable[[], Any]]:
+    cubemap = load_cubemap()
+    with numpy_backend(use_numpy):
+        yield lambda: iblfuncs.get_sh_coeffs_from_cube_map(cubemap)
+
+
+def prefilter(
+    _ctx: BenchContext,
+    use_numpy: bool,
+    size: int,
+    num_samples: int,
+) -> Iterator[Callable[[], Any]]:
+    cubemap = load_cubemap()
+    with numpy_backend(use_numpy):
+        yield lambda: iblfuncs.filter_env_map(
+            cubemap,
+            p3d.Texture(),
+            size=size,
+            num_samples=num_samples
+        )
+
+
+def brdf_lut(
+    _ctx: BenchContext,
+    use_numpy: bool,
+    size: int,
+    num_samples: int,
+) -> Iterator[Callable[[], Any]]:
+    with numpy_backend(use_numpy):
+        yield lambda: iblfuncs.gen_brdf_lut(size, num_samples)
+
+
+def envmap_prepare(_ctx: BenchContext) -> Iterator[Callable[[], Any]]:
+    cubemap = load_cubemap()
+    yield lambda: simplepbr.EnvMap(cubemap, blocking_prepare=True, num_workers=0)
+
+
+def env_write(_ctx: BenchContext, compress: bool) -> Iterator[Callable[[], Any]]:
+    envmap = simplepbr.EnvMap.from_file_path(ENV_V1_PATH)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = p3d.Filename.from_os_specific(os.path.join(tmpdir, 'bench.env'))
+        yield lambda: envmap.write(path, compress=compress)
+
+
+def env_read(_ctx: BenchContext, load_source: bool) -> Iterator[Callable[[], Any]]:
+    envmap = simplepbr.EnvMap.from_file_path(ENV_V1_PATH)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = p3d.Filename.from_os_specific(os.path.join(tmpdir, 'bench.env'))
+        envmap.write(path)
+        yield lambda: simplepbr.EnvMap.from_file_path(path, load_source=load_source)
+
+
+def env_read_v1(_ctx: BenchContext) -> Iterator[Callable[[], Any]]:
+    yield lambda: simplepbr.EnvMap.from_file_path(ENV_V1_PATH)
+
+
+def sdr_lut_load(_ctx: BenchContext) -> Iterator[Callable[[], Any]]:
+    yield lambda: utils.load_sdr_lut(SDR_LUT_PATH)
+
+
+SHADER_VARIANTS = [
+    {
+        'MAX_LIGHTS': max_lights,
+        'USE_NORMAL_MAP': normal_maps,
+        'ENABLE_FOG': fog,
+        'ENABLE_SHADOWS': True,
+        'USE_330': use_330,
+    }
+    for max_lights in (4, 8)
+    for normal_maps in (False, True)
+    for fog in (False, True)
+    for use_330 in (False, True)
+]
+
+
+def shader_variants(_ctx: BenchContext, disk_cache: bool) -> Iterator[Callable[[], Any]]:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        page = p3d.load_prc_file_data(
+            '',
+            f'model-cache-dir {p3d.Filename.from_os_specific(tmpdir)}\n'
+            f'simplepbr-shader-disk-cache {"true" if disk_cache else "false"}\n'
+        )
+
+        def build() -> None:
+            shaderutils.clear_shader_cache()
+            for defines in SHADER_VARIANTS:
+                shaderutils.make_shader('pbr', 'simplepbr.vert', 'simplepbr.frag', defines)
+
+        # Warm the disk cache so only cache hits are measured
+        if disk_cache:
+            build()
+
+        try:
+            yield build
+        finally:
+            p3d.unload_prc_file(page)
+            shaderutils.clear_shader_cache()
+
+
+def pipeline_init(ctx: BenchContext) -> Iterator[Callable[[], Any]]:
+    showbase = ctx.showbase
+
+    def init() -> None:
+        # Includes tearing the Pipeline down again so iterations do not accumulate buffers
+        pipeline = simplepbr.init(
+            render_node=showbase.render,
+            window=showbase.win,
+            camera_node=showbase.cam,
+        )
+        pipeline._filtermgr.cleanup() # pylint:disable=protected-access
+        showbase.task_mgr.remove('simplepbr update')
+        showbase.render.clear_shader()
+    yield init
+
+
+def get_grid_transforms(count: int, spacing: float = 2.0) -> list[p3d.LMatrix4]:
+    columns = math.ceil(math.sqrt(count))
+    return [
+        p3d.LMatrix4.translate_mat((idx % columns) * spacing, (idx // columns) * spacing, 0)
+        for idx in range(count)
+    ]
+
+
+def instancing_build(_ctx: BenchContext, count: int) -> Iterator[Callable[[], Any]]:
+    prop = p3d.NodePath(p3d.Loader.get_global_ptr().load_sync('models/box'))
+    transforms = get_grid_transforms(count)
+    yield lambda: utils.make_instanced(prop, transforms)
+
+
+@contextlib.contextmanager
+def prop_scene(showbase: Any, enable_instancing: bool) -> Iterator[p3d.NodePath[p3d.PandaNode]]:
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_instancing=enable_instancing,
+    )
+    props = showbase.render.attach_new_node('props')
+    showbase.cam.set_pos(-20, -20, 40)
+    showbase.cam.look_at(100, 100, 0)
+    try:
+        yield props
+    finally:
+        props.remove_node()
+        pipeline._filtermgr.cleanup() # pylint:disable=protected-access
+        showbase.task_mgr.remove('simplepbr update')
+        showbase.render.clear_shader()
+
+
+def instanced_scene(ctx: BenchContext, count: int) -> Iterator[Callable[[], Any]]:
+    showbase = ctx.showbase
+    with prop_scene(showbase, True) as props:
+        prop = showbase.loader.load_model('models/box')
+        prop.reparent_to(props)
+        utils.make_instanced(prop, get_grid_transforms(count))
+        yield showbase.task_mgr.step
+
+
+def copied_scene(ctx: BenchContext, count: int) -> Iterator[Callable[[], Any]]:
+    # The same scene as instanced_scene drawn with a node per prop for comparison
+    showbase = ctx.showbase
+    with prop_scene(showbase, False) as props:
+        prop = showbase.loader.load_model('models/box')
+        for mat in get_grid_transforms(count):
+            prop.copy_to(props).set_mat(mat)
+        yield showbase.task_mgr.step
+
+
+def skinning_palette_update(_ctx: BenchContext, count: int) -> Iterator[Callable[[], Any]]:
+    loader = p3d.Loader.get_global_ptr()
+    model = p3d.NodePath(loader.load_sync('models/panda-model'))
+    anim = p3d.NodePath(loader.load_sync('models/panda-walk4'))
+    animbundle = anim.find('**/+AnimBundleNode').node().get_bundle()
+    render = p3d.NodePath('render')
+    controls = []
+    for idx in range(count):
+        crowd_member = model.copy_to(render)
+        crowd_member.set_x(idx * 5)
+        bundle = crowd_member.find('**/+Character').node().get_bundle(0)
+        controls.append(bundle.bind_anim(animbundle, -1))
+
+    palette = skinning.SkinningPalette()
+    palette.update(render)
+    frame = 0
+
+    def update() -> None:
+        # Pose every character on a new frame so that all joints change
+        nonlocal frame
+        frame += 1
+        for control in controls:
+            control.pose(frame % control.num_frames)
+        palette.update(render)
+    yield update
+
+
+def make_caster_scene(count: int, group_size: int = 50) -> p3d.NodePath[p3d.PandaNode]:
+    render = p3d.NodePath('render')
+    for idx, mat in enumerate(get_grid_transforms(count)):
+        if idx % group_size == 0:
+            group = render.attach_new_node(f'group{idx // group_size}')
+        caster = group.attach_new_node(p3d.GeomNode(f'caster{idx}'))
+        caster.node().set_bounds(p3d.BoundingSphere((0, 0, 0), 0.5))
+        caster.set_mat(mat)
+    return render
+
+
+def caster_spheres(_ctx: BenchContext, count: int, moving: bool) -> Iterator[Callable[[], Any]]:
+    render = make_caster_scene(count)
+    mover = render.find('**/caster0')
+    cache = shadows.CasterSpheres()
+    cache.update(render)
+
+    def update() -> None:
+        if moving:
+            mover.set_z(mover.get_z() + 0.01)
+        cache.update(render)
+    yield update
+
+
+def shadow_schedule(ctx: BenchContext, count: int) -> Iterator[Callable[[], Any]]:
+    # One node moves per frame, so every frame checks the lights' frustums again
+    render = make_caster_scene(count)
+    mover = render.find('**/caster0')
+    regions = []
+    for idx in range(4):
+        lightnp = render.attach_new_node(p3d.Spotlight(f'light{idx}'))
+        lightnp.set_pos(idx * 30, -10, 10)
+        lightnp.look_at(idx * 30, 30, 0)
+        texture = shadows.make_shadow_texture(f'light{idx}')
+        buffer = shadows.make_shadow_buffer(ctx.showbase.win, f'light{idx}', 64, 64, texture)
+        dispregion = buffer.make_display_region()
+        dispregion.set_camera(lightnp)
+        regions.append((dispregion, lightnp))
+    scheduler = shadows.ShadowUpdateScheduler()
+
+    def update() -> None:
+        mover.set_z(mover.get_z() + 0.01)
+        scheduler.update(regions, render, 'on_change', 1)
+    try:
+        yield update
+    finally:
+        for dispregion, _ in regions:
+            dispregion.window.engine.remove_window(dispregion.window)
+
+
+def light_selection(_ctx: BenchContext, count: int, moving: bool) -> Iterator[Callable[[], Any]]:
+    render = make_caster_scene(count)
+    for idx in range(16):
+        light = p3d.PointLight(f'light{idx}')
+        light.attenuation = (1, 0, 1)
+        lightnp = render.attach_new_node(light)
+        lightnp.set_pos(idx * 10, idx * 5, 2)
+        render.set_light(lightnp)
+    mover = render.find('**/caster0')
+    selector = lightselection.LightSelector()
+    selector.update(render, 8)
+
+    def update() -> None:
+        if moving:
+            mover.set_z(mover.get_z() + 0.01)
+        selector.update(render, 8)
+    yield update
+
+
+def register_all() -> None:
+    backends = [True, False] if has_numpy() else [False]
+    for use_numpy in backends:
+        backend = 'numpy' if use_numpy else 'python'
+        register(f'sh_projection[{backend}]', sh_projection, use_numpy=use_numpy)
+
+        # The pure Python implementation is too slow for the larger configurations, but the
+        # default EnvMap configuration is kept so that both backends can be compared there
+        prefilter_sizes = (
+            [(16, 16), (64, 16), (64, 64), (128, 64)]
+            if use_numpy
+            else [(16, 16), (64, 16)]
+        )
+        for size, num_samples in prefilter_sizes:
+            register(
+                f'prefilter[{backend}-{size}-{num_samples}]',
+                prefilter,
+                use_numpy=use_numpy,
+                size=size,
+                num_samples=num_samples,
+            )
+
+        lut_size, lut_samples = (128, 256) if use_numpy else (32, 64)
+        register(
+            f'brdf_lut[{backend}-{lut_size}-{lut_samples}]',
+            brdf_lut,
+            use_numpy=use_numpy,
+            size=lut_size,
+            num_samples=lut_samples,
+        )
+
+    register('envmap_prepare', envmap_prepare)
+    register('env_write[compressed]', env_write, compress=True)
+    register('env_write[uncompressed]', env_write, compress=False)
+    register('env_read[source]', env_read, load_source=True)
+    register('env_read[no-source]', env_read, load_source=False)
+    register('env_read[v1]', env_read_v1)
+    register('sdr_lut_load', sdr_lut_load)
+    register('shader_variants[no-disk-cache]', shader_variants, disk_cache=False)
+    register('shader_variants[disk-cache]', shader_variants, disk_cache=True)
+    register('pipeline_init', pipeline_init, needs_showbase=True)
+    register('instancing_build[10000]', instancing_build, count=10000)
+    register('instanced_scene[10000]', instanced_scene, needs_showbase=True, count=10000)
+    register('copied_scene[10000]', copied_scene, needs_showbase=True, count=10000)
+    register('skinning_palette_update[100]', skinning_palette_update, count=100)
+    register('caster_spheres[static-5000]', caster_spheres, count=5000, moving=False)
+    register('caster_spheres[moving-5000]', caster_spheres, count=5000, moving=True)
+    register('shadow_schedule[on_change-5000]', shadow_schedule, needs_showbase=True, count=5000)
+    register('light_selection[static-5000]', light_selection, count=5000, moving=False)
+    register('light_selection[moving-5000]', light_selection, count=5000, moving=True)
+
+
+register_all()
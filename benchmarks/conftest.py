@@ -0,0 +1,19 @@
+import os
+import sys
+
+import panda3d.core as p3d
+from direct.showbase.ShowBase import ShowBase
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import cases # noqa: E402
+
+#pylint:disable=redefined-outer-name
+
+@pytest.fixture(scope='session')
+def showbase():
+    p3d.load_prc_file_data('', cases.PRC_BASE)
+    showbase = ShowBase()
+    yield showbase
+    showbase.destroy()
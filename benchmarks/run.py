@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+'''Standalone runner for the simplepbr benchmarks that does not require pytest-benchmark'''
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import panda3d.core as p3d # noqa: E402
+
+import cases # noqa: E402
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def get_metadata() -> dict[str, Any]:
+    return {
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'panda3d': p3d.PandaSystem.get_version_string(),
+        'platform': platform.platform(),
+        'backend': 'numpy' if cases.has_numpy() else 'python',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def time_case(
+    case: cases.Case,
+    ctx: cases.BenchContext,
+    repeat: int,
+    min_time: float,
+) -> dict[str, Any]:
+    with case.factory(ctx) as func:
+        # Warm up caches and imports before timing
+        func()
+
+        times = []
+        totaltime = 0.0
+        while len(times) < repeat or totaltime < min_time:
+            starttime = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - starttime
+            times.append(elapsed)
+            totaltime += elapsed
+
+    return {
+        'min': min(times),
+        'max': max(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'rounds': len(times),
+    }
+
+
+def format_time(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f}us'
+    if seconds < 1.0:
+        return f'{seconds * 1e3:.2f}ms'
+    return f'{seconds:.3f}s'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Run the simplepbr benchmarks',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        'filter',
+        type=str,
+        nargs='*',
+        help='only run benchmarks matching these glob patterns',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='the minimum number of timed rounds for each benchmark',
+    )
+    parser.add_argument(
+        '--min-time',
+        type=float,
+        default=0.0,
+        help='keep running rounds until at least this many seconds have been spent',
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='write results to this JSON file',
+    )
+    parser.add_argument(
+        '--compare',
+        type=str,
+        help='a JSON file from a previous run to compare median times against',
+    )
+    parser.add_argument(
+        '--list',
+        action='store_true',
+        help='list the available benchmarks and exit',
+    )
+    args = parser.parse_args()
+
+    selected = [
+        case
+        for name, case in cases.CASES.items()
+        if not args.filter or any(fnmatch.fnmatchcase(name, i) for i in args.filter)
+    ]
+
+    if args.list:
+        for case in selected:
+            print(case.name)
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf8') as basefile:
+            baseline = json.load(basefile)['benchmarks']
+
+    ctx = cases.BenchContext()
+    if any(case.needs_showbase for case in selected):
+        from direct.showbase.ShowBase import ShowBase # pylint:disable=import-outside-toplevel
+        p3d.load_prc_file_data('', cases.PRC_BASE)
+        ctx.showbase = ShowBase()
+
+    metadata = get_metadata()
+    print(
+        f'simplepbr benchmarks ({metadata["commit"]}, Python {metadata["python"]}, '
+        f'Panda3D {metadata["panda3d"]}, {metadata["backend"]} backend)'
+    )
+
+    results = {}
+    try:
+        for case in selected:
+            result = time_case(case, ctx, args.repeat, args.min_time)
+            results[case.name] = result
+            line = (
+                f'{case.name:<36} median {format_time(result["median"]):>10}'
+                f'  min {format_time(result["min"]):>10}'
+                f'  stddev {format_time(result["stddev"]):>10}'
+            )
+            if case.name in baseline:
+                ratio = result['median'] / baseline[case.name]['median']
+                line += f'  {ratio:.2f}x baseline'
+            print(line)
+    finally:
+        if ctx.showbase is not None:
+            ctx.showbase.destroy()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as outfile:
+            json.dump({'metadata': metadata, 'benchmarks': results}, outfile, indent=2)
+        print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
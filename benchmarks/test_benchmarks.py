@@ -0,0 +1,16 @@
+import pytest
+
+import cases
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('name', list(cases.CASES))
+def test_benchmark(benchmark, request, name):
+    case = cases.CASES[name]
+    ctx = cases.BenchContext()
+    if case.needs_showbase:
+        ctx.showbase = request.getfixturevalue('showbase')
+
+    with case.factory(ctx) as func:
+        benchmark(func)
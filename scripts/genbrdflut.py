@@ -1,22 +1,138 @@
 #!/usr/bin/env python
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import os
+import sys
+import time
 
 import panda3d.core as p3d
 
 from simplepbr import _ibl_funcs_cpu as iblfuncs
 
+
+OUTPUT_FORMATS = ['txo', 'pfm', 'png']
+
+
+def write_lut(brdflut: p3d.Texture, outfile: p3d.Filename, outformat: str) -> None:
+    if outformat == 'txo':
+        brdflut.write(outfile)
+        return
+
+    # Image formats get the LUT as RGB with (scale, bias, average albedo or 0)
+    lutsize = brdflut.x_size
+    peeker = brdflut.peek()
+    color = p3d.LColor()
+    if outformat == 'pfm':
+        image = p3d.PfmFile()
+        image.clear(lutsize, lutsize, 3)
+        for ycoord in range(lutsize):
+            for xcoord in range(lutsize):
+                peeker.fetch_pixel(color, xcoord, ycoord)
+                # Images are stored top to bottom
+                image.set_point3(xcoord, lutsize - ycoord - 1, color.xyz)
+    else:
+        image = p3d.PNMImage(lutsize, lutsize, 3, 65535)
+        for ycoord in range(lutsize):
+            for xcoord in range(lutsize):
+                peeker.fetch_pixel(color, xcoord, ycoord)
+                image.set_xel(xcoord, lutsize - ycoord - 1, color.xyz)
+
+    if not image.write(outfile):
+        raise RuntimeError(f'Failed to write {outfile}')
+
+
 def main():
-    brdflut = iblfuncs.gen_brdf_lut(512, num_samples=1024)
-    outfile = p3d.Filename.from_os_specific(
-        os.path.join(
-            os.path.dirname(__file__),
-            '..',
-            'simplepbr',
-            'textures',
-            'brdf_lut.txo'
+    parser = argparse.ArgumentParser(
+        description='Generate the split-sum BRDF LUT used for IBL specular',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        nargs='?',
+        help='output file, defaults to the LUT shipped with simplepbr',
+    )
+    parser.add_argument(
+        '--size',
+        type=int,
+        help='the size to use for both dimensions of the LUT',
+        default=512,
+    )
+    parser.add_argument(
+        '--samples',
+        type=int,
+        help='the number of samples to use for each pixel of the LUT',
+        default=1024,
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='the number of worker processes to use, 0 to run in the current process',
+        default=os.cpu_count() or 0,
+    )
+    parser.add_argument(
+        '--multiscatter',
+        action='store_true',
+        help='add the average albedo used for multiple scattering energy compensation',
+    )
+    parser.add_argument(
+        '--format',
+        choices=OUTPUT_FORMATS,
+        help='the output file format, defaults to the output file extension or txo',
+    )
+    args = parser.parse_args()
+
+    if args.output:
+        outfile = p3d.Filename.from_os_specific(args.output)
+    else:
+        outfile = p3d.Filename.from_os_specific(
+            os.path.join(
+                os.path.dirname(__file__),
+                '..',
+                'simplepbr',
+                'textures',
+                'brdf_lut_ms.txo' if args.multiscatter else 'brdf_lut.txo'
+            )
         )
+
+    outformat = args.format
+    if outformat is None:
+        extension = outfile.get_extension()
+        outformat = extension if extension in OUTPUT_FORMATS else 'txo'
+
+    def progress(rows_done: int, total_rows: int) -> None:
+        elapsed = time.perf_counter() - starttime
+        sys.stdout.write(f'\r{rows_done}/{total_rows} rows ({elapsed:.1f}s)')
+        sys.stdout.flush()
+
+    backend = 'NumPy' if iblfuncs.iblfuncs_np is not None else 'pure Python'
+    print(
+        f'Generating {args.size}x{args.size} {"multiscatter " if args.multiscatter else ""}'
+        f'BRDF LUT with {args.samples} samples '
+        f'using {backend} and {args.workers} worker(s)'
     )
-    brdflut.write(outfile)
+    starttime = time.perf_counter()
+    if args.workers > 0:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            brdflut = iblfuncs.gen_brdf_lut(
+                args.size,
+                num_samples=args.samples,
+                multiscatter=args.multiscatter,
+                executor=executor,
+                progress_cb=progress,
+            )
+    else:
+        brdflut = iblfuncs.gen_brdf_lut(
+            args.size,
+            num_samples=args.samples,
+            multiscatter=args.multiscatter,
+            progress_cb=progress,
+        )
+    print(f'\nGenerated in {time.perf_counter() - starttime:.3f}s')
+
+    write_lut(brdflut, outfile, outformat)
+    print(f'Wrote {outfile.to_os_specific()} ({outformat})')
+
 
 if __name__ == '__main__':
     main()
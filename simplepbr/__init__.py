@@ -8,14 +8,23 @@ from dataclasses import (
     MISSING,
 )
 import builtins
+import contextlib
+from collections.abc import (
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+)
 import functools
 import os
+import time
 from typing import (
     ClassVar,
 )
 from typing_extensions import (
     Any,
     Literal,
+    Self,
     TypeAlias,
     TypeVar,
 )
@@ -31,6 +40,23 @@ from .envpool import EnvPool
 from . import logging
 from . import utils
 from . import _shaderutils as shaderutils
+from . import _profiling as profiling
+from ._clustering import (
+    ClusteredLightManager,
+    INDEX_TEXTURE_WIDTH,
+)
+from ._lightselection import LightSelector
+from ._skinning import (
+    JOINTS_PER_ROW,
+    SkinningPalette,
+)
+from ._shadows import (
+    CascadedShadowMap,
+    CasterRegionType,
+    CasterSpheres,
+    ShadowAtlas,
+    ShadowUpdateScheduler,
+)
 
 try:
     from .textures import textures # type: ignore
@@ -47,6 +73,7 @@ __all__ = [
 ]
 
 ShaderDefinesType: TypeAlias = 'dict[str, Any]'
+ShaderOptionsType: TypeAlias = 'Mapping[str, Any]'
 
 
 def _load_texture(texturepath: str) -> p3d.Texture:
@@ -118,6 +145,8 @@ def add_prc_fields(cls: TypeT) -> TypeT:
             default_value = getattr(cls, attrname)
             if attrtype.startswith('Literal') and isinstance(default_value, int):
                 attrtype = 'int'
+            elif attrtype.startswith('Literal') and isinstance(default_value, str):
+                attrtype = 'str'
 
             if attrtype not in prc_types:
                 # Not a currently supported type, skip
@@ -136,6 +165,7 @@ class Pipeline:
     # Class variables
     _EMPTY_ENV_MAP: ClassVar[EnvMap] = EnvMap.create_empty()
     _BRDF_LUT: ClassVar[p3d.Texture] = _load_texture('brdf_lut.txo')
+    _BRDF_LUT_MS: ClassVar[p3d.Texture] = _load_texture('brdf_lut_ms.txo')
     _PBR_VARS: ClassVar[list[str]] = [
         'enable_fog',
         'enable_hardware_skinning',
@@ -145,6 +175,12 @@ class Pipeline:
         'use_normal_maps',
         'use_occlusion_maps',
         'calculate_normalmap_blue',
+        'enable_multiscatter',
+        'enable_clustered_lighting',
+        'enable_shadow_atlas',
+        'shadow_atlas_size',
+        'enable_instancing',
+        'enable_skinning_palette',
     ]
     _POST_PROC_VARS: ClassVar[list[str]] = [
         'camera_node',
@@ -168,17 +204,43 @@ class Pipeline:
     exposure: float = 0.0
     enable_shadows: bool = True
     shadow_bias: float = 0.005
+    enable_shadow_atlas: bool = False
+    shadow_atlas_size: int = 4096
+    shadow_update_policy: Literal['always', 'on_change', 'interval'] = 'always'
+    shadow_update_interval: int = 4
     enable_fog: bool  = False
     use_330: bool = field(default_factory=_get_default_330)
     use_hardware_skinning: InitVar[bool | None] = None
     enable_hardware_skinning: bool = True
+    enable_skinning_palette: bool = False
     sdr_lut: p3d.Texture | None = None
     sdr_lut_factor: float = 1.0
     env_map: EnvMap | str | None = None
     calculate_normalmap_blue: bool = True
+    enable_multiscatter: bool = False
+    enable_clustered_lighting: bool = False
+    enable_light_selection: bool = False
+    enable_instancing: bool = False
+    defer_updates: bool = False
 
     # Private instance variables
     _shader_ready: bool = False
+    _bound_env_map: EnvMap | None = None
+    _pending_env_map: str | None = None
+    _batch_depth: int = 0
+    _dirty_pbr: bool = False
+    _dirty_tonemap: bool = False
+    _caster_signature: tuple[int, p3d.GraphicsOutput | None] | None = None
+    _num_caster_scans: int = 0
+    _light_clusters: ClusteredLightManager | None = None
+    _light_selector: LightSelector | None = None
+    _skinning_palette: SkinningPalette | None = None
+    _cascaded_shadows: CascadedShadowMap | None = None
+    _shadow_atlas: ShadowAtlas | None = None
+    _caster_regions: list[CasterRegionType] = field(default_factory=list)
+    _caster_spheres: CasterSpheres = field(default_factory=CasterSpheres)
+    _shadow_scheduler: ShadowUpdateScheduler = field(init=False)
+    _shadow_attrib: p3d.ShaderAttrib | None = None
     _filtermgr: FilterManager = field(init=False)
     _post_process_quad: p3d.NodePath[p3d.GeomNode] = field(init=False)
     _is_webgl: bool = field(init=False)
@@ -187,6 +249,9 @@ class Pipeline:
         self._shader_ready = False
         self._is_webgl = 'WebGL' in self.window.type.name
 
+        # The scheduler and shadow atlas share one scan of the scene's bounds per frame
+        self._shadow_scheduler = ShadowUpdateScheduler(self._caster_spheres)
+
         # Create a FilterManager instance
         self._filtermgr = FilterManager(self.window, self.camera_node)
         if self._filtermgr.nextsort == -1000:
@@ -211,15 +276,18 @@ class Pipeline:
         # Tonemapping
         self._setup_tonemapping()
 
+        self._setup_light_selection()
+
         # Do updates based on scene changes
         self.taskmgr.add(self._update, 'simplepbr update', sort=49)
 
         self._shader_ready = True
 
-        self._BRDF_LUT.wrap_u = p3d.SamplerState.WM_clamp
-        self._BRDF_LUT.wrap_v = p3d.SamplerState.WM_clamp
-        self._BRDF_LUT.minfilter = p3d.SamplerState.FT_linear
-        self._BRDF_LUT.magfilter = p3d.SamplerState.FT_linear
+        for brdf_lut in (self._BRDF_LUT, self._BRDF_LUT_MS):
+            brdf_lut.wrap_u = p3d.SamplerState.WM_clamp
+            brdf_lut.wrap_v = p3d.SamplerState.WM_clamp
+            brdf_lut.minfilter = p3d.SamplerState.FT_linear
+            brdf_lut.magfilter = p3d.SamplerState.FT_linear
 
     def __setattr__(self, name: str, value: Any) -> None:
         prev_value = getattr(self, name, None)
@@ -228,16 +296,6 @@ class Pipeline:
         if not self._shader_ready:
             return
 
-        def resetup_tonemap() -> None:
-            # Destroy previous buffers so we can re-create
-            self._filtermgr.cleanup()
-            if self._filtermgr.nextsort == -1000:
-                self._filtermgr.nextsort = -9
-
-            # Create a new FilterManager instance
-            self._filtermgr = FilterManager(self.window, self.camera_node)
-            self._setup_tonemapping()
-
         if name == 'exposure':
             self._post_process_quad.set_shader_input('exposure', 2**self.exposure)
         elif name == 'sdr_lut_factor':
@@ -246,21 +304,101 @@ class Pipeline:
             self._set_env_map_uniforms()
         elif name == 'shadow_bias':
             self.render_node.set_shader_input('global_shadow_bias', self.shadow_bias)
+        elif name == 'enable_light_selection':
+            self._setup_light_selection()
 
         if name in self._PBR_VARS and prev_value != value:
-            self._recompile_pbr()
+            self._invalidate_pbr()
 
         if name in self._POST_PROC_VARS and prev_value != value:
-            resetup_tonemap()
+            if self.defer_updates or self._batch_depth > 0:
+                self._dirty_tonemap = True
+            else:
+                self._resetup_tonemap()
+
+    def _invalidate_pbr(self) -> None:
+        if self.defer_updates or self._batch_depth > 0:
+            self._dirty_pbr = True
+        else:
+            self._recompile_pbr()
 
+    def _resetup_tonemap(self) -> None:
+        # Destroy previous buffers so we can re-create
+        self._filtermgr.cleanup()
+        if self._filtermgr.nextsort == -1000:
+            self._filtermgr.nextsort = -9
+
+        # Create a new FilterManager instance
+        self._filtermgr = FilterManager(self.window, self.camera_node)
+        self._setup_tonemapping()
+
+    def _flush_updates(self) -> None:
+        if self._dirty_tonemap:
+            self._dirty_tonemap = False
+            self._resetup_tonemap()
+        if self._dirty_pbr:
+            self._dirty_pbr = False
+            self._recompile_pbr()
+
+    @contextlib.contextmanager
+    def batch_update(self) -> Iterator[Self]:
+        '''Apply option changes made inside the with block with a single rebuild at exit
+
+        With defer_updates enabled, the rebuild instead happens in the next update task.
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and not self.defer_updates:
+                self._flush_updates()
+
+    @profiling.profiled('set_env_map_uniforms')
     def _set_env_map_uniforms(self) -> None:
         env_map = self.env_map
         if env_map is None:
             env_map = self._EMPTY_ENV_MAP
         elif isinstance(env_map, str):
-            env_map = EnvPool.ptr().load(env_map)
+            future = EnvPool.ptr().load_async(env_map)
+            if not future.done():
+                # Keep the previous map bound until the new one is ready
+                if self._pending_env_map != env_map:
+                    self._pending_env_map = env_map
+                    future.add_done_callback(functools.partial(self._env_map_loaded, env_map))
+                env_map = self._bound_env_map or self._EMPTY_ENV_MAP
+            elif future.cancelled():
+                env_map = self._EMPTY_ENV_MAP
+            else:
+                env_map = future.result()
+
+        self._bind_env_map(env_map)
+
+    def _env_map_loaded(self, requested: str, future: p3d.AsyncFuture) -> None:
+        if self._pending_env_map == requested:
+            self._pending_env_map = None
+        if self.env_map == requested and not future.cancelled():
+            self._bind_env_map(future.result())
+
+    def _env_map_refined(self, env_map: EnvMap, _stage: int, _num_stages: int) -> None:
+        # Progressive EnvMaps swap in new textures as they are refined
+        if env_map is self._bound_env_map:
+            self._set_env_map_uniforms()
+
+    def _bind_env_map(self, env_map: EnvMap) -> None:
+        # Keep the bound map pinned so EnvPool does not evict it
+        if env_map is not self._bound_env_map:
+            envpool = EnvPool.ptr()
+            envpool.acquire(env_map)
+            env_map.add_refine_callback(self._env_map_refined)
+            if self._bound_env_map is not None:
+                envpool.release(self._bound_env_map)
+                self._bound_env_map.remove_refine_callback(self._env_map_refined)
+            self._bound_env_map = env_map
+
         self.render_node.set_shader_input('sh_coeffs', env_map.sh_coefficients)
-        self.render_node.set_shader_input('brdf_lut', self._BRDF_LUT)
+        brdf_lut = self._BRDF_LUT_MS if self.enable_multiscatter else self._BRDF_LUT
+        self.render_node.set_shader_input('brdf_lut', brdf_lut)
         filtered_env_map = env_map.filtered_env_map
         self.render_node.set_shader_input('filtered_env_map', filtered_env_map)
         self.render_node.set_shader_input(
@@ -268,40 +406,246 @@ class Pipeline:
             filtered_env_map.num_loadable_ram_mipmap_images
         )
 
-    def _recompile_pbr(self) -> None:
+    def _get_option(self, options: ShaderOptionsType | None, name: str) -> Any:
+        if options is not None and name in options:
+            return options[name]
+        return getattr(self, name)
+
+    def _create_pbr_shader(self, options: ShaderOptionsType | None = None) -> p3d.Shader:
+        def get(name: str) -> Any:
+            return self._get_option(options, name)
+
         pbr_defines = {
-            'MAX_LIGHTS': self.max_lights,
-            'USE_NORMAL_MAP': self.use_normal_maps,
-            'USE_EMISSION_MAP': self.use_emission_maps,
-            'ENABLE_SHADOWS': self.enable_shadows,
-            'ENABLE_FOG': self.enable_fog,
-            'USE_OCCLUSION_MAP': self.use_occlusion_maps,
-            'USE_330': self.use_330,
+            'MAX_LIGHTS': get('max_lights'),
+            'USE_NORMAL_MAP': get('use_normal_maps'),
+            'USE_EMISSION_MAP': get('use_emission_maps'),
+            'ENABLE_SHADOWS': get('enable_shadows'),
+            'ENABLE_FOG': get('enable_fog'),
+            'USE_OCCLUSION_MAP': get('use_occlusion_maps'),
+            'USE_330': get('use_330'),
             'IS_WEBGL': self._is_webgl,
-            'ENABLE_SKINNING': self.enable_hardware_skinning,
-            'CALC_NORMAL_Z': self.calculate_normalmap_blue,
+            'ENABLE_SKINNING': get('enable_hardware_skinning'),
+            'ENABLE_SKINNING_PALETTE': get('enable_skinning_palette') and get('use_330'),
+            'ENABLE_INSTANCING': get('enable_instancing'),
+            'CALC_NORMAL_Z': get('calculate_normalmap_blue'),
+            'ENABLE_MULTISCATTER': get('enable_multiscatter'),
+            'ENABLE_CLUSTERED_LIGHTS': get('enable_clustered_lighting') and get('use_330'),
+            'ENABLE_SHADOW_ATLAS': get('enable_shadows') and get('enable_shadow_atlas'),
+            'ENABLE_CASCADED_SHADOWS': (
+                get('enable_shadows') and self._cascaded_shadows is not None
+            ),
         }
-
-        pbrshader = shaderutils.make_shader(
+        if pbr_defines['ENABLE_CLUSTERED_LIGHTS']:
+            pbr_defines['CLUSTER_INDEX_WIDTH'] = INDEX_TEXTURE_WIDTH
+        if pbr_defines['ENABLE_SKINNING_PALETTE']:
+            pbr_defines['PALETTE_JOINTS_PER_ROW'] = JOINTS_PER_ROW
+        if pbr_defines['ENABLE_CASCADED_SHADOWS']:
+            assert self._cascaded_shadows is not None
+            pbr_defines['CSM_CASCADES'] = self._cascaded_shadows.num_cascades
+
+        return shaderutils.make_shader(
             'pbr',
             'simplepbr.vert',
             'simplepbr.frag',
-            pbr_defines
+            pbr_defines,
+            driver=shaderutils.get_driver_string(self.window.gsg),
+        )
+
+    def _create_tonemap_shader(self, options: ShaderOptionsType | None = None) -> p3d.Shader:
+        defines = {
+            'USE_330': self._get_option(options, 'use_330'),
+            'IS_WEBGL': self._is_webgl,
+            'USE_SDR_LUT': bool(self._get_option(options, 'sdr_lut')),
+        }
+
+        return shaderutils.make_shader(
+            'tonemap',
+            'post.vert',
+            'tonemap.frag',
+            defines,
+            driver=shaderutils.get_driver_string(self.window.gsg),
+        )
+
+    def _create_shadow_shader(self, options: ShaderOptionsType | None = None) -> p3d.Shader:
+        defines = {
+            'USE_330': self._get_option(options, 'use_330'),
+            'IS_WEBGL': self._is_webgl,
+            'ENABLE_SKINNING': self._get_option(options, 'enable_hardware_skinning'),
+            'ENABLE_SKINNING_PALETTE': (
+                self._get_option(options, 'enable_skinning_palette')
+                and self._get_option(options, 'use_330')
+            ),
+            'ENABLE_INSTANCING': self._get_option(options, 'enable_instancing'),
+        }
+        if defines['ENABLE_SKINNING_PALETTE']:
+            defines['PALETTE_JOINTS_PER_ROW'] = JOINTS_PER_ROW
+        return shaderutils.make_shader(
+            'shadow',
+            'shadow.vert',
+            'shadow.frag',
+            defines,
+            driver=shaderutils.get_driver_string(self.window.gsg),
         )
+
+    @profiling.profiled('recompile_pbr')
+    def _recompile_pbr(self) -> None:
+        pbrshader = self._create_pbr_shader()
         attr = p3d.ShaderAttrib.make(pbrshader)
         if self.enable_hardware_skinning:
             attr = attr.set_flag(p3d.ShaderAttrib.F_hardware_skinning, True)
         self.render_node.set_attrib(attr)
         self.render_node.set_shader_input('global_shadow_bias', self.shadow_bias)
+        # Nodes drawn with utils.make_instanced() override this
+        self.render_node.set_shader_input('instancing_enabled', 0.0)
         self._set_env_map_uniforms()
+        self._setup_clustered_lighting()
+        self._setup_skinning_palette()
+        self._setup_shadow_atlas()
+        self._refresh_shadow_shader()
+        if self._cascaded_shadows is not None:
+            self._cascaded_shadows.apply(self.render_node)
+
+    def _refresh_shadow_shader(self) -> None:
+        '''Swap the shadow shader of existing casters when its defines change'''
+        prev_attrib = self._shadow_attrib
+        attrib = self._create_shadow_shader_attrib()
+        self._shadow_attrib = attrib
+        if prev_attrib is None or prev_attrib == attrib:
+            return
 
+        for caster in self.get_all_casters():
+            state = caster.get_initial_state()
+            if state.get_attrib(p3d.ShaderAttrib) == prev_attrib:
+                caster.set_initial_state(state.add_attrib(attrib, 1))
+
+        state = p3d.RenderState.make_empty().add_attrib(attrib, 1)
+        if self._shadow_atlas is not None:
+            self._shadow_atlas.set_shadow_state(state)
+        if self._cascaded_shadows is not None:
+            self._cascaded_shadows.set_shadow_state(state)
+
+    def _setup_light_selection(self) -> None:
+        if self.enable_light_selection:
+            if self._light_selector is None:
+                self._light_selector = LightSelector()
+        elif self._light_selector is not None:
+            self._light_selector.clear()
+            self._light_selector = None
+
+    def _setup_clustered_lighting(self) -> None:
+        enabled = self.enable_clustered_lighting
+        if enabled and not self.use_330:
+            logging.warning('Clustered lighting requires use_330, using the regular light loop')
+            enabled = False
+
+        clusters = self._light_clusters
+        if clusters is not None and (not enabled or clusters.max_lights != self.max_lights):
+            clusters.clear()
+            self._light_clusters = None
+
+        if enabled and self._light_clusters is None:
+            self._light_clusters = ClusteredLightManager(max_lights=self.max_lights)
+            self._light_clusters.apply(self.render_node)
+
+    def _setup_skinning_palette(self) -> None:
+        enabled = self.enable_skinning_palette
+        if enabled and not self.use_330:
+            logging.warning('Skinning palettes require use_330, using p3d_TransformTable')
+            enabled = False
+
+        if not enabled:
+            if self._skinning_palette is not None:
+                self._skinning_palette.clear()
+                self._skinning_palette = None
+            return
+
+        if self._skinning_palette is None:
+            self._skinning_palette = SkinningPalette()
+            self._skinning_palette.apply(self.render_node)
+
+    def _setup_shadow_atlas(self) -> None:
+        atlas = self._shadow_atlas
+        if atlas is not None and (
+            not self.enable_shadow_atlas
+            or atlas.size != self.shadow_atlas_size
+            or atlas.max_lights != self.max_lights
+        ):
+            atlas.destroy()
+            self._shadow_atlas = None
+
+        if not self.enable_shadow_atlas or self._shadow_atlas is not None:
+            return
+
+        # Drop any per-light shadow buffers, the atlas replaces them
+        for caster in self.get_all_casters():
+            sbuff_size = caster.get_shadow_buffer_size()
+            caster.set_shadow_buffer_size((0, 0))
+            caster.set_shadow_buffer_size(sbuff_size)
+
+        state = p3d.RenderState.make_empty().add_attrib(self._create_shadow_shader_attrib(), 1)
+        self._shadow_atlas = ShadowAtlas(
+            self.render_node,
+            self.window,
+            state,
+            size=self.shadow_atlas_size,
+            max_lights=self.max_lights,
+            caster_spheres=self._caster_spheres,
+        )
+        self._shadow_atlas.apply(self.render_node)
+
+    def add_cascaded_shadows(
+        self,
+        light: p3d.NodePath[p3d.DirectionalLight],
+        *,
+        num_cascades: int = 4,
+        size: int = 1024,
+        max_distance: float = 100.0,
+        split_lambda: float = 0.75,
+        dynamic_cascades: int = 2,
+    ) -> CascadedShadowMap:
+        '''Render cascaded shadow maps for a DirectionalLight, replacing any previous ones
+
+        The view frustum of camera_node up to max_distance is split into num_cascades (at most
+        4) cascades of size x size texels, with split_lambda blending between uniform (0.0) and
+        logarithmic (1.0) splits. Only the first dynamic_cascades cascades are re-rendered every
+        frame, the others are re-rendered when they move, when geometry within them changes, or
+        when CascadedShadowMap.invalidate() is called. The light should not also be a regular
+        shadow caster.
+        '''
+        self.remove_cascaded_shadows()
+        state = p3d.RenderState.make_empty().add_attrib(self._create_shadow_shader_attrib(), 1)
+        self._cascaded_shadows = CascadedShadowMap(
+            light,
+            self.render_node,
+            self.window,
+            state,
+            num_cascades=num_cascades,
+            size=size,
+            max_distance=max_distance,
+            split_lambda=split_lambda,
+            dynamic_cascades=dynamic_cascades,
+            caster_spheres=self._caster_spheres,
+        )
+        self._cascaded_shadows.apply(self.render_node)
+        self._invalidate_pbr()
+        return self._cascaded_shadows
+
+    def remove_cascaded_shadows(self) -> None:
+        if self._cascaded_shadows is None:
+            return
+        self._cascaded_shadows.destroy()
+        self._cascaded_shadows = None
+        self._invalidate_pbr()
+
+    @profiling.profiled('setup_tonemapping')
     def _setup_tonemapping(self) -> None:
         if self._shader_ready:
             # Destroy previous buffers so we can re-create
             self._filtermgr.cleanup()
 
             # Fix shadow buffers after FilterManager.cleanup()
-            for caster in self.get_all_casters():
+            casters = self.get_all_casters() if self._shadow_atlas is None else []
+            for caster in casters:
                 sbuff_size = caster.get_shadow_buffer_size()
                 caster.set_shadow_buffer_size((0, 0))
                 caster.set_shadow_buffer_size(sbuff_size)
@@ -321,18 +665,7 @@ class Pipeline:
         if postquad is None:
             raise RuntimeError('Failed to setup FilterManager')
 
-        defines = {
-            'USE_330': self.use_330,
-            'IS_WEBGL': self._is_webgl,
-            'USE_SDR_LUT': bool(self.sdr_lut),
-        }
-
-        tonemap_shader = shaderutils.make_shader(
-            'tonemap',
-            'post.vert',
-            'tonemap.frag',
-            defines
-        )
+        tonemap_shader = self._create_tonemap_shader()
         postquad.set_shader(tonemap_shader)
         postquad.set_shader_input('tex', scene_tex)
         postquad.set_shader_input('exposure', 2**self.exposure)
@@ -342,13 +675,58 @@ class Pipeline:
 
         self._post_process_quad = postquad
 
-    def get_all_casters(self) -> list[p3d.LightLensNode]:
+    def stats(self) -> dict[str, Any]:
+        '''Return a snapshot of simplepbr's counters and timings
+
+        Call counts and timings are only recorded while PStats is connected or the
+        simplepbr-profile PRC variable is set.
+        '''
+        return {
+            'profile': profiling.snapshot(),
+            'shader_cache': shaderutils.get_shader_cache_stats(),
+            'envpool': EnvPool.ptr().stats(),
+            'caster_scans': self._num_caster_scans,
+            'shadow_updates': self._shadow_scheduler.stats(),
+            'clustered_lights': (
+                self._light_clusters.stats() if self._light_clusters is not None else None
+            ),
+            'light_selection': (
+                self._light_selector.stats() if self._light_selector is not None else None
+            ),
+            'skinning_palette': (
+                self._skinning_palette.stats() if self._skinning_palette is not None else None
+            ),
+            'shadow_atlas': (
+                self._shadow_atlas.stats() if self._shadow_atlas is not None else None
+            ),
+            'cascaded_shadows': (
+                self._cascaded_shadows.stats() if self._cascaded_shadows is not None else None
+            ),
+        }
+
+    @property
+    def num_caster_scans(self) -> int:
+        '''Number of times the graphics engine has been scanned for shadow casters'''
+        return self._num_caster_scans
+
+    def invalidate_casters(self) -> None:
+        '''Force the next update to scan for shadow casters
+
+        Casters are rescanned automatically when windows or buffers are added or removed (which
+        happens when a light's shadow caster flag changes), but not when, e.g., a display region
+        is switched to a different camera.
+        '''
+        self._caster_signature = None
+
+    def _get_casters_signature(self) -> tuple[int, p3d.GraphicsOutput | None]:
+        engine = p3d.GraphicsEngine.get_global_ptr()
+        num_windows = engine.get_num_windows()
+        newest = engine.get_window(num_windows - 1) if num_windows else None
+        return (num_windows, newest)
+
+    def _get_caster_regions(self) -> list[CasterRegionType]:
+        self._num_caster_scans += 1
         engine = p3d.GraphicsEngine.get_global_ptr()
-        cameras = [
-            dispregion.camera
-            for win in engine.windows
-            for dispregion in win.active_display_regions
-        ]
 
         def is_caster(node: p3d.NodePath[p3d.PandaNode]) -> bool:
             if node.is_empty():
@@ -357,39 +735,115 @@ class Pipeline:
             pandanode = node.node()
             return hasattr(pandanode, 'is_shadow_caster') and pandanode.is_shadow_caster()
 
+        # Include inactive display regions, shadow update policies deactivate them between
+        # renders
         return [
-            i.node()
-            for i in cameras
-            if is_caster(i)
+            (dispregion, dispregion.camera)
+            for win in engine.windows
+            for dispregion in win.display_regions
+            if is_caster(dispregion.camera)
         ]
 
+    def get_all_casters(self) -> list[p3d.LightLensNode]:
+        casters = []
+        for _, camera in self._get_caster_regions():
+            if camera.node() not in casters:
+                casters.append(camera.node())
+        return casters
+
     def _create_shadow_shader_attrib(self) -> p3d.ShaderAttrib:
-        defines = {
-            'USE_330': self.use_330,
-            'IS_WEBGL': self._is_webgl,
-            'ENABLE_SKINNING': self.enable_hardware_skinning,
-        }
-        shader = shaderutils.make_shader(
-            'shadow',
-            'shadow.vert',
-            'shadow.frag',
-            defines
-        )
+        shader = self._create_shadow_shader()
         attr = p3d.ShaderAttrib.make(shader)
         if self.enable_hardware_skinning:
             attr = attr.set_flag(p3d.ShaderAttrib.F_hardware_skinning, True)
         return attr
 
+    @profiling.profiled('update')
     def _update(self, task: p3d.PythonTask) -> int:
-        recompile = False
-        # Use a simpler, faster shader for shadows
-        for caster in self.get_all_casters():
-            if isinstance(caster, p3d.PointLight):
+        if self._batch_depth == 0:
+            self._flush_updates()
+
+        # Only scan for new shadow casters when windows or buffers have changed
+        signature = self._get_casters_signature()
+        if signature != self._caster_signature:
+            self._caster_signature = signature
+            self._setup_casters()
+
+        # Copy window background color so ShowBase.set_background_color() works
+        self._filtermgr.buffers[0].set_clear_color(self.window.get_clear_color())
+
+        self.render_node.set_shader_input(
+            'camera_world_position',
+            self.camera_node.get_pos(self.render_node)
+        )
+
+        if self._caster_regions:
+            self._shadow_scheduler.update(
+                self._caster_regions,
+                self.render_node,
+                self.shadow_update_policy,
+                self.shadow_update_interval,
+            )
+
+        if self._light_selector is not None:
+            self._light_selector.update(self.render_node, self.max_lights)
+
+        if self._light_clusters is not None:
+            self._light_clusters.update(self.render_node, self.camera_node)
+
+        if self._skinning_palette is not None:
+            self._skinning_palette.update(self.render_node)
+
+        if self._shadow_atlas is not None:
+            if self.enable_shadows:
+                self._shadow_atlas.update(self.camera_node)
+            else:
+                self._shadow_atlas.set_active(False)
+
+        if self._cascaded_shadows is not None:
+            if self.enable_shadows:
+                self._cascaded_shadows.update(self.camera_node)
+            else:
+                self._cascaded_shadows.set_active(False)
+
+        return task.DS_cont
+
+    def _setup_casters(self) -> None:
+        regions = self._get_caster_regions()
+        # The shadow atlas schedules its own updates
+        atlas_buffer = self._shadow_atlas.buffer if self._shadow_atlas is not None else None
+        self._caster_regions = [i for i in regions if i[0].window != atlas_buffer]
+
+        # Point light shadows are only rendered through the shadow atlas, so skip rendering any
+        # cube map buffers Panda3D made for them
+        point_regions = [
+            i for i in self._caster_regions if isinstance(i[1].node(), p3d.PointLight)
+        ]
+        if point_regions:
+            self._caster_regions = [i for i in self._caster_regions if i not in point_regions]
+            for dispregion, _ in point_regions:
+                dispregion.set_active(False)
+                if not any(i.is_active() for i in dispregion.window.display_regions):
+                    dispregion.window.set_active(False)
+
+        if not self.enable_shadow_atlas:
+            # The regular shader would sample a point light's cube map as a 2D shadow map
+            point_casters = {i[1].node() for i in point_regions}
+            for caster in sorted(point_casters, key=lambda caster: caster.name):
                 logging.warning(
-                    f'PointLight shadow casters are not supported, disabling {caster.name}'
+                    f'PointLight shadows require enable_shadow_atlas, disabling {caster.name}'
                 )
                 caster.set_shadow_caster(False)
-                recompile = True
+            if point_casters:
+                self._recompile_pbr()
+
+        # Use a simpler, faster shader for shadows
+        casters = []
+        for _, camera in regions:
+            if camera.node() not in casters:
+                casters.append(camera.node())
+        for caster in casters:
+            if isinstance(caster, p3d.PointLight):
                 continue
             state = caster.get_initial_state()
             if not state.has_attrib(p3d.ShaderAttrib):
@@ -398,19 +852,57 @@ class Pipeline:
                 state = state.remove_attrib(p3d.CullFaceAttrib)
                 caster.set_initial_state(state)
 
-        if recompile:
-            self._recompile_pbr()
 
-        # Copy window background color so ShowBase.set_background_color() works
-        self._filtermgr.buffers[0].set_clear_color(self.window.get_clear_color())
-
-        self.render_node.set_shader_input(
-            'camera_world_position',
-            self.camera_node.get_pos(self.render_node)
+    def precompile_variants(
+        self,
+        options: Iterable[ShaderOptionsType] = ({},),
+        *,
+        time_budget: float = 0.004,
+        progress_cb: Callable[[int, int], None] | None = None,
+    ) -> p3d.AsyncFuture:
+        '''Build and prepare the shader variants used by the given option combinations
+
+        Each item of options maps Pipeline option names (e.g., enable_fog or max_lights) to the
+        values to use, with unspecified options using the current values. The PBR, shadow, and
+        tonemap shaders are compiled in a task that spends up to time_budget seconds per frame,
+        calling progress_cb with the number of variants done and the total. The returned future
+        is done once every variant has been prepared.
+        '''
+        builders = (
+            self._create_pbr_shader,
+            self._create_shadow_shader,
+            self._create_tonemap_shader,
         )
-
-        return task.DS_cont
-
+        jobs = []
+        for optionset in options:
+            for name in optionset:
+                if name.startswith('_') or not hasattr(self, name):
+                    raise ValueError(f'Unknown Pipeline option: {name}')
+            jobs.extend(functools.partial(builder, optionset) for builder in builders)
+
+        future = p3d.AsyncFuture()
+        prepared: set[p3d.Shader] = set()
+        numjobs = len(jobs)
+        jobs.reverse()
+
+        def precompile(task: p3d.PythonTask) -> int:
+            gsg = self.window.gsg
+            starttime = time.perf_counter()
+            while jobs:
+                shader = jobs.pop()()
+                if shader not in prepared:
+                    prepared.add(shader)
+                    shader.prepare_now(gsg.prepared_objects, gsg)
+                if progress_cb is not None:
+                    progress_cb(numjobs - len(jobs), numjobs)
+                if time.perf_counter() - starttime >= time_budget:
+                    return task.DS_cont
+
+            future.set_result(len(prepared))
+            return task.DS_done
+
+        self.taskmgr.add(precompile, 'simplepbr precompile variants')
+        return future
 
     def verify_shaders(self) -> None:
         gsg = self.window.gsg
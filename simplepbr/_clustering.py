@@ -0,0 +1,487 @@
+'''CPU-side light binning for clustered forward shading
+
+The view frustum is divided into a grid of clusters (tiles on screen and exponentially sized
+depth slices). Each frame, point lights and spotlights are assigned to the clusters their
+bounding spheres overlap, and the light data, per-cluster offsets and counts, and the light
+index list are uploaded as float textures. The fragment shader then only loops over the lights
+of the cluster containing the fragment.
+
+Shadow casting lights are left to the regular light loop so their shadow maps are still used,
+and nodes whose LightAttrib changes the set of lights they receive fall back to the regular
+loop via the clustered_lights_enabled shader input.
+'''
+from __future__ import annotations
+
+import array
+import math
+from typing import (
+    Any,
+    Final,
+)
+from typing_extensions import (
+    TypeAlias,
+)
+
+import panda3d.core as p3d
+
+from . import _profiling as profiling
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # type: ignore[assignment]
+
+
+CLUSTER_GRID: Final = (16, 9, 24)
+
+# Width of the light index texture, the shader gets it via the CLUSTER_INDEX_WIDTH define
+INDEX_TEXTURE_WIDTH: Final = 1024
+
+# Number of RGBA texels used for each light in the light data texture
+TEXELS_PER_LIGHT: Final = 4
+
+# Lights are treated as out of range once their intensity drops below this
+LIGHT_THRESHOLD: Final = 1.0 / 256.0
+
+GridType: TypeAlias = 'tuple[int, int, int]'
+ClusterBoxType: TypeAlias = 'tuple[int, int, int, int, int, int]'
+SphereType: TypeAlias = 'tuple[float, float, float, float]'
+# (bounds sequence, parent LightAttrib, parent enabled, shader input set here, child entries)
+NodeStateType: TypeAlias = (
+    'tuple[int, p3d.LightAttrib, bool, bool | None, dict[p3d.PandaNode, Any]]'
+)
+
+
+def get_light_radius(light: p3d.PointLight | p3d.Spotlight) -> float:
+    '''Return the distance at which a light's contribution falls below LIGHT_THRESHOLD'''
+    color = light.color
+    target = max(color[0], color[1], color[2]) / LIGHT_THRESHOLD
+    const, linear, quadratic = light.attenuation
+    if target <= const:
+        return 0.0
+
+    if quadratic > 0.0:
+        radius = (
+            -linear + math.sqrt(linear * linear - 4.0 * quadratic * (const - target))
+        ) / (2.0 * quadratic)
+    elif linear > 0.0:
+        radius = (target - const) / linear
+    else:
+        radius = math.inf
+
+    return min(radius, light.max_distance)
+
+
+def get_spot_cos_cutoff(light: p3d.Spotlight) -> float:
+    fov = light.get_lens().get_fov()
+    return math.cos(math.radians(max(fov[0], fov[1]) * 0.5))
+
+
+def get_spot_bounds(
+    position: p3d.LVecBase3,
+    forward: p3d.LVecBase3,
+    radius: float,
+    cos_cutoff: float,
+) -> tuple[p3d.LVecBase3, float]:
+    '''Return the center and radius of a sphere bounding a spotlight's cone'''
+    if cos_cutoff >= math.sqrt(0.5):
+        # Narrow cones fit in a sphere through the apex and the rim of the far cap
+        offset = radius / (2.0 * cos_cutoff)
+        return position + forward * offset, offset
+
+    sin_cutoff = math.sqrt(max(1.0 - cos_cutoff * cos_cutoff, 0.0))
+    return position + forward * (radius * cos_cutoff), radius * sin_cutoff
+
+
+def get_depth_slice_params(near: float, far: float, num_slices: int) -> tuple[float, float]:
+    '''Return the scale and bias that map log(depth) to a depth slice'''
+    scale = num_slices / math.log(far / near)
+    return scale, -math.log(near) * scale
+
+
+def get_cluster_box(
+    sphere: SphereType,
+    projmat: p3d.LMatrix4,
+    near: float,
+    far: float,
+    grid: GridType,
+    slice_params: tuple[float, float],
+) -> ClusterBoxType | None:
+    '''Return the range of clusters (x0, x1, y0, y1, z0, z1) overlapped by a sphere in camera
+    space, or None if the sphere is outside of the view frustum'''
+    xcenter, depth, zcenter, radius = sphere
+    if depth + radius < near or depth - radius > far:
+        return None
+
+    gridx, gridy, gridz = grid
+    if depth - radius <= near:
+        # The sphere crosses the near plane, so it can cover any part of the screen
+        box_x = (0, gridx - 1)
+        box_y = (0, gridy - 1)
+    else:
+        ndc_min = [math.inf, math.inf]
+        ndc_max = [-math.inf, -math.inf]
+        for xcoord in (xcenter - radius, xcenter + radius):
+            for ycoord in (depth - radius, depth + radius):
+                for zcoord in (zcenter - radius, zcenter + radius):
+                    clip = projmat.xform(p3d.LVecBase4(xcoord, ycoord, zcoord, 1.0))
+                    for axis in (0, 1):
+                        ndc = clip[axis] / clip[3]
+                        ndc_min[axis] = min(ndc_min[axis], ndc)
+                        ndc_max[axis] = max(ndc_max[axis], ndc)
+
+        if any(ndc_max[i] < -1.0 or ndc_min[i] > 1.0 for i in (0, 1)):
+            return None
+
+        def to_tile(ndc: float, count: int) -> int:
+            return min(max(math.floor((ndc * 0.5 + 0.5) * count), 0), count - 1)
+
+        box_x = (to_tile(ndc_min[0], gridx), to_tile(ndc_max[0], gridx))
+        box_y = (to_tile(ndc_min[1], gridy), to_tile(ndc_max[1], gridy))
+
+    def to_slice(slice_depth: float) -> int:
+        idx = math.floor(math.log(slice_depth) * slice_params[0] + slice_params[1])
+        return min(max(idx, 0), gridz - 1)
+
+    return (
+        *box_x,
+        *box_y,
+        to_slice(max(depth - radius, near)),
+        to_slice(min(depth + radius, far)),
+    )
+
+
+def _get_cluster_boxes_np(
+    spheres: list[SphereType],
+    projmat: p3d.LMatrix4,
+    near: float,
+    far: float,
+    grid: GridType,
+    slice_params: tuple[float, float],
+) -> Any:
+    bounds = np.array(spheres, dtype=np.float64).reshape(-1, 4)
+    depth = bounds[:, 1]
+    radius = bounds[:, 3]
+    visible = (depth + radius >= near) & (depth - radius <= far)
+
+    offsets = np.array([
+        (xoff, yoff, zoff, 0.0)
+        for xoff in (-1.0, 1.0)
+        for yoff in (-1.0, 1.0)
+        for zoff in (-1.0, 1.0)
+    ])
+    corners = bounds[:, None, :3] + offsets[None, :, :3] * radius[:, None, None]
+    clip = np.concatenate([corners, np.ones_like(corners[..., :1])], axis=2) @ np.array(projmat)
+
+    # The sphere crosses the near plane, so it can cover any part of the screen
+    crosses_near = depth - radius <= near
+    clipw = np.where(crosses_near[:, None], 1.0, clip[..., 3])
+    ndc = clip[..., :2] / clipw[..., None]
+    ndc_min = np.where(crosses_near[:, None], -1.0, ndc.min(axis=1))
+    ndc_max = np.where(crosses_near[:, None], 1.0, ndc.max(axis=1))
+    visible &= np.all(ndc_max >= -1.0, axis=1) & np.all(ndc_min <= 1.0, axis=1)
+
+    grid_xy = np.array(grid[:2])
+    tile_min = np.clip(np.floor((ndc_min * 0.5 + 0.5) * grid_xy), 0, grid_xy - 1)
+    tile_max = np.clip(np.floor((ndc_max * 0.5 + 0.5) * grid_xy), 0, grid_xy - 1)
+
+    def to_slice(slice_depth: Any) -> Any:
+        idx = np.floor(np.log(slice_depth) * slice_params[0] + slice_params[1])
+        return np.clip(idx, 0, grid[2] - 1)
+
+    boxes = np.stack([
+        tile_min[:, 0],
+        tile_max[:, 0],
+        tile_min[:, 1],
+        tile_max[:, 1],
+        to_slice(np.maximum(depth - radius, near)),
+        to_slice(np.clip(depth + radius, near, far)),
+    ], axis=1).astype(np.int32)
+    return boxes, visible
+
+
+def bin_lights(
+    spheres: list[SphereType],
+    projmat: p3d.LMatrix4,
+    near: float,
+    far: float,
+    grid: GridType,
+) -> tuple[list[int], bytes, bytes]:
+    '''Assign lights to the clusters overlapped by their bounding spheres (in camera space)
+
+    Returns the indices of the visible lights, the (offset, count) pairs for each cluster, and
+    the indices into the visible lights for all clusters. Clusters are ordered by depth slice,
+    then row, then column.
+    '''
+    gridx, gridy, gridz = grid
+    num_clusters = gridx * gridy * gridz
+    slice_params = get_depth_slice_params(near, far, gridz)
+
+    if np is not None:
+        boxes, visible = _get_cluster_boxes_np(spheres, projmat, near, far, grid, slice_params)
+        boxes = boxes[visible]
+        def in_range(count: int, axis: int) -> Any:
+            idx = np.arange(count)
+            return (idx >= boxes[:, 2 * axis, None]) & (idx <= boxes[:, 2 * axis + 1, None])
+        mask = (
+            in_range(gridz, 2)[:, :, None, None]
+            & in_range(gridy, 1)[:, None, :, None]
+            & in_range(gridx, 0)[:, None, None, :]
+        )
+        # Order the (cluster, light) pairs by cluster
+        nonzero = np.nonzero(mask.transpose(1, 2, 3, 0))
+        cluster_ids = np.ravel_multi_index(nonzero[:3], (gridz, gridy, gridx))
+        counts = np.bincount(cluster_ids, minlength=num_clusters)
+        offsets = np.cumsum(counts) - counts
+        cluster_data = np.stack([offsets, counts], axis=1).astype('<f4')
+        return (
+            np.flatnonzero(visible).tolist(),
+            cluster_data.tobytes(),
+            nonzero[3].astype('<f4').tobytes(),
+        )
+
+    visible_lights = []
+    clusters: list[list[int]] = [[] for _ in range(num_clusters)]
+    for sphere_idx, sphere in enumerate(spheres):
+        box = get_cluster_box(sphere, projmat, near, far, grid, slice_params)
+        if box is None:
+            continue
+        light_idx = len(visible_lights)
+        visible_lights.append(sphere_idx)
+        xmin, xmax, ymin, ymax, zmin, zmax = box
+        for zcoord in range(zmin, zmax + 1):
+            for ycoord in range(ymin, ymax + 1):
+                base = (zcoord * gridy + ycoord) * gridx
+                for xcoord in range(xmin, xmax + 1):
+                    clusters[base + xcoord].append(light_idx)
+
+    cluster_values = array.array('f')
+    indices = array.array('f')
+    for lights in clusters:
+        cluster_values.append(len(indices))
+        cluster_values.append(len(lights))
+        indices.extend(lights)
+    return visible_lights, cluster_values.tobytes(), indices.tobytes()
+
+
+def _make_data_texture(name: str, width: int, height: int, fmt: int) -> p3d.Texture:
+    texture = p3d.Texture(name)
+    texture.setup_2d_texture(width, height, p3d.Texture.T_float, fmt)
+    texture.minfilter = p3d.SamplerState.FT_nearest
+    texture.magfilter = p3d.SamplerState.FT_nearest
+    return texture
+
+
+def _resize_data_texture(texture: p3d.Texture, width: int, height: int) -> None:
+    if texture.x_size != width or texture.y_size != height:
+        texture.setup_2d_texture(width, height, p3d.Texture.T_float, texture.format)
+
+
+class ClusteredLightManager:
+    '''Bins the point lights and spotlights applied to a render node into view frustum
+    clusters for the clustered lighting variant of the PBR shader'''
+    def __init__(self, grid: GridType = CLUSTER_GRID, max_lights: int = 8) -> None:
+        self.grid = grid
+        self.max_lights = max_lights
+        gridx, gridy, gridz = grid
+        self.light_data = _make_data_texture(
+            'clustered_light_data',
+            TEXELS_PER_LIGHT,
+            1,
+            p3d.Texture.F_rgba32,
+        )
+        self.cluster_data = _make_data_texture(
+            'clustered_cluster_data',
+            gridx * gridy,
+            gridz,
+            p3d.Texture.F_rg32,
+        )
+        self.light_indices = _make_data_texture(
+            'clustered_light_indices',
+            INDEX_TEXTURE_WIDTH,
+            1,
+            p3d.Texture.F_r32,
+        )
+        # Shader inputs are in the GSG's coordinate system (Y-up for OpenGL)
+        self._to_shader_space = p3d.LMatrix4.convert_mat(p3d.CS_default, p3d.CS_yup_right)
+        # View space positions of the shadow casting lights left to the regular light loop
+        self.shadow_lights = p3d.PTA_LVecBase4f([p3d.LVecBase4(0)] * max_lights)
+        self.num_lights = 0
+        self.num_indices = 0
+        self._clustered: frozenset[p3d.NodePath[p3d.PandaNode]] = frozenset()
+        self._lights_changed = False
+        self._root: NodeStateType | None = None
+
+    def get_lights(
+        self,
+        render_node: p3d.NodePath[p3d.PandaNode],
+        *,
+        shadow_casters: bool = False,
+    ) -> list[p3d.NodePath[p3d.PandaNode]]:
+        '''Return the clustered lights of a render node, or its shadow casting point lights and
+        spotlights if shadow_casters is set'''
+        attrib = render_node.get_attrib(p3d.LightAttrib)
+        if attrib is None:
+            return []
+        return [
+            light
+            for light in attrib.get_on_lights()
+            if isinstance(light.node(), (p3d.PointLight, p3d.Spotlight))
+            and light.node().is_shadow_caster() == shadow_casters
+        ]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'lights': self.num_lights,
+            'indices': self.num_indices,
+        }
+
+    @profiling.profiled('cluster_lights')
+    def update(
+        self,
+        render_node: p3d.NodePath[p3d.PandaNode],
+        camera_node: p3d.NodePath[p3d.Camera],
+    ) -> None:
+        lens = camera_node.node().get_lens()
+        near = lens.near
+        far = lens.far
+
+        spheres: list[SphereType] = []
+        light_texels: list[tuple[float, ...]] = []
+        for lightnp in self.get_lights(render_node):
+            light = lightnp.node()
+            radius = get_light_radius(light)
+            if radius <= 0.0:
+                continue
+            # Lights without falloff reach the whole view frustum
+            radius = min(radius, far)
+
+            mat = lightnp.get_mat(camera_node)
+            position = mat.get_row3(3)
+            forward = mat.get_row3(1).normalized()
+            if isinstance(light, p3d.Spotlight):
+                cos_cutoff = get_spot_cos_cutoff(light)
+                center, bounds_radius = get_spot_bounds(position, forward, radius, cos_cutoff)
+            else:
+                cos_cutoff = -1.0
+                center, bounds_radius = position, radius
+            spheres.append((*center, bounds_radius))
+
+            color = light.color
+            light_texels.append((
+                *self._to_shader_space.xform_point(position), radius,
+                color[0], color[1], color[2], cos_cutoff,
+                *self._to_shader_space.xform_vec(forward), 0.0,
+                *light.attenuation, 0.0,
+            ))
+
+        visible, cluster_values, index_values = bin_lights(
+            spheres,
+            lens.get_projection_mat(),
+            near,
+            far,
+            self.grid,
+        )
+        self.num_lights = len(visible)
+        self.num_indices = len(index_values) // 4
+
+        light_values = array.array('f')
+        for light_idx in visible:
+            light_values.extend(light_texels[light_idx])
+        if not visible:
+            light_values.extend([0.0] * 4 * TEXELS_PER_LIGHT)
+        _resize_data_texture(self.light_data, TEXELS_PER_LIGHT, max(len(visible), 1))
+        self.light_data.set_ram_image_as(light_values.tobytes(), 'RGBA')
+
+        self.cluster_data.set_ram_image(cluster_values)
+
+        rows = max(math.ceil(self.num_indices / INDEX_TEXTURE_WIDTH), 1)
+        _resize_data_texture(self.light_indices, INDEX_TEXTURE_WIDTH, rows)
+        padding = rows * INDEX_TEXTURE_WIDTH - self.num_indices
+        self.light_indices.set_ram_image(index_values + bytes(4 * padding))
+
+        casters = self.get_lights(render_node, shadow_casters=True)[:self.max_lights]
+        for idx in range(self.max_lights):
+            self.shadow_lights[idx] = p3d.LVecBase4(0)
+        for idx, lightnp in enumerate(casters):
+            position = self._to_shader_space.xform_point(lightnp.get_pos(camera_node))
+            self.shadow_lights[idx] = p3d.LVecBase4(position, 1)
+
+        slice_params = get_depth_slice_params(near, far, self.grid[2])
+        render_node.set_shader_input('cluster_slice_params', p3d.LVecBase2(*slice_params))
+
+        clustered = frozenset(self.get_lights(render_node))
+        self._lights_changed = clustered != self._clustered
+        self._clustered = clustered
+        self._root = self._visit(render_node.node(), p3d.LightAttrib.make(), True, self._root, True)
+
+    def _visit(
+        self,
+        node: p3d.PandaNode,
+        parent_attrib: p3d.LightAttrib,
+        parent_enabled: bool,
+        prev: NodeStateType | None,
+        is_root: bool,
+    ) -> NodeStateType:
+        seq = p3d.UpdateSeq()
+        thread = p3d.Thread.get_current_thread()
+        node.get_bounds(seq, thread)
+        if (
+            prev is not None
+            and not self._lights_changed
+            and prev[0] == seq.get_seq()
+            and prev[1] == parent_attrib
+            and prev[2] == parent_enabled
+        ):
+            return prev
+
+        own_attrib = node.get_attrib(p3d.LightAttrib)
+        net_attrib = parent_attrib.compose(own_attrib) if own_attrib is not None else parent_attrib
+        enabled = parent_enabled
+        if own_attrib is not None and not is_root:
+            # Only nodes lit by exactly the clustered lights can use the cluster loop
+            lights = frozenset(
+                light
+                for light in net_attrib.get_on_lights()
+                if isinstance(light.node(), (p3d.PointLight, p3d.Spotlight))
+                and not light.node().is_shadow_caster()
+            )
+            enabled = lights == self._clustered
+
+        value = enabled if enabled != parent_enabled else None
+        if value != (prev[3] if prev is not None else None):
+            if value is None:
+                p3d.NodePath(node).clear_shader_input('clustered_lights_enabled')
+            else:
+                p3d.NodePath(node).set_shader_input('clustered_lights_enabled', float(value))
+
+        prev_children = prev[4] if prev is not None else {}
+        children = {
+            child: self._visit(child, net_attrib, enabled, prev_children.get(child), False)
+            for child in node.get_children()
+        }
+
+        # Setting shader inputs above bumped the sequence of this node
+        node.get_bounds(seq, thread)
+        return (seq.get_seq(), parent_attrib, parent_enabled, value, children)
+
+    def apply(self, render_node: p3d.NodePath[p3d.PandaNode]) -> None:
+        '''Bind the cluster textures to a render node'''
+        render_node.set_shader_input('clustered_light_data', self.light_data)
+        render_node.set_shader_input('clustered_cluster_data', self.cluster_data)
+        render_node.set_shader_input('clustered_light_indices', self.light_indices)
+        render_node.set_shader_input('cluster_grid', p3d.LVecBase3(*self.grid))
+        render_node.set_shader_input('cluster_slice_params', p3d.LVecBase2(1.0, 0.0))
+        render_node.set_shader_input('clustered_shadow_lights', self.shadow_lights)
+        render_node.set_shader_input('clustered_lights_enabled', 1.0)
+
+    def clear(self) -> None:
+        '''Remove the clustered_lights_enabled inputs set on nodes under the render node'''
+        entries = list(self._root[4].items()) if self._root is not None else []
+        while entries:
+            node, entry = entries.pop()
+            if entry[3] is not None:
+                p3d.NodePath(node).clear_shader_input('clustered_lights_enabled')
+            entries.extend(entry[4].items())
+        self._root = None
+        self._clustered = frozenset()
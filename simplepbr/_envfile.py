@@ -0,0 +1,164 @@
+'''Reading and writing of version 2 .env files
+
+A version 2 file starts with a header and an index of chunks, followed by the chunk data:
+
+    header: magic (8 bytes), version (uint32), number of chunks (uint32)
+    index: per chunk, tag (4 bytes), flags (uint32), offset, stored size, and raw size (uint64)
+
+All values are little-endian. Chunks can be zlib compressed, and each prefiltered mip level and
+the source cube map are stored in separate chunks so readers only touch what they need. Version 1
+files are BAM files and are handled by EnvMap directly.
+'''
+from __future__ import annotations
+
+from collections.abc import Sequence
+import json
+import mmap
+import os
+import struct
+from typing import (
+    Any,
+    Final,
+)
+from typing_extensions import (
+    Self,
+)
+import zlib
+
+import panda3d.core as p3d
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # type: ignore[assignment]
+
+
+MAGIC: Final = b'SPBRENV\x00'
+VERSION: Final = 2
+FLAG_ZLIB: Final = 1
+
+HEADER: Final = struct.Struct('<8sII')
+CHUNK_ENTRY: Final = struct.Struct('<4sIQQQ')
+
+TAG_META: Final = b'META'
+TAG_SH: Final = b'SHCF'
+TAG_SOURCE: Final = b'SRC '
+
+# Largest finite half float, brighter HDR values are clamped to it
+HALF_MAX: Final = 65504.0
+
+
+def get_mip_tag(level: int) -> bytes:
+    return f'M{level:03d}'.encode('ascii')
+
+
+def is_env_file(header: bytes) -> bool:
+    return header[:len(MAGIC)] == MAGIC
+
+
+def floats_to_halves(data: Any) -> bytes:
+    '''Convert a buffer of 32-bit floats to 16-bit floats'''
+    if np is not None:
+        floats = np.frombuffer(data, dtype='<f4')
+        return np.clip(floats, -HALF_MAX, HALF_MAX).astype('<f2').tobytes()
+
+    view = memoryview(data).cast('B')
+    count = len(view) // 4
+    floats = struct.unpack(f'<{count}f', view)
+    return struct.pack(
+        f'<{count}e',
+        *(min(max(i, -HALF_MAX), HALF_MAX) for i in floats)
+    )
+
+
+def get_texture_image(texture: p3d.Texture, level: int) -> tuple[int, bytes]:
+    '''Return the component type and bytes to store for a mip level of a texture'''
+    data = memoryview(texture.get_ram_mipmap_image(level))
+    if texture.component_type == p3d.Texture.T_float:
+        return p3d.Texture.T_half_float, floats_to_halves(data)
+    return texture.component_type, data.tobytes()
+
+
+def write_env_file(
+    filepath: p3d.Filename,
+    chunks: Sequence[tuple[bytes, bytes]],
+    *,
+    compress: bool = True,
+) -> None:
+    index = []
+    payloads = []
+    offset = HEADER.size + CHUNK_ENTRY.size * len(chunks)
+    for tag, data in chunks:
+        flags = 0
+        stored = data
+        if compress:
+            compressed = zlib.compress(data, 6)
+            if len(compressed) < len(data):
+                flags |= FLAG_ZLIB
+                stored = compressed
+        index.append(CHUNK_ENTRY.pack(tag, flags, offset, len(stored), len(data)))
+        payloads.append(stored)
+        offset += len(stored)
+
+    with open(filepath.to_os_specific(), 'wb') as envfile:
+        envfile.write(HEADER.pack(MAGIC, VERSION, len(chunks)))
+        for entry in index:
+            envfile.write(entry)
+        for payload in payloads:
+            envfile.write(payload)
+
+
+class EnvFileReader:
+    '''Random access to the chunks of a version 2 .env file
+
+    Files on disk are memory-mapped so only the chunks that are read get paged in, other files
+    (e.g., in a multifile) are read through the VirtualFileSystem.
+    '''
+    def __init__(self, filepath: p3d.Filename) -> None:
+        self._data: mmap.mmap | bytes
+        ospath = filepath.to_os_specific()
+        if os.path.isfile(ospath):
+            # The mapping stays valid after the file is closed
+            with open(ospath, 'rb') as envfile:
+                self._data = mmap.mmap(envfile.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            vfs = p3d.VirtualFileSystem.get_global_ptr()
+            self._data = vfs.read_file(filepath, True)
+
+        magic, version, num_chunks = HEADER.unpack_from(self._data, 0)
+        if magic != MAGIC:
+            self.close()
+            raise RuntimeError(f'{filepath} is not a simplepbr env file')
+        if version != VERSION:
+            self.close()
+            raise RuntimeError(f'{filepath} has unsupported env file version {version}')
+
+        self._chunks: dict[bytes, tuple[int, int, int, int]] = {}
+        for idx in range(num_chunks):
+            tag, flags, offset, size, rawsize = CHUNK_ENTRY.unpack_from(
+                self._data,
+                HEADER.size + idx * CHUNK_ENTRY.size
+            )
+            self._chunks[tag] = (flags, offset, size, rawsize)
+
+        self.meta: dict[str, Any] = json.loads(self.read_chunk(TAG_META))
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def has_chunk(self, tag: bytes) -> bool:
+        return tag in self._chunks
+
+    def read_chunk(self, tag: bytes) -> bytes:
+        flags, offset, size, rawsize = self._chunks[tag]
+        data = self._data[offset:offset + size]
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data, bufsize=rawsize)
+        return data
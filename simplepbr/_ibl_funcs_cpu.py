@@ -1,11 +1,19 @@
 from __future__ import annotations
 # pylint: disable=invalid-name
 
+from collections.abc import (
+    Callable,
+    Iterable,
+    Sequence,
+)
+from concurrent.futures import Executor
 import functools
+import itertools
 import math
 import struct
 import typing
 from typing import (
+    Any,
     Final,
 )
 from typing_extensions import (
@@ -14,6 +22,11 @@ from typing_extensions import (
 
 import panda3d.core as p3d
 
+try:
+    from . import _ibl_funcs_np as iblfuncs_np
+except ImportError:
+    iblfuncs_np = None # type: ignore[assignment]
+
 Vec2TupleType: TypeAlias = 'tuple[float, float]'
 Vec3TupleType: TypeAlias = 'tuple[float, float, float]'
 SHTupleType: TypeAlias = '''tuple[
@@ -28,6 +41,8 @@ SHTupleType: TypeAlias = '''tuple[
     float,
 ]'''
 
+ALL_FACES: Final = (0, 1, 2, 3, 4, 5)
+
 
 def calc_vector(dim: int, face_idx: int, xloc: float, yloc: float) -> Vec3TupleType:
     maxidx = dim - 1
@@ -88,7 +103,7 @@ def get_sh_basis_from_vector(vec: Vec3TupleType) -> SHTupleType:
         0.546274 * (vecx * vecx - vecy * vecy),
     )
 
-def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
+def check_cube_map(texcubemap: p3d.Texture) -> None:
     if texcubemap.z_size != 6:
         raise RuntimeError('supplied texture was not a cube map')
     if texcubemap.x_size != texcubemap.y_size:
@@ -96,6 +111,28 @@ def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
     if not texcubemap.might_have_ram_image():
         raise RuntimeError('expected might_have_ram_image() to be true on supplied texture')
 
+
+def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture, stride: int = 1) -> list[p3d.LVector3]:
+    check_cube_map(texcubemap)
+
+    shcoeffs = get_sh_sums_from_cube_map(texcubemap, stride=stride)
+    apply_sh_cosine_lobe(shcoeffs)
+
+    return shcoeffs
+
+
+def get_sh_sums_from_cube_map(
+    texcubemap: p3d.Texture,
+    faces: Sequence[int] = ALL_FACES,
+    stride: int = 1,
+) -> list[p3d.LVector3]:
+    if iblfuncs_np is not None and iblfuncs_np.supports_texture(texcubemap):
+        shsums = iblfuncs_np.get_sh_sums_from_cube_map(texcubemap, faces, stride)
+        return [
+            p3d.LVector3(*(float(i) for i in coeff))
+            for coeff in shsums
+        ]
+
     peeker = texcubemap.peek()
 
     if peeker is None:
@@ -118,10 +155,10 @@ def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
     colorptr = p3d.LColor()
 
     # SH Basis
-    for x in range(texcubemap.x_size):
-        for y in range(texcubemap.y_size):
-            sa = calc_solid_angle(invdim, x, y)
-            for face in range(texcubemap.z_size):
+    for x in range(0, texcubemap.x_size, stride):
+        for y in range(0, texcubemap.y_size, stride):
+            sa = calc_solid_angle(invdim, x, y) * stride * stride
+            for face in faces:
                 # Grab the color value
                 peeker.fetch_pixel(colorptr, x, y, face)
                 color = colorptr.xyz
@@ -135,6 +172,10 @@ def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
                 for idx, value in enumerate(basis):
                     shcoeffs[idx] += color * value
 
+    return shcoeffs
+
+
+def apply_sh_cosine_lobe(shcoeffs: list[p3d.LVector3]) -> None:
     # Convolution with cosine lobe for irradiance
     # this is actually for reconstruction, but we can bake it in here to avoid
     # extra math in the shader
@@ -150,8 +191,6 @@ def get_sh_coeffs_from_cube_map(texcubemap: p3d.Texture) -> list[p3d.LVector3]:
     shcoeffs[6] *= a2
     shcoeffs[7] *= a2
 
-    return shcoeffs
-
 
 def van_der_corput(idx: int, base: int = 2) -> float:
     result = 0.0
@@ -246,23 +285,106 @@ def integrate_brdf(ndotv: float, roughness: float, num_samples: int = 1024) -> p
     return retval
 
 
-def gen_brdf_lut(lutsize: int, num_samples: int = 1024) -> p3d.Texture:
+def integrate_brdf_rows(lutsize: int, num_samples: int, rows: Sequence[int]) -> bytes:
+    '''Integrate the given rows of a BRDF LUT, returning packed (scale, bias) floats'''
+    if iblfuncs_np is not None:
+        return iblfuncs_np.integrate_brdf_rows(lutsize, num_samples, rows)
+
+    data = bytearray(len(rows) * lutsize * 2 * 4)
+    for rowidx, ycoord in enumerate(rows):
+        for xcoord in range(lutsize):
+            idx = (rowidx * lutsize + xcoord) * 2 * 4
+            result = integrate_brdf(xcoord / lutsize, ycoord / lutsize, num_samples)
+            struct.pack_into('ff', data, idx, result[0], result[1])
+
+    return bytes(data)
+
+
+def calc_average_albedo(row: Sequence[float]) -> float:
+    '''Calculate the cosine-weighted average of directional albedo samples
+
+    The samples are expected at n_dot_v = idx / len(row).
+    '''
+    lutsize = len(row)
+    # Trapezoidal integration of 2 * E(mu) * mu from 0 to 1
+    points = [(idx / lutsize, value) for idx, value in enumerate(row)]
+    points.append((1.0, row[-1]))
+    total = 0.0
+    for (mu0, albedo0), (mu1, albedo1) in zip(points, points[1:]):
+        total += (albedo0 * mu0 + albedo1 * mu1) * 0.5 * (mu1 - mu0)
+    return min(2 * total, 1.0)
+
+
+def gen_brdf_lut(
+    lutsize: int,
+    num_samples: int = 1024,
+    *,
+    multiscatter: bool = False,
+    executor: Executor | None = None,
+    progress_cb: Callable[[int, int], None] | None = None,
+) -> p3d.Texture:
+    '''Generate the split-sum BRDF LUT
+
+    The red and green channels store the scale and bias applied to F0. If
+    multiscatter is True, the blue channel stores the average directional
+    albedo for the roughness of each row, which is used for energy
+    compensation of multiple scattering.
+    '''
     brdflut = p3d.Texture('brdf_lut')
-    brdflut.setup_2d_texture(lutsize, lutsize, p3d.Texture.T_float, p3d.Texture.F_rg16)
+    brdflut.setup_2d_texture(
+        lutsize,
+        lutsize,
+        p3d.Texture.T_float,
+        p3d.Texture.F_rgb16 if multiscatter else p3d.Texture.F_rg16
+    )
     brdflut.wrap_u = p3d.SamplerState.WM_clamp
     brdflut.wrap_v = p3d.SamplerState.WM_clamp
     brdflut.minfilter = p3d.SamplerState.FT_linear
     brdflut.magfilter = p3d.SamplerState.FT_linear
 
-    handle = typing.cast(memoryview, brdflut.modify_ram_image())
-    pixelsize = brdflut.component_width * brdflut.num_components
-    xsize = brdflut.x_size
+    handle = typing.cast(memoryview, memoryview(brdflut.modify_ram_image()))
+    rowsize = lutsize * 2 * 4
 
-    for ycoord in range(lutsize):
-        for xcoord in range(lutsize):
-            idx = (ycoord * xsize + xcoord) * pixelsize
-            result = integrate_brdf(xcoord / lutsize, ycoord / lutsize, num_samples)
-            struct.pack_into('ff', handle, idx, result[0], result[1])
+    # Split the LUT into enough chunks to report progress and balance workers
+    chunksize = max(lutsize // 64, 1)
+    chunks = [
+        range(start, min(start + chunksize, lutsize))
+        for start in range(0, lutsize, chunksize)
+    ]
+
+    if executor is not None:
+        results: Iterable[bytes] = executor.map(
+            integrate_brdf_rows,
+            itertools.repeat(lutsize),
+            itertools.repeat(num_samples),
+            chunks,
+        )
+    else:
+        results = (integrate_brdf_rows(lutsize, num_samples, rows) for rows in chunks)
+
+    for rows, data in zip(chunks, results):
+        if multiscatter:
+            for rowidx, ycoord in enumerate(rows):
+                rowdata = struct.unpack_from(f'{lutsize * 2}f', data, rowidx * rowsize)
+                scales = rowdata[0::2]
+                biases = rowdata[1::2]
+                albedo_avg = calc_average_albedo([
+                    scale + bias
+                    for scale, bias in zip(scales, biases)
+                ])
+                offset = ycoord * lutsize * 3 * 4
+                for xcoord, (scale, bias) in enumerate(zip(scales, biases)):
+                    # RAM images are stored as BGR
+                    struct.pack_into(
+                        'fff',
+                        handle,
+                        offset + xcoord * 3 * 4,
+                        albedo_avg, bias, scale,
+                    )
+        else:
+            handle[rows.start * rowsize:rows.stop * rowsize] = data
+        if progress_cb is not None:
+            progress_cb(rows.stop, lutsize)
 
     return brdflut
 
@@ -294,6 +416,66 @@ def filter_sample(
     return retval
 
 
+def filter_mip_level(
+    peeker: p3d.TexturePeeker,
+    mipsize: int,
+    roughness: float,
+    num_samples: int,
+    faces: Sequence[int] = ALL_FACES,
+) -> p3d.PTA_uchar:
+    pixelsize = 3 * 4 # F_rgb32
+    texdata = p3d.PTA_uchar.empty_array(mipsize * mipsize * len(faces) * pixelsize)
+
+    for faceidx, face in enumerate(faces):
+        for xcoord in range(mipsize):
+            for ycoord in range(mipsize):
+                offset = ((faceidx * mipsize + ycoord) * mipsize + xcoord) * pixelsize
+                vec = calc_vector(mipsize, face, xcoord, ycoord)
+                pos = p3d.LVector3(vec[0], vec[1], vec[2])
+                result = filter_sample(pos, peeker, roughness, num_samples)
+                struct.pack_into(
+                    'fff',
+                    typing.cast(memoryview, texdata), offset, result[2], result[1], result[0]
+                )
+
+    return texdata
+
+
+def get_filter_source(envmap: p3d.Texture) -> Any:
+    '''Return the object filter_faces() samples from for the given cube map'''
+    if iblfuncs_np is not None and iblfuncs_np.supports_texture(envmap):
+        return iblfuncs_np.cube_map_to_array(envmap)
+    return envmap.peek()
+
+
+def filter_faces(
+    source: Any,
+    mipsize: int,
+    roughness: float,
+    num_samples: int,
+    faces: Sequence[int] = ALL_FACES,
+) -> p3d.PTA_uchar:
+    if isinstance(source, p3d.TexturePeeker):
+        return filter_mip_level(source, mipsize, roughness, num_samples, faces)
+    return iblfuncs_np.filter_mip_level_to_pta(source, mipsize, roughness, num_samples, faces)
+
+
+def get_mip_levels(size: int, num_mipmaps: int) -> list[tuple[int, float]]:
+    return [
+        (
+            int(size * 0.5 ** i),
+            1 if num_mipmaps == 1 else i / (num_mipmaps - 1),
+        )
+        for i in range(num_mipmaps)
+    ]
+
+
+def setup_filtered_env_map(filtered: p3d.Texture, size: int) -> None:
+    filtered.setup_cube_map(size, p3d.Texture.T_float, p3d.Texture.F_rgb32)
+    filtered.magfilter = p3d.SamplerState.FT_linear
+    filtered.minfilter = p3d.SamplerState.FT_linear_mipmap_linear
+
+
 def filter_env_map(
         envmap: p3d.Texture,
         filtered: p3d.Texture,
@@ -302,28 +484,9 @@ def filter_env_map(
         num_mipmaps: int = 4,
         num_samples: int = 4
     ) -> None:
-    peeker = envmap.peek()
-
-    filtered.setup_cube_map(size, p3d.Texture.T_float, p3d.Texture.F_rgb32)
-    filtered.magfilter = p3d.SamplerState.FT_linear
-    filtered.minfilter = p3d.SamplerState.FT_linear_mipmap_linear
+    source = get_filter_source(envmap)
+    setup_filtered_env_map(filtered, size)
 
-    pixelsize = filtered.component_width * filtered.num_components
-
-    for i in range(num_mipmaps):
-        mipsize = int(size * 0.5 ** i)
-        roughness = 1 if num_mipmaps == 1 else i / (num_mipmaps - 1)
-        texdata = p3d.PTA_uchar.empty_array(mipsize * mipsize * 6 * pixelsize)
-
-        for face in range(6):
-            for xcoord in range(mipsize):
-                for ycoord in range(mipsize):
-                    offset = ((face * mipsize + ycoord) * mipsize + xcoord) * pixelsize
-                    vec = calc_vector(mipsize, face, xcoord, ycoord)
-                    pos = p3d.LVector3(vec[0], vec[1], vec[2])
-                    result = filter_sample(pos, peeker, roughness, num_samples)
-                    struct.pack_into(
-                        'fff',
-                        typing.cast(memoryview, texdata), offset, result[2], result[1], result[0]
-                    )
+    for i, (mipsize, roughness) in enumerate(get_mip_levels(size, num_mipmaps)):
+        texdata = filter_faces(source, mipsize, roughness, num_samples)
         filtered.set_ram_mipmap_image(i, texdata)
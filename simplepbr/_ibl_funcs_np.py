@@ -0,0 +1,362 @@
+from __future__ import annotations
+# pylint: disable=invalid-name
+
+from collections.abc import (
+    Sequence,
+)
+import typing
+from typing_extensions import (
+    TypeAlias,
+)
+
+import numpy as np
+import numpy.typing as npt
+
+import panda3d.core as p3d
+
+
+FloatArray: TypeAlias = 'npt.NDArray[np.float64]'
+
+ALL_FACES = (0, 1, 2, 3, 4, 5)
+
+
+_COMPONENT_TYPES: dict[int, tuple[type[np.generic], float]] = {
+    p3d.Texture.T_unsigned_byte: (np.uint8, 255.0),
+    p3d.Texture.T_unsigned_short: (np.uint16, 65535.0),
+    p3d.Texture.T_half_float: (np.float16, 1.0),
+    p3d.Texture.T_float: (np.float32, 1.0),
+}
+
+_SUPPORTED_FORMATS: set[int] = {
+    p3d.Texture.F_rgb,
+    p3d.Texture.F_rgb8,
+    p3d.Texture.F_rgb12,
+    p3d.Texture.F_rgb16,
+    p3d.Texture.F_rgb32,
+    p3d.Texture.F_rgba,
+    p3d.Texture.F_rgba8,
+    p3d.Texture.F_rgba12,
+    p3d.Texture.F_rgba16,
+    p3d.Texture.F_rgba32,
+}
+
+
+def supports_texture(texture: p3d.Texture) -> bool:
+    return (
+        texture.component_type in _COMPONENT_TYPES
+        and texture.format in _SUPPORTED_FORMATS
+        and texture.num_components in (3, 4)
+    )
+
+
+def cube_map_to_array(texture: p3d.Texture) -> FloatArray:
+    '''Return the RGB values of a cube map as a (face, y, x, rgb) array'''
+    if texture.ram_image_compression == p3d.Texture.CM_off:
+        image = texture.get_ram_image()
+    else:
+        image = texture.get_uncompressed_ram_image()
+    dtype, scale = _COMPONENT_TYPES[texture.component_type]
+
+    # View the RAM image in place, the only copy made is the conversion below
+    data = np.frombuffer(typing.cast(memoryview, memoryview(image)), dtype=dtype)
+    data = data.reshape(
+        texture.z_size,
+        texture.y_size,
+        texture.x_size,
+        texture.num_components,
+    )
+
+    # RAM images are stored as BGR(A)
+    colors = data[..., 2::-1].astype(np.float64)
+    if scale != 1.0:
+        colors /= scale
+    return colors
+
+
+def calc_vectors(dim: int) -> FloatArray:
+    '''Vectorized calc_vector() for every texel of every face as a (face, y, x, xyz) array'''
+    maxidx = dim - 1
+    coords = np.arange(dim, dtype=np.float64)
+    xcoord = np.broadcast_to(coords / maxidx * 2 - 1, (dim, dim))
+    ycoord = np.broadcast_to(((maxidx - coords) / maxidx * 2 - 1)[:, None], (dim, dim))
+    unitlength = np.full((dim, dim), 1.00001)
+
+    faces = [
+        (unitlength, ycoord, -xcoord),
+        (-unitlength, ycoord, xcoord),
+        (xcoord, unitlength, -ycoord),
+        (xcoord, -unitlength, ycoord),
+        (xcoord, ycoord, unitlength),
+        (-xcoord, ycoord, -unitlength),
+    ]
+
+    return np.stack([np.stack(face, axis=-1) for face in faces])
+
+
+def calc_solid_angles(dim: int) -> FloatArray:
+    '''Vectorized calc_solid_angle() for every texel of a face as a (y, x) array'''
+    invdim = 1.0 / dim
+    coords = (np.arange(dim, dtype=np.float64) + 0.5) * 2 * invdim - 1
+    s = coords[None, :]
+    t = coords[:, None]
+    x0 = s - invdim
+    y0 = t - invdim
+    x1 = s + invdim
+    y1 = t + invdim
+
+    x02 = x0 * x0
+    y02 = y0 * y0
+    x12 = x1 * x1
+    y12 = y1 * y1
+
+    return (
+        np.arctan2(x0 * y0, np.sqrt(x02 + y02 + 1))
+        - np.arctan2(x0 * y1, np.sqrt(x02 + y12 + 1))
+        - np.arctan2(x1 * y0, np.sqrt(x12 + y02 + 1))
+        + np.arctan2(x1 * y1, np.sqrt(x12 + y12 + 1))
+    )
+
+
+def get_sh_basis_from_vectors(vecs: FloatArray) -> FloatArray:
+    vecx = vecs[..., 0]
+    vecy = vecs[..., 1]
+    vecz = vecs[..., 2]
+    return np.stack([
+        np.full(vecx.shape, 0.282095),
+        0.488603 * vecx,
+        0.488603 * vecz,
+        0.488603 * vecy,
+        1.092548 * vecx * vecz,
+        1.092548 * vecy * vecz,
+        1.092548 * vecy * vecx,
+        (0.946176 * vecz * vecz - 0.315392),
+        0.546274 * (vecx * vecx - vecy * vecy),
+    ], axis=-1)
+
+
+def get_sh_sums_from_cube_map(
+    texcubemap: p3d.Texture,
+    faces: Sequence[int] = ALL_FACES,
+    stride: int = 1,
+) -> FloatArray:
+    '''Project a cube map onto the SH basis, returning a (9, rgb) array
+
+    The cosine lobe convolution is not applied to the result. A stride greater than one only
+    samples every stride-th texel in each direction for a faster, coarser projection.
+    '''
+    dim = texcubemap.x_size
+    faces = list(faces)
+    colors = cube_map_to_array(texcubemap)[faces, ::stride, ::stride]
+    basis = get_sh_basis_from_vectors(calc_vectors(dim)[faces, ::stride, ::stride])
+
+    # Use SA as a weight to better handle corners (box vs sphere)
+    solid_angles = calc_solid_angles(dim)[::stride, ::stride] * stride * stride
+    colors *= solid_angles[None, :, :, None]
+
+    return np.einsum('fyxb,fyxc->bc', basis, colors)
+
+
+def hammersley_points(num_samples: int) -> FloatArray:
+    indices = np.arange(num_samples, dtype=np.uint32)
+
+    # Van der Corput sequence via bit reversal
+    bits = indices.copy()
+    bits = ((bits << 16) | (bits >> 16)) & 0xFFFFFFFF
+    bits = ((bits & 0x55555555) << 1) | ((bits & 0xAAAAAAAA) >> 1)
+    bits = ((bits & 0x33333333) << 2) | ((bits & 0xCCCCCCCC) >> 2)
+    bits = ((bits & 0x0F0F0F0F) << 4) | ((bits & 0xF0F0F0F0) >> 4)
+    bits = ((bits & 0x00FF00FF) << 8) | ((bits & 0xFF00FF00) >> 8)
+    radical_inverse = bits.astype(np.float64) / 2.0**32
+
+    return np.stack([indices / num_samples, radical_inverse], axis=-1)
+
+
+def importance_sample_ggx(xi: FloatArray, roughness: float) -> FloatArray:
+    '''Return GGX half vectors in tangent space (normal is +Z)'''
+    alpha = roughness * roughness
+
+    phi = 2 * np.pi * xi[..., 0]
+    costheta = np.sqrt((1 - xi[..., 1]) / (1 + (alpha * alpha - 1) * xi[..., 1]))
+    sintheta = np.sqrt(1 - costheta * costheta)
+
+    return np.stack([
+        np.cos(phi) * sintheta,
+        np.sin(phi) * sintheta,
+        costheta,
+    ], axis=-1)
+
+
+def calc_prefilter_samples(roughness: float, num_samples: int) -> tuple[FloatArray, FloatArray]:
+    '''Return tangent space light directions and their NdotL weights
+
+    Since the prefilter assumes N = V, the reflected light directions only
+    depend on the roughness and can be shared by every texel of a mip level.
+    Samples that do not contribute (NdotL <= 0) are dropped.
+    '''
+    hvecs = importance_sample_ggx(hammersley_points(num_samples), roughness)
+    lvecs = hvecs * (2.0 * hvecs[:, 2:3])
+    lvecs[:, 2] -= 1.0
+    lvecs /= np.linalg.norm(lvecs, axis=-1, keepdims=True)
+
+    ndotl = lvecs[:, 2]
+    mask = ndotl > 0.0
+    return lvecs[mask], ndotl[mask]
+
+
+def calc_tangent_frames(normals: FloatArray) -> tuple[FloatArray, FloatArray]:
+    upvecs = np.zeros_like(normals)
+    use_z = np.abs(normals[..., 2]) < 0.999
+    upvecs[use_z, 2] = 1.0
+    upvecs[~use_z, 0] = 1.0
+
+    tangents = np.cross(upvecs, normals)
+    tangents /= np.linalg.norm(tangents, axis=-1, keepdims=True)
+    bitangents = np.cross(normals, tangents)
+    return tangents, bitangents
+
+
+def sample_cube_map(colors: FloatArray, vecs: FloatArray) -> FloatArray:
+    '''Bilinearly sample a (face, y, x, rgb) array with direction vectors'''
+    dim = colors.shape[1]
+    maxidx = dim - 1
+    vecx = vecs[..., 0]
+    vecy = vecs[..., 1]
+    vecz = vecs[..., 2]
+    absx = np.abs(vecx)
+    absy = np.abs(vecy)
+    absz = np.abs(vecz)
+
+    use_x = (absx >= absy) & (absx >= absz)
+    use_y = ~use_x & (absy >= absz)
+    use_z = ~use_x & ~use_y
+
+    faces = np.empty(vecx.shape, dtype=np.intp)
+    xcoord = np.empty(vecx.shape)
+    ycoord = np.empty(vecx.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        faces[use_x] = np.where(vecx[use_x] > 0, 0, 1)
+        xcoord[use_x] = -vecz[use_x] / vecx[use_x]
+        ycoord[use_x] = vecy[use_x] / absx[use_x]
+
+        faces[use_y] = np.where(vecy[use_y] > 0, 2, 3)
+        xcoord[use_y] = vecx[use_y] / absy[use_y]
+        ycoord[use_y] = -vecz[use_y] / vecy[use_y]
+
+        faces[use_z] = np.where(vecz[use_z] > 0, 4, 5)
+        xcoord[use_z] = vecx[use_z] / vecz[use_z]
+        ycoord[use_z] = vecy[use_z] / absz[use_z]
+
+    # Remap [-1, 1] to texel coordinates with texel centers at half-texel offsets,
+    # which matches TexturePeeker.lookup()
+    xloc = np.clip((xcoord + 1) * 0.5 * dim - 0.5, 0, maxidx)
+    yloc = np.clip((1 - ycoord) * 0.5 * dim - 0.5, 0, maxidx)
+
+    x0 = np.minimum(xloc.astype(np.intp), max(maxidx - 1, 0))
+    y0 = np.minimum(yloc.astype(np.intp), max(maxidx - 1, 0))
+    x1 = np.minimum(x0 + 1, maxidx)
+    y1 = np.minimum(y0 + 1, maxidx)
+    xfrac = (xloc - x0)[..., None]
+    yfrac = (yloc - y0)[..., None]
+
+    top = colors[faces, y0, x0] * (1 - xfrac) + colors[faces, y0, x1] * xfrac
+    bottom = colors[faces, y1, x0] * (1 - xfrac) + colors[faces, y1, x1] * xfrac
+    return top * (1 - yfrac) + bottom * yfrac
+
+
+def filter_mip_level(
+    colors: FloatArray,
+    mipsize: int,
+    roughness: float,
+    num_samples: int,
+    faces: Sequence[int] = ALL_FACES,
+    *,
+    max_chunk_size: int = 1 << 20,
+) -> FloatArray:
+    '''Prefilter faces of a mip level, returning a (face, y, x, rgb) array'''
+    lvecs, ndotl = calc_prefilter_samples(roughness, num_samples)
+    totweight = ndotl.sum()
+
+    faces = list(faces)
+    normals = calc_vectors(mipsize)[faces].reshape(-1, 3)
+    normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+    result = np.empty_like(normals)
+
+    # Process texels in chunks to keep the (texel, sample, xyz) arrays bounded
+    chunksize = max(max_chunk_size // max(len(ndotl), 1), 1)
+    for start in range(0, len(normals), chunksize):
+        chunk = normals[start:start + chunksize]
+        tangents, bitangents = calc_tangent_frames(chunk)
+        lightvecs = (
+            tangents[:, None, :] * lvecs[None, :, 0:1]
+            + bitangents[:, None, :] * lvecs[None, :, 1:2]
+            + chunk[:, None, :] * lvecs[None, :, 2:3]
+        )
+        samples = sample_cube_map(colors, lightvecs)
+        result[start:start + chunksize] = np.einsum('tsc,s->tc', samples, ndotl) / totweight
+
+    return result.reshape(len(faces), mipsize, mipsize, 3)
+
+
+def filter_mip_level_to_pta(
+    colors: FloatArray,
+    mipsize: int,
+    roughness: float,
+    num_samples: int,
+    faces: Sequence[int] = ALL_FACES,
+) -> p3d.PTA_uchar:
+    '''Prefilter faces of a mip level and pack them as F_rgb32 RAM image data'''
+    result = filter_mip_level(colors, mipsize, roughness, num_samples, faces)
+
+    texdata = p3d.PTA_uchar.empty_array(result.size * 4)
+    texarray = np.frombuffer(typing.cast(memoryview, memoryview(texdata)), dtype=np.float32)
+    # RAM images are stored as BGR
+    texarray[:] = result[..., ::-1].ravel()
+    return texdata
+
+
+def geometry_schlick_ggx(ndotv: FloatArray, roughness: FloatArray) -> FloatArray:
+    kibl = roughness * roughness / 2
+    return ndotv / (ndotv * (1 - kibl) + kibl)
+
+
+def integrate_brdf(ndotv: FloatArray, roughness: FloatArray, num_samples: int) -> FloatArray:
+    '''Vectorized integrate_brdf(), returning a (..., 2) array of (scale, bias)'''
+    ndotv = np.maximum(ndotv, 0.0001)[..., None]
+    roughness = np.asarray(roughness, dtype=np.float64)[..., None]
+    viewx = np.sqrt(1 - ndotv * ndotv)
+    viewz = ndotv
+
+    xi = hammersley_points(num_samples)
+    alpha = roughness * roughness
+    phi = 2 * np.pi * xi[:, 0]
+    costheta = np.sqrt((1 - xi[:, 1]) / (1 + (alpha * alpha - 1) * xi[:, 1]))
+    sintheta = np.sqrt(1 - costheta * costheta)
+
+    # Tangent frame used by importance_sample_ggx() for a normal of +Z
+    hvecx = np.sin(phi) * sintheta
+    hvecz = costheta
+
+    vdoth_signed = viewx * hvecx + viewz * hvecz
+    # Only the z component of the reflected light vector is needed (normal is +Z)
+    lightz = 2 * vdoth_signed * hvecz - viewz
+    ndotl = np.maximum(lightz, 0)
+
+    ndoth = np.maximum(hvecz, 0)
+    vdoth = np.maximum(vdoth_signed, 0)
+    geom = geometry_schlick_ggx(viewz, roughness) * geometry_schlick_ggx(ndotl, roughness)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        geom_vis = np.where(ndotl > 0, (geom * vdoth) / (ndoth * ndotv), 0.0)
+    fresnel = (1 - vdoth) ** 5
+
+    return np.stack([
+        ((1 - fresnel) * geom_vis).sum(axis=-1),
+        (fresnel * geom_vis).sum(axis=-1),
+    ], axis=-1) / num_samples
+
+
+def integrate_brdf_rows(lutsize: int, num_samples: int, rows: Sequence[int]) -> bytes:
+    ndotv = np.arange(lutsize, dtype=np.float64) / lutsize
+    result = np.empty((len(rows), lutsize, 2), dtype=np.float32)
+    for rowidx, ycoord in enumerate(rows):
+        result[rowidx] = integrate_brdf(ndotv, np.full(lutsize, ycoord / lutsize), num_samples)
+    return result.tobytes()
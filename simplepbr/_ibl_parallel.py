@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+from concurrent.futures import (
+    Executor,
+    Future,
+)
+from multiprocessing import shared_memory
+import typing
+from typing import (
+    Any,
+)
+from typing_extensions import (
+    Self,
+    TypeAlias,
+)
+
+import panda3d.core as p3d
+
+from . import _ibl_funcs_cpu as iblfuncs
+
+
+# (shared memory name, image size, cube map size, component type, format)
+SharedCubeMapDesc: TypeAlias = 'tuple[str, int, int, int, int]'
+
+
+class SharedCubeMap:
+    '''A copy of a cube map's RAM image in shared memory
+
+    Worker processes attach to the shared memory block by name instead of
+    receiving the image through pickling.
+    '''
+    def __init__(self, texture: p3d.Texture) -> None:
+        if texture.ram_image_compression == p3d.Texture.CM_off:
+            image = texture.get_ram_image()
+        else:
+            image = texture.get_uncompressed_ram_image()
+        data = typing.cast(memoryview, memoryview(image))
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        self._shm.buf[:data.nbytes] = data
+        self.desc: SharedCubeMapDesc = (
+            self._shm.name,
+            data.nbytes,
+            texture.x_size,
+            texture.component_type,
+            texture.format,
+        )
+
+    def close(self) -> None:
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+class _WorkerCubeMap:
+    def __init__(self, desc: SharedCubeMapDesc) -> None:
+        name, nbytes, size, component_type, texformat = desc
+
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            self.texture = p3d.Texture(name)
+            self.texture.setup_cube_map(size, component_type, texformat)
+            self.texture.set_ram_image(bytes(shm.buf[:nbytes]))
+        finally:
+            shm.close()
+        self._filter_source: Any = None
+
+    @property
+    def filter_source(self) -> Any:
+        if self._filter_source is None:
+            self._filter_source = iblfuncs.get_filter_source(self.texture)
+        return self._filter_source
+
+
+# Per-process cache so a worker only copies a cube map out of shared memory once
+_WORKER_CUBEMAPS: dict[str, _WorkerCubeMap] = {}
+
+
+def _attach(desc: SharedCubeMapDesc) -> _WorkerCubeMap:
+    name = desc[0]
+    if name not in _WORKER_CUBEMAPS:
+        _WORKER_CUBEMAPS.clear()
+        _WORKER_CUBEMAPS[name] = _WorkerCubeMap(desc)
+    return _WORKER_CUBEMAPS[name]
+
+
+def _sh_sums_job(desc: SharedCubeMapDesc, face: int) -> list[tuple[float, float, float]]:
+    cubemap = _attach(desc)
+    return [
+        (vec.x, vec.y, vec.z)
+        for vec in iblfuncs.get_sh_sums_from_cube_map(cubemap.texture, (face,))
+    ]
+
+
+def _filter_job(
+    desc: SharedCubeMapDesc,
+    mipsize: int,
+    roughness: float,
+    num_samples: int,
+    face: int,
+) -> bytes:
+    cubemap = _attach(desc)
+    texdata = iblfuncs.filter_faces(
+        cubemap.filter_source,
+        mipsize,
+        roughness,
+        num_samples,
+        (face,)
+    )
+    return bytes(typing.cast(memoryview, memoryview(texdata)))
+
+
+def get_sh_coeffs_from_cube_map(
+    texcubemap: p3d.Texture,
+    executor: Executor,
+) -> list[p3d.LVector3]:
+    iblfuncs.check_cube_map(texcubemap)
+
+    with SharedCubeMap(texcubemap) as shared:
+        jobs = [
+            executor.submit(_sh_sums_job, shared.desc, face)
+            for face in iblfuncs.ALL_FACES
+        ]
+        facesums = [job.result() for job in jobs]
+
+    shcoeffs = [p3d.LVector3(0, 0, 0) for _ in range(9)]
+    for sums in facesums:
+        for idx, value in enumerate(sums):
+            shcoeffs[idx] += p3d.LVector3(*value)
+
+    iblfuncs.apply_sh_cosine_lobe(shcoeffs)
+    return shcoeffs
+
+
+def filter_env_map(
+        envmap: p3d.Texture,
+        filtered: p3d.Texture,
+        executor: Executor,
+        *,
+        size: int = 16,
+        num_mipmaps: int = 4,
+        num_samples: int = 4
+    ) -> None:
+    mip_levels = iblfuncs.get_mip_levels(size, num_mipmaps)
+    iblfuncs.setup_filtered_env_map(filtered, size)
+
+    with SharedCubeMap(envmap) as shared:
+        jobs: dict[tuple[int, int], Future[bytes]] = {
+            (mip, face): executor.submit(
+                _filter_job,
+                shared.desc,
+                mipsize,
+                roughness,
+                num_samples,
+                face,
+            )
+            for mip, (mipsize, roughness) in enumerate(mip_levels)
+            for face in iblfuncs.ALL_FACES
+        }
+
+        for mip, (mipsize, _) in enumerate(mip_levels):
+            facesize = mipsize * mipsize * 3 * 4 # F_rgb32
+            texdata = p3d.PTA_uchar.empty_array(facesize * 6)
+            view = typing.cast(memoryview, memoryview(texdata))
+            for face in iblfuncs.ALL_FACES:
+                view[face * facesize:(face + 1) * facesize] = jobs[mip, face].result()
+            filtered.set_ram_mipmap_image(mip, texdata)
@@ -0,0 +1,300 @@
+'''Per-object light selection
+
+Panda3D binds the first max_lights lights applied to a node to p3d_LightSource, regardless of
+how much they actually contribute to it. LightSelector instead ranks the lights applied to each
+GeomNode by their influence on its bounds and applies a LightAttrib holding only the strongest
+ones. Rankings are cached and only recomputed when a node or the lights move or change.
+'''
+from __future__ import annotations
+
+import math
+from typing import (
+    Any,
+)
+from typing_extensions import (
+    TypeAlias,
+)
+
+import panda3d.core as p3d
+
+from . import _profiling as profiling
+from ._clustering import (
+    get_light_radius,
+    get_spot_cos_cutoff,
+)
+
+
+# (light, is directional, position, forward, radius, intensity, attenuation, spot cutoff)
+LightInfoType: TypeAlias = (
+    'tuple[p3d.NodePath[p3d.PandaNode], bool, p3d.LPoint3, p3d.LVector3, float, float, '
+    'tuple[float, float, float], float]'
+)
+ObjectKeyType: TypeAlias = 'tuple[tuple[float, float, float], float, p3d.LightAttrib]'
+# (bounds sequence, parent transform, parent LightAttrib, ranking key, applied LightAttrib,
+#  applied LightAttribs of the subtree, child entries)
+NodeEntryType: TypeAlias = (
+    'tuple[int, p3d.TransformState, p3d.LightAttrib, ObjectKeyType | None, '
+    'p3d.LightAttrib | None, tuple[tuple[p3d.PandaNode, p3d.LightAttrib], ...], '
+    'dict[p3d.PandaNode, Any]]'
+)
+
+
+def get_light_info(
+    lightnp: p3d.NodePath[p3d.PandaNode],
+    render_node: p3d.NodePath[p3d.PandaNode],
+) -> LightInfoType:
+    light = lightnp.node()
+    mat = lightnp.get_mat(render_node)
+    position = p3d.LPoint3(mat.get_row3(3))
+    forward = p3d.LVector3(mat.get_row3(1)).normalized()
+    color = light.color
+    intensity = max(color[0], color[1], color[2])
+
+    if isinstance(light, p3d.DirectionalLight):
+        return (lightnp, True, position, forward, math.inf, intensity, (1.0, 0.0, 0.0), -1.0)
+
+    cos_cutoff = get_spot_cos_cutoff(light) if isinstance(light, p3d.Spotlight) else -1.0
+    return (
+        lightnp,
+        False,
+        position,
+        forward,
+        get_light_radius(light),
+        intensity,
+        tuple(light.attenuation),
+        cos_cutoff,
+    )
+
+
+def get_influence(light: LightInfoType, center: p3d.LPoint3, radius: float) -> float:
+    '''Return the intensity of a light at the closest point of a bounding sphere, or 0 if the
+    sphere is out of the light's reach'''
+    _, is_directional, position, forward, light_radius, intensity, attenuation, cos_cutoff = light
+    if is_directional:
+        return intensity
+
+    to_center = center - position
+    center_dist = to_center.length()
+    dist = max(center_dist - radius, 0.0)
+    if dist > light_radius:
+        return 0.0
+
+    if cos_cutoff > -1.0 and center_dist > radius:
+        # Skip spheres that are entirely outside of a spotlight's cone
+        axis_dist = to_center.dot(forward)
+        perp_dist = math.sqrt(max(center_dist * center_dist - axis_dist * axis_dist, 0.0))
+        sin_cutoff = math.sqrt(max(1.0 - cos_cutoff * cos_cutoff, 0.0))
+        if perp_dist * cos_cutoff - axis_dist * sin_cutoff > radius:
+            return 0.0
+
+    const, linear, quadratic = attenuation
+    return intensity / max(const + linear * dist + quadratic * dist * dist, 1e-6)
+
+
+def get_node_bounding_sphere(
+    node: p3d.PandaNode,
+    parent_transform: p3d.TransformState,
+) -> tuple[p3d.LPoint3, float] | None:
+    '''Return the bounding sphere of a node given the transform of its parent'''
+    # Node bounds are in the coordinate space of the node's parent
+    bounds = node.get_bounds()
+    if bounds.is_empty():
+        return None
+    if bounds.is_infinite():
+        return p3d.LPoint3(0, 0, 0), math.inf
+
+    if not isinstance(bounds, p3d.BoundingSphere):
+        sphere = p3d.BoundingSphere()
+        sphere.extend_by(bounds)
+        bounds = sphere
+
+    scale = parent_transform.get_scale()
+    radius = bounds.get_radius() * max(abs(scale[0]), abs(scale[1]), abs(scale[2]))
+    return parent_transform.get_mat().xform_point(bounds.get_center()), radius
+
+
+class LightSelector:
+    '''Applies a LightAttrib with only the most influential lights to each GeomNode under a
+    render node
+
+    Each GeomNode is ranked against its net lights relative to the render node, so lights
+    turned on or off by its ancestors are respected, and GeomNodes with their own LightAttrib
+    are left alone. Panda3D bumps the bounds sequence of a node whenever its transform, state
+    or anything below it changes, so subtrees with an unchanged sequence are skipped until the
+    lights change.
+    '''
+    def __init__(self) -> None:
+        self._root: NodeEntryType | None = None
+        self._light_infos: dict[p3d.NodePath[p3d.PandaNode], LightInfoType | None] = {}
+        self._lights_key: Any = None
+        self._lights_changed = False
+        self._render_node: p3d.NodePath[p3d.PandaNode] | None = None
+        self._max_lights = 0
+        self._num_rankings = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'objects': len(self._root[5]) if self._root is not None else 0,
+            'rankings': self._num_rankings,
+        }
+
+    def select_lights(
+        self,
+        lights: list[LightInfoType],
+        center: p3d.LPoint3,
+        radius: float,
+        max_lights: int,
+    ) -> list[p3d.NodePath[p3d.PandaNode]]:
+        '''Return the max_lights most influential lights for a bounding sphere'''
+        self._num_rankings += 1
+        ranked = []
+        for idx, light in enumerate(lights):
+            influence = get_influence(light, center, radius)
+            if influence > 0.0:
+                # Directional lights are not attenuated and always rank first
+                ranked.append((not light[1], -influence, idx))
+        ranked.sort()
+        return [lights[idx][0] for _, _, idx in ranked[:max_lights]]
+
+    def _get_light_info(self, lightnp: p3d.NodePath[p3d.PandaNode]) -> LightInfoType | None:
+        if lightnp not in self._light_infos:
+            assert self._render_node is not None
+            self._light_infos[lightnp] = (
+                None
+                if isinstance(lightnp.node(), p3d.AmbientLight)
+                else get_light_info(lightnp, self._render_node)
+            )
+        return self._light_infos[lightnp]
+
+    def _make_attrib(
+        self,
+        net_attrib: p3d.LightAttrib,
+        center: p3d.LPoint3,
+        radius: float,
+    ) -> p3d.LightAttrib:
+        ambient_lights = []
+        lights = []
+        for lightnp in net_attrib.get_on_lights():
+            info = self._get_light_info(lightnp)
+            if info is None:
+                ambient_lights.append(lightnp)
+            else:
+                lights.append(info)
+
+        selected = self.select_lights(lights, center, radius, self._max_lights)
+        attrib = p3d.LightAttrib.make_all_off()
+        for lightnp in ambient_lights + selected:
+            attrib = attrib.add_on_light(lightnp)
+        return attrib
+
+    def _visit(
+        self,
+        node: p3d.PandaNode,
+        parent_transform: p3d.TransformState,
+        parent_attrib: p3d.LightAttrib,
+        prev: NodeEntryType | None,
+        is_root: bool,
+    ) -> NodeEntryType:
+        seq = p3d.UpdateSeq()
+        thread = p3d.Thread.get_current_thread()
+        node.get_bounds(seq, thread)
+        if (
+            prev is not None
+            and not self._lights_changed
+            and prev[0] == seq.get_seq()
+            and prev[1] == parent_transform
+            and prev[2] == parent_attrib
+        ):
+            return prev
+
+        own_attrib = node.get_attrib(p3d.LightAttrib)
+        prev_applied = prev[4] if prev is not None else None
+        # Only LightAttribs set by the application, not the ones applied here, affect the net lights
+        is_custom = own_attrib is not None and own_attrib != prev_applied
+        net_attrib = parent_attrib.compose(own_attrib) if is_custom else parent_attrib
+
+        key = None
+        applied = None
+        if not is_root and not is_custom and node.is_geom_node():
+            sphere = get_node_bounding_sphere(node, parent_transform)
+            if sphere is not None:
+                center, radius = sphere
+                key = (tuple(center), radius, net_attrib)
+                if (
+                    prev is not None
+                    and not self._lights_changed
+                    and prev[3] == key
+                    and own_attrib is not None
+                ):
+                    applied = prev_applied
+                else:
+                    applied = self._make_attrib(net_attrib, center, radius)
+                    node.set_attrib(applied)
+            elif own_attrib is not None:
+                node.clear_attrib(p3d.LightAttrib)
+
+        # The render node's own transform does not move anything in its space
+        transform = (
+            p3d.TransformState.make_identity()
+            if is_root
+            else parent_transform.compose(node.get_transform())
+        )
+        prev_children = prev[6] if prev is not None else {}
+        children = {}
+        applied_nodes = [(node, applied)] if applied is not None else []
+        for child in node.get_children():
+            entry = self._visit(child, transform, net_attrib, prev_children.get(child), False)
+            children[child] = entry
+            applied_nodes.extend(entry[5])
+
+        # Applying LightAttribs above bumped the sequence of this node
+        node.get_bounds(seq, thread)
+        return (
+            seq.get_seq(),
+            parent_transform,
+            parent_attrib,
+            key,
+            applied,
+            tuple(applied_nodes),
+            children,
+        )
+
+    @profiling.profiled('select_lights')
+    def update(self, render_node: p3d.NodePath[p3d.PandaNode], max_lights: int) -> None:
+        if render_node != self._render_node:
+            self.clear()
+        self._render_node = render_node
+        self._max_lights = max_lights
+
+        attrib = render_node.get_attrib(p3d.LightAttrib)
+        lightnps = list(self._light_infos)
+        if attrib is not None:
+            lightnps.extend(attrib.get_on_lights())
+        self._light_infos = {}
+        for lightnp in lightnps:
+            self._get_light_info(lightnp)
+        lights_key = (max_lights, {
+            lightnp: (light[0], tuple(light[2]), tuple(light[3]), *light[4:])
+            if light is not None else None
+            for lightnp, light in self._light_infos.items()
+        })
+        self._lights_changed = lights_key != self._lights_key
+        self._lights_key = lights_key
+
+        self._root = self._visit(
+            render_node.node(),
+            p3d.TransformState.make_identity(),
+            p3d.LightAttrib.make(),
+            self._root,
+            True,
+        )
+
+    def clear(self) -> None:
+        '''Remove the LightAttribs applied by update()'''
+        if self._root is not None:
+            for node, node_attrib in self._root[5]:
+                if node.get_attrib(p3d.LightAttrib) == node_attrib:
+                    node.clear_attrib(p3d.LightAttrib)
+        self._root = None
+        self._light_infos = {}
+        self._lights_key = None
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from collections.abc import (
+    Callable,
+    Iterator,
+)
+import contextlib
+import functools
+import time
+from typing import (
+    Any,
+    TypeVar,
+)
+
+import panda3d.core as p3d
+
+
+PROFILE_TIMINGS = p3d.ConfigVariableBool(
+    'simplepbr-profile',
+    False,
+    'Record call counts and timings for Pipeline.stats() even when PStats is not connected',
+)
+
+FuncT = TypeVar('FuncT', bound=Callable[..., Any])
+
+_collectors: dict[str, p3d.PStatCollector] = {}
+_counts: dict[str, int] = {}
+_times: dict[str, float] = {}
+
+
+def get_collector(name: str) -> p3d.PStatCollector:
+    collector = _collectors.get(name)
+    if collector is None:
+        collector = p3d.PStatCollector(f'simplepbr:{name}')
+        _collectors[name] = collector
+    return collector
+
+
+def is_enabled() -> bool:
+    return p3d.PStatClient.is_connected() or PROFILE_TIMINGS.value
+
+
+@contextlib.contextmanager
+def collect(name: str) -> Iterator[None]:
+    '''Count and time a section of code with a PStatCollector when PStats is connected or
+    simplepbr-profile is set'''
+    if not is_enabled():
+        yield
+        return
+
+    _counts[name] = _counts.get(name, 0) + 1
+    collector = get_collector(name)
+    collector.start()
+    starttime = time.perf_counter()
+    try:
+        yield
+    finally:
+        collector.stop()
+        _times[name] = _times.get(name, 0.0) + time.perf_counter() - starttime
+
+
+def profiled(name: str) -> Callable[[FuncT], FuncT]:
+    '''Decorator version of collect() that calls the function directly when profiling is off'''
+    def decorator(func: FuncT) -> FuncT:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with collect(name):
+                return func(*args, **kwargs)
+        return wrapper # type: ignore[return-value]
+    return decorator
+
+
+def snapshot() -> dict[str, dict[str, float]]:
+    '''Return the call count and total time in seconds recorded for each collector'''
+    return {
+        name: {
+            'count': count,
+            'time': _times.get(name, 0.0),
+        }
+        for name, count in _counts.items()
+    }
+
+
+def reset() -> None:
+    _counts.clear()
+    _times.clear()
@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+from importlib import metadata
 import os
 
+import typing
 from typing import (
     Any,
 )
@@ -11,6 +15,9 @@ from typing_extensions import (
 
 import panda3d.core as p3d
 
+from . import logging
+from . import _profiling as profiling
+
 
 try:
     from .shaders import shaders # type: ignore
@@ -19,6 +26,23 @@ except ImportError:
 
 
 ShaderDefinesType: TypeAlias = 'dict[str, Any]'
+ShaderKeyType: TypeAlias = 'tuple[str, str, str, tuple[tuple[str, Any], ...]]'
+
+SHADER_DISK_CACHE = p3d.ConfigVariableBool(
+    'simplepbr-shader-disk-cache',
+    False,
+    'Store preprocessed shader sources under model-cache-dir',
+)
+
+SHADER_CACHE_DIR_NAME = 'simplepbr-shaders'
+
+# Process-wide cache of shader variants, sharing Shader objects also lets Panda3D reuse
+# shaders already prepared on the GSG
+_shader_cache: dict[ShaderKeyType, p3d.Shader] = {}
+_shader_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+}
 
 
 def _add_shader_defines(shaderstr: str, defines: ShaderDefinesType) -> str:
@@ -46,16 +70,18 @@ def _add_shader_defines(shaderstr: str, defines: ShaderDefinesType) -> str:
     )
 
 
-def _load_shader_str(shaderpath: str, defines: ShaderDefinesType | None = None) -> str:
-    shaderstr = ''
-
+def _read_shader_source(shaderpath: str) -> str:
     if shaders:
-        shaderstr = shaders[shaderpath]
-    else:
-        shader_dir = os.path.join(os.path.dirname(__file__), 'shaders')
+        return typing.cast(str, shaders[shaderpath])
+
+    shader_dir = os.path.join(os.path.dirname(__file__), 'shaders')
+
+    with open(os.path.join(shader_dir, shaderpath), encoding='utf8') as shaderfile:
+        return shaderfile.read()
 
-        with open(os.path.join(shader_dir, shaderpath), encoding='utf8') as shaderfile:
-            shaderstr = shaderfile.read()
+
+def _load_shader_str(shaderpath: str, defines: ShaderDefinesType | None = None) -> str:
+    shaderstr = _read_shader_source(shaderpath)
 
     if defines is None:
         defines = {}
@@ -87,13 +113,143 @@ def _load_shader_str(shaderpath: str, defines: ShaderDefinesType | None = None)
     return shaderstr
 
 
-def make_shader(name: str, vertex: str, fragment: str, defines: ShaderDefinesType) -> p3d.Shader:
-    vertstr = _load_shader_str(vertex, defines)
-    fragstr = _load_shader_str(fragment, defines)
+@functools.cache
+def get_package_version() -> str:
+    try:
+        return metadata.version('panda3d-simplepbr')
+    except metadata.PackageNotFoundError:
+        return 'dev'
+
+
+def get_driver_string(gsg: p3d.GraphicsStateGuardian | None) -> str:
+    '''Return a string identifying the graphics driver used by a GSG'''
+    if gsg is None:
+        return ''
+    return f'{gsg.driver_vendor}|{gsg.driver_renderer}|{gsg.driver_version}'
+
+
+def get_shader_cache_dir() -> p3d.Filename | None:
+    '''Return the versioned directory used for the on-disk shader cache, or None if
+    model-cache-dir is not set'''
+    model_cache_dir = p3d.ConfigVariableFilename('model-cache-dir').value
+    if model_cache_dir.empty():
+        return None
+    return model_cache_dir / SHADER_CACHE_DIR_NAME / get_package_version()
+
+
+def _prune_shader_cache_dirs(cache_dir: p3d.Filename) -> None:
+    # Remove the cache files written by other versions of simplepbr, the parent directory only
+    # holds the versioned directories of this cache
+    parent = p3d.Filename(cache_dir.get_dirname())
+    current = cache_dir.get_basename()
+    vfs = p3d.VirtualFileSystem.get_global_ptr()
+    for vfile in vfs.scan_directory(parent) or []:
+        if vfile.get_filename().get_basename() == current or not vfile.is_directory():
+            continue
+        entries = vfile.scan_directory() or []
+        for entry in entries:
+            if entry.get_filename().get_extension() == 'glsl':
+                vfs.delete_file(entry.get_filename())
+        if all(entry.get_filename().get_extension() == 'glsl' for entry in entries):
+            vfs.delete_file(vfile.get_filename())
+
+
+_pruned_cache_dirs: set[str] = set()
+_source_digests: dict[str, str] = {}
+
+
+def load_cached_shader_str(
+    shaderpath: str,
+    defines: ShaderDefinesType | None = None,
+    driver: str = '',
+) -> str:
+    '''Return the preprocessed source of a shader, using the on-disk cache when enabled'''
+    cache_dir = get_shader_cache_dir() if SHADER_DISK_CACHE.value else None
+    if cache_dir is None:
+        return _load_shader_str(shaderpath, dict(defines or {}))
+
+    if shaderpath not in _source_digests:
+        source = _read_shader_source(shaderpath)
+        _source_digests[shaderpath] = hashlib.sha256(source.encode('utf8')).hexdigest()
+    keysrc = '\n'.join([
+        _source_digests[shaderpath],
+        repr(sorted((defines or {}).items())),
+        driver,
+    ])
+    key = hashlib.sha256(keysrc.encode('utf8')).hexdigest()
+    cache_path = cache_dir / f'{key}.glsl'
+    ospath = cache_path.to_os_specific()
+
+    try:
+        with open(ospath, encoding='utf8') as cachefile:
+            return cachefile.read()
+    except OSError:
+        pass
+
+    shaderstr = _load_shader_str(shaderpath, dict(defines or {}))
+
+    try:
+        if cache_dir.get_fullpath() not in _pruned_cache_dirs:
+            _pruned_cache_dirs.add(cache_dir.get_fullpath())
+            _prune_shader_cache_dirs(cache_dir)
+        cache_path.make_dir()
+        tmp_path = f'{ospath}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as cachefile:
+            cachefile.write(shaderstr)
+        os.replace(tmp_path, ospath)
+    except OSError as exc:
+        logging.warning(f'Failed to write shader cache file {cache_path}: {exc}')
+
+    return shaderstr
+
+
+def _make_shader_key(
+    name: str,
+    vertex: str,
+    fragment: str,
+    defines: ShaderDefinesType,
+) -> ShaderKeyType:
+    return (name, vertex, fragment, tuple(sorted(defines.items())))
+
+
+@profiling.profiled('make_shader')
+def make_shader(
+    name: str,
+    vertex: str,
+    fragment: str,
+    defines: ShaderDefinesType,
+    *,
+    driver: str = '',
+) -> p3d.Shader:
+    key = _make_shader_key(name, vertex, fragment, defines)
+    shader = _shader_cache.get(key)
+    if shader is not None:
+        _shader_cache_stats['hits'] += 1
+        return shader
+
+    _shader_cache_stats['misses'] += 1
+    vertstr = load_cached_shader_str(vertex, defines, driver)
+    fragstr = load_cached_shader_str(fragment, defines, driver)
     shader = p3d.Shader.make(
         p3d.Shader.SL_GLSL,
         vertstr,
         fragstr
     )
     shader.set_filename(p3d.Shader.ST_none, name)
+    _shader_cache[key] = shader
     return shader
+
+
+def get_shader_cache_stats() -> dict[str, int]:
+    '''Return hit, miss, and entry counts for the shader variant cache'''
+    return {
+        **_shader_cache_stats,
+        'entries': len(_shader_cache),
+    }
+
+
+def clear_shader_cache() -> None:
+    '''Drop all cached shader variants and reset the cache statistics'''
+    _shader_cache.clear()
+    for stat in _shader_cache_stats:
+        _shader_cache_stats[stat] = 0
@@ -0,0 +1,953 @@
+'''Shadow rendering managed by the Pipeline
+
+CascadedShadowMap splits the view frustum of the main camera into depth ranges (cascades) and
+renders a shadow map for each one from a DirectionalLight into tiles of a single depth texture.
+Cascades are fit to bounding spheres of the frustum slices and snapped to shadow map texels, so
+a cascade only moves once the camera has moved by at least a texel. Cascades past the first
+dynamic_cascades are only re-rendered when they move.
+
+ShadowAtlas renders the shadow maps of regular shadow casters into tiles of a single depth
+texture instead of a buffer per light. Tile sizes follow how large each light's bounds appear
+from the camera, and a tile is only re-rendered when its light, its tile, or the casters in its
+bounds change. Only tiles whose size changed are re-allocated, other tiles keep their place and
+contents. PointLight tiles hold the six faces of a cube shadow map, and point lights with
+small tiles are re-rendered at a reduced rate.
+
+ShadowUpdateScheduler applies the Pipeline's shadow update policy to the shadow buffers Panda3D
+creates for regular shadow casters by toggling their display regions and buffers.
+
+Both detect changed casters with CasterSpheres, which caches the bounding spheres of the
+GeomNodes under the render node and only revisits subtrees whose bounds have changed.
+'''
+from __future__ import annotations
+
+import collections
+import itertools
+import math
+from typing import (
+    Any,
+    Final,
+)
+from typing_extensions import (
+    Literal,
+    TypeAlias,
+)
+
+import panda3d.core as p3d
+
+from . import _profiling as profiling
+from ._clustering import get_light_radius
+from ._lightselection import get_node_bounding_sphere
+
+
+MAX_CASCADES: Final = 4
+MIN_TILE_FRACTION: Final = 32
+
+# Octaves a light's ideal tile size has to move past its current size before the tile is resized
+TILE_SIZE_HYSTERESIS: Final = 0.25
+
+# Number of versions of changed caster spheres kept for lights that skip updates
+MAX_SPHERE_CHANGES: Final = 16
+
+# (forward, up) of the cameras rendering each face of a PointLight's shadow map
+POINT_LIGHT_FACES: Final = (
+    ((1, 0, 0), (0, 0, 1)),
+    ((-1, 0, 0), (0, 0, 1)),
+    ((0, 1, 0), (0, 0, 1)),
+    ((0, -1, 0), (0, 0, 1)),
+    ((0, 0, 1), (0, 1, 0)),
+    ((0, 0, -1), (0, 1, 0)),
+)
+
+UpdatePolicyType: TypeAlias = Literal['always', 'on_change', 'interval']
+CasterRegionType: TypeAlias = 'tuple[p3d.DisplayRegion, p3d.NodePath[p3d.LightLensNode]]'
+LightNodeType: TypeAlias = 'p3d.NodePath[p3d.LightLensNode]'
+TileType: TypeAlias = 'tuple[int, int, int]'
+SphereType: TypeAlias = 'tuple[tuple[float, float, float], float]'
+# (bounds sequence, parent transform, own sphere, spheres of the subtree, child entries)
+SphereEntryType: TypeAlias = (
+    'tuple[int, p3d.TransformState, SphereType | None, tuple[SphereType, ...], '
+    'dict[p3d.PandaNode, Any]]'
+)
+
+
+def get_cascade_splits(
+    near: float,
+    far: float,
+    num_cascades: int,
+    split_lambda: float,
+) -> list[float]:
+    '''Return the num_cascades + 1 view distances that bound the cascades
+
+    split_lambda blends between uniform (0.0) and logarithmic (1.0) split distances.
+    '''
+    splits = []
+    for idx in range(num_cascades + 1):
+        fraction = idx / num_cascades
+        log_split = near * (far / near) ** fraction
+        uniform_split = near + (far - near) * fraction
+        splits.append(split_lambda * log_split + (1.0 - split_lambda) * uniform_split)
+    return splits
+
+
+def get_slice_bounds(near: float, far: float, tan_sq: float) -> tuple[float, float]:
+    '''Return the view distance of the center and the radius of the smallest sphere bounding a
+    slice of a view frustum, tan_sq is the squared length of the (tan(hfov/2), tan(vfov/2))
+    vector'''
+    center = (near + far) * (1.0 + tan_sq) * 0.5
+    if center > far:
+        return far, far * math.sqrt(tan_sq)
+    return center, math.sqrt((far - center) ** 2 + far * far * tan_sq)
+
+
+def make_shadow_texture(name: str) -> p3d.Texture:
+    texture = p3d.Texture(name)
+    texture.minfilter = p3d.SamplerState.FT_shadow
+    texture.magfilter = p3d.SamplerState.FT_shadow
+    # Anything outside of a shadow map is lit
+    texture.wrap_u = p3d.SamplerState.WM_border_color
+    texture.wrap_v = p3d.SamplerState.WM_border_color
+    texture.border_color = p3d.LColor(1, 1, 1, 1)
+    return texture
+
+
+def make_shadow_buffer(
+    window: p3d.GraphicsOutput,
+    name: str,
+    width: int,
+    height: int,
+    texture: p3d.Texture,
+) -> p3d.GraphicsOutput:
+    '''Create a depth-only buffer that renders into texture, display regions of the buffer are
+    responsible for clearing their part of it'''
+    fbprops = p3d.FrameBufferProperties()
+    fbprops.set_depth_bits(24)
+    buffer = window.engine.make_output(
+        window.pipe,
+        name,
+        -10,
+        fbprops,
+        p3d.WindowProperties.size(width, height),
+        p3d.GraphicsPipe.BF_refuse_window,
+        window.gsg,
+        window,
+    )
+    if buffer is None:
+        raise RuntimeError(f'Failed to create shadow buffer {name}')
+
+    buffer.add_render_texture(
+        texture,
+        p3d.GraphicsOutput.RTM_bind_or_copy,
+        p3d.GraphicsOutput.RTP_depth,
+    )
+    buffer.disable_clears()
+    # Keep the default display region from clearing the whole texture
+    buffer.get_overlay_display_region().disable_clears()
+    return buffer
+
+
+class CascadedShadowMap:
+    '''Cascaded shadow maps for a DirectionalLight'''
+    def __init__(
+        self,
+        light: p3d.NodePath[p3d.DirectionalLight],
+        render_node: p3d.NodePath[p3d.PandaNode],
+        window: p3d.GraphicsOutput,
+        shadow_state: p3d.RenderState,
+        *,
+        num_cascades: int = 4,
+        size: int = 1024,
+        max_distance: float = 100.0,
+        split_lambda: float = 0.75,
+        dynamic_cascades: int = 2,
+        caster_spheres: CasterSpheres | None = None,
+    ) -> None:
+        if not isinstance(light.node(), p3d.DirectionalLight):
+            raise ValueError('Cascaded shadow maps require a DirectionalLight')
+        if not 1 <= num_cascades <= MAX_CASCADES:
+            raise ValueError(f'num_cascades must be between 1 and {MAX_CASCADES}')
+
+        self.light = light
+        self.render_node = render_node
+        self.num_cascades = num_cascades
+        self.size = size
+        self.max_distance = max_distance
+        self.split_lambda = split_lambda
+        self.dynamic_cascades = dynamic_cascades
+        self.caster_spheres = caster_spheres if caster_spheres is not None else CasterSpheres()
+
+        self.atlas = make_shadow_texture('csm_atlas')
+        self.buffer = make_shadow_buffer(
+            window,
+            'simplepbr cascaded shadows',
+            size * num_cascades,
+            size,
+            self.atlas,
+        )
+
+        self.cameras: list[p3d.NodePath[p3d.Camera]] = []
+        self.display_regions: list[p3d.DisplayRegion] = []
+        for idx in range(num_cascades):
+            camera = p3d.Camera(f'csm_cascade{idx}', p3d.OrthographicLens())
+            camera.set_initial_state(shadow_state)
+            cameranp = render_node.attach_new_node(camera)
+            self.cameras.append(cameranp)
+
+            dispregion = self.buffer.make_display_region(
+                idx / num_cascades,
+                (idx + 1) / num_cascades,
+                0,
+                1,
+            )
+            dispregion.disable_clears()
+            dispregion.set_clear_depth_active(True)
+            dispregion.set_clear_depth(1.0)
+            dispregion.set_camera(cameranp)
+            self.display_regions.append(dispregion)
+
+        self.matrices = p3d.PTA_LMatrix4f([p3d.LMatrix4.ident_mat()] * MAX_CASCADES)
+        self._num_renders = [0] * num_cascades
+        self._keys: list[tuple[tuple[float, ...], int] | None] = [None] * num_cascades
+        self._from_gl_view = p3d.LMatrix4.convert_mat(p3d.CS_yup_right, p3d.CS_default)
+        self._to_gl_view = p3d.LMatrix4.convert_mat(p3d.CS_default, p3d.CS_yup_right)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'cascades': self.num_cascades,
+            'renders': list(self._num_renders),
+        }
+
+    def invalidate(self) -> None:
+        '''Re-render every cascade on the next update, e.g., after the shadow state has changed'''
+        self._keys = [None] * self.num_cascades
+
+    def set_active(self, active: bool) -> None:
+        self.buffer.set_active(active)
+
+    def set_shadow_state(self, shadow_state: p3d.RenderState) -> None:
+        for cameranp in self.cameras:
+            cameranp.node().set_initial_state(shadow_state)
+
+    def apply(self, render_node: p3d.NodePath[p3d.PandaNode]) -> None:
+        render_node.set_shader_input('csm_atlas', self.atlas)
+        render_node.set_shader_input('csm_matrices', self.matrices)
+        render_node.set_shader_input('csm_splits', p3d.LVecBase4(0))
+        render_node.set_shader_input('csm_light_direction', p3d.LVecBase3(0))
+
+    def destroy(self) -> None:
+        self.buffer.engine.remove_window(self.buffer)
+        for camera in self.cameras:
+            camera.remove_node()
+        self.cameras = []
+        self.display_regions = []
+
+    def _place_cascade(
+        self,
+        idx: int,
+        center: p3d.LPoint3,
+        radius: float,
+        light_quat: p3d.LQuaternion,
+    ) -> None:
+        forward = light_quat.get_forward()
+        camera = self.cameras[idx]
+        camera.set_pos_quat(self.render_node, center - forward * radius * 2.0, light_quat)
+        lens = camera.node().get_lens()
+        lens.set_film_size(radius * 2.0, radius * 2.0)
+        # Include casters up to a radius beyond the slice bounds
+        lens.set_near_far(0.0, radius * 4.0)
+
+    @profiling.profiled('update_cascades')
+    def update(self, camera_node: p3d.NodePath[p3d.Camera]) -> None:
+        render_node = self.render_node
+        lens = camera_node.node().get_lens()
+        fov = lens.get_fov()
+        tan_sq = (
+            math.tan(math.radians(fov[0] * 0.5)) ** 2
+            + math.tan(math.radians(fov[1] * 0.5)) ** 2
+        )
+        near = lens.near
+        far = min(lens.far, self.max_distance)
+        splits = get_cascade_splits(near, far, self.num_cascades, self.split_lambda)
+
+        camera_mat = camera_node.get_mat(render_node)
+        light_quat = self.light.get_quat(render_node)
+        to_light = p3d.LQuaternion(light_quat)
+        to_light.invert_in_place()
+
+        if self.dynamic_cascades < self.num_cascades:
+            self.caster_spheres.update(render_node)
+        version = self.caster_spheres.version
+
+        any_active = False
+        for idx in range(self.num_cascades):
+            center_dist, radius = get_slice_bounds(splits[idx], splits[idx + 1], tan_sq)
+            center = camera_mat.xform_point(p3d.LPoint3(0, center_dist, 0))
+
+            # Snap to texels (and coarser steps along the light direction) in light space so
+            # that shadow edges do not shimmer and still cascades can be detected
+            texel = radius * 2.0 / self.size
+            light_space = to_light.xform(center)
+            snapped = p3d.LPoint3(
+                math.floor(light_space.x / texel) * texel,
+                math.floor(light_space.y / (radius * 0.5)) * (radius * 0.5),
+                math.floor(light_space.z / texel) * texel,
+            )
+            key = (*snapped, radius, *light_quat)
+
+            # Still cascades are also re-rendered when casters within them have changed
+            prev = self._keys[idx]
+            if idx < self.dynamic_cascades or prev is None or prev[0] != key:
+                active = True
+            else:
+                cascade = self.cameras[idx]
+                bounds = cascade.node().get_lens().make_bounds()
+                bounds.xform(cascade.get_mat(render_node))
+                active = self.caster_spheres.changed_in_bounds(prev[1], bounds)
+                if not active:
+                    self._keys[idx] = (key, version)
+            if active:
+                self._place_cascade(idx, light_quat.xform(snapped), radius, light_quat)
+                self._keys[idx] = (key, version)
+                self._num_renders[idx] += 1
+                any_active = True
+            self.display_regions[idx].set_active(active)
+
+            cascade = self.cameras[idx]
+            tile = (
+                p3d.LMatrix4.scale_mat(0.5)
+                * p3d.LMatrix4.translate_mat(0.5)
+                * p3d.LMatrix4.scale_mat(1.0 / self.num_cascades, 1.0, 1.0)
+                * p3d.LMatrix4.translate_mat(idx / self.num_cascades, 0.0, 0.0)
+            )
+            self.matrices[idx] = (
+                self._from_gl_view
+                * camera_node.get_mat(cascade)
+                * cascade.node().get_lens().get_projection_mat()
+                * tile
+            )
+
+        self.buffer.set_active(any_active)
+
+        light_dir = self._to_gl_view.xform_vec(-self.light.get_quat(camera_node).get_forward())
+        light_dir.normalize()
+        render_node.set_shader_input('csm_matrices', self.matrices)
+        render_node.set_shader_input('csm_splits', p3d.LVecBase4(*(splits[1:] + [0.0] * 4)[:4]))
+        render_node.set_shader_input('csm_light_direction', light_dir)
+
+
+def _reserve_tile(free: list[TileType], tile: TileType) -> None:
+    # Split the free square holding an aligned tile until the tile itself can be removed
+    x, y, size = tile
+    container = next(
+        i for i in free
+        if i[0] <= x < i[0] + i[2] and i[1] <= y < i[1] + i[2] and i[2] >= size
+    )
+    free.remove(container)
+    cx, cy, csize = container
+    while csize > size:
+        csize //= 2
+        for qx, qy in ((cx, cy), (cx + csize, cy), (cx, cy + csize), (cx + csize, cy + csize)):
+            if qx <= x < qx + csize and qy <= y < qy + csize:
+                nextx, nexty = qx, qy
+            else:
+                free.append((qx, qy, csize))
+        cx, cy = nextx, nexty
+
+
+def allocate_tiles(
+    sizes: list[int],
+    atlas_size: int,
+    reserved: list[TileType] | None = None,
+) -> list[TileType | None]:
+    '''Pack power-of-two square tiles into a square atlas around already reserved tiles
+
+    Returns an (x, y, size) tile for each requested size, or None for tiles that do not fit.
+    '''
+    free: list[TileType] = [(0, 0, atlas_size)]
+    for tile in sorted(reserved or [], key=lambda tile: -tile[2]):
+        _reserve_tile(free, tile)
+    tiles: list[TileType | None] = [None] * len(sizes)
+    # Placing large tiles first keeps the free squares aligned to every smaller size, so a tile
+    # only fails to fit once the atlas is full
+    for idx in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        size = sizes[idx]
+        candidates = [tile for tile in free if tile[2] >= size]
+        if not candidates:
+            continue
+
+        tile = min(candidates, key=lambda tile: (tile[2], tile[1], tile[0]))
+        free.remove(tile)
+        x, y, tile_size = tile
+        while tile_size > size:
+            tile_size //= 2
+            free.extend([
+                (x + tile_size, y, tile_size),
+                (x, y + tile_size, tile_size),
+                (x + tile_size, y + tile_size, tile_size),
+            ])
+        tiles[idx] = (x, y, size)
+    return tiles
+
+
+def get_matrix_key(mat: p3d.LMatrix4) -> tuple[float, ...]:
+    return tuple(value for row in mat for value in row)
+
+
+def get_point_light_range(light: p3d.PointLight) -> tuple[float, float]:
+    '''Return the near and far distances of a PointLight's shadow map'''
+    lens = light.get_lens(0)
+    return lens.near, min(lens.far, get_light_radius(light))
+
+
+def get_light_bounds(
+    lightnp: p3d.NodePath[p3d.LightLensNode],
+    render_node: p3d.NodePath[p3d.PandaNode],
+) -> p3d.GeometricBoundingVolume:
+    '''Return the volume covered by a light's shadow map in render_node's space'''
+    light = lightnp.node()
+    if isinstance(light, p3d.PointLight):
+        _, far = get_point_light_range(light)
+        return p3d.BoundingSphere(lightnp.get_pos(render_node), far)
+
+    bounds = light.get_lens().make_bounds()
+    bounds.xform(lightnp.get_mat(render_node))
+    return bounds
+
+
+class CasterSpheres:
+    '''Bounding spheres of the GeomNodes under a render node in its space
+
+    Panda3D bumps the bounds sequence of a node whenever its transform or anything below it
+    changes, so spheres are cached per subtree and only subtrees with a new bounds sequence or
+    a moved parent are revisited. Updating an unchanged scene only checks the render node. The
+    spheres that were added or removed by recent updates are kept so that lights only need to
+    test those against their bounds.
+    '''
+    def __init__(self) -> None:
+        self.spheres: tuple[SphereType, ...] = ()
+        self.version = 0
+        self._root: SphereEntryType | None = None
+        self._changed: list[SphereType] = []
+        self._changes: collections.deque[tuple[int, tuple[SphereType, ...]]] = (
+            collections.deque(maxlen=MAX_SPHERE_CHANGES)
+        )
+        self._num_visits = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'spheres': len(self.spheres),
+            'visits': self._num_visits,
+        }
+
+    def _visit(
+        self,
+        node: p3d.PandaNode,
+        parent_transform: p3d.TransformState,
+        prev: SphereEntryType | None,
+        is_root: bool,
+    ) -> SphereEntryType:
+        seq = p3d.UpdateSeq()
+        node.get_bounds(seq, p3d.Thread.get_current_thread())
+        seqnum = seq.get_seq()
+        if prev is not None and prev[0] == seqnum and prev[1] == parent_transform:
+            return prev
+
+        self._num_visits += 1
+        own_sphere = None
+        if not is_root and node.is_geom_node():
+            sphere = get_node_bounding_sphere(node, parent_transform)
+            if sphere is not None:
+                own_sphere = (tuple(sphere[0]), sphere[1])
+        prev_sphere = prev[2] if prev is not None else None
+        if own_sphere != prev_sphere:
+            self._changed.extend(i for i in (prev_sphere, own_sphere) if i is not None)
+        spheres = [own_sphere] if own_sphere is not None else []
+
+        # The render node's own transform does not move anything in its space
+        transform = (
+            p3d.TransformState.make_identity()
+            if is_root
+            else parent_transform.compose(node.get_transform())
+        )
+        prev_children = prev[4] if prev is not None else {}
+        children = {}
+        for child in node.get_children():
+            entry = self._visit(child, transform, prev_children.get(child), False)
+            children[child] = entry
+            spheres.extend(entry[3])
+        for child, entry in prev_children.items():
+            if child not in children:
+                self._changed.extend(entry[3])
+        return (seqnum, parent_transform, own_sphere, tuple(spheres), children)
+
+    @profiling.profiled('caster_spheres')
+    def update(self, render_node: p3d.NodePath[p3d.PandaNode]) -> tuple[SphereType, ...]:
+        '''Return the current spheres, version is incremented whenever they change'''
+        self._changed = []
+        self._root = self._visit(
+            render_node.node(),
+            p3d.TransformState.make_identity(),
+            self._root,
+            True,
+        )
+        self.spheres = self._root[3]
+        if self._changed:
+            self.version += 1
+            self._changes.append((self.version, tuple(self._changed)))
+        return self.spheres
+
+    def get_changes_since(self, version: int) -> tuple[SphereType, ...] | None:
+        '''Return the old and new spheres of everything that changed after version, or None
+        if those changes are no longer known'''
+        changes = [changed for i, changed in self._changes if i > version]
+        if len(changes) != self.version - version:
+            return None
+        return tuple(itertools.chain.from_iterable(changes))
+
+    def changed_in_bounds(self, version: int, bounds: p3d.GeometricBoundingVolume) -> bool:
+        '''Return whether any spheres changed within bounds after version'''
+        changes = self.get_changes_since(version)
+        return changes is None or has_sphere_in_bounds(bounds, changes)
+
+
+def has_sphere_in_bounds(
+    bounds: p3d.GeometricBoundingVolume,
+    spheres: tuple[SphereType, ...],
+) -> bool:
+    outer = p3d.BoundingSphere()
+    outer.extend_by(bounds)
+    if outer.is_empty():
+        return False
+    (outer_x, outer_y, outer_z), outer_radius = outer.get_center(), outer.get_radius()
+
+    for (x, y, z), radius in spheres:
+        if math.isinf(radius):
+            return True
+        # Cheaply reject spheres that are nowhere near the bounds before the exact test
+        reach = outer_radius + radius
+        dist_sq = (x - outer_x) ** 2 + (y - outer_y) ** 2 + (z - outer_z) ** 2
+        if dist_sq > reach * reach:
+            continue
+        if bounds.contains(p3d.BoundingSphere(p3d.LPoint3(x, y, z), radius)):
+            return True
+    return False
+
+
+def get_cube_face(direction: p3d.LVecBase3) -> tuple[int, float, float, float]:
+    '''Return the PointLight shadow map face that a direction from the light falls on, along
+    with the direction's [0, 1] coordinates on that face and its distance along the face's axis
+
+    This matches the face selection in simplepbr.frag.
+    '''
+    absdir = [abs(i) for i in direction]
+    if absdir[0] >= absdir[1] and absdir[0] >= absdir[2]:
+        face = 0 if direction[0] > 0 else 1
+    elif absdir[1] >= absdir[2]:
+        face = 2 if direction[1] > 0 else 3
+    else:
+        face = 4 if direction[2] > 0 else 5
+
+    forward = p3d.LVector3(*POINT_LIGHT_FACES[face][0])
+    up = p3d.LVector3(*POINT_LIGHT_FACES[face][1])
+    right = forward.cross(up)
+    dist = direction.dot(forward)
+    return (
+        face,
+        direction.dot(right) / dist * 0.5 + 0.5,
+        direction.dot(up) / dist * 0.5 + 0.5,
+        dist,
+    )
+
+
+def get_face_rect(tile: TileType, face: int) -> tuple[float, float, float, float]:
+    '''Return the (x, y, width, height) of a PointLight face in the light's tile, faces are
+    laid out in three columns and two rows'''
+    x, y, size = tile
+    width = size / 3
+    height = size / 2
+    return x + (face % 3) * width, y + (face // 3) * height, width, height
+
+
+class ShadowAtlas:
+    '''Renders the shadow maps of shadow casting lights into tiles of one depth texture'''
+    def __init__(
+        self,
+        render_node: p3d.NodePath[p3d.PandaNode],
+        window: p3d.GraphicsOutput,
+        shadow_state: p3d.RenderState,
+        *,
+        size: int = 4096,
+        max_lights: int = 8,
+        caster_spheres: CasterSpheres | None = None,
+    ) -> None:
+        self.render_node = render_node
+        self.size = size
+        self.max_lights = max_lights
+        self.shadow_state = shadow_state
+        self.caster_spheres = caster_spheres if caster_spheres is not None else CasterSpheres()
+
+        self.texture = make_shadow_texture('shadow_atlas')
+        self.buffer = make_shadow_buffer(
+            window,
+            'simplepbr shadow atlas',
+            size,
+            size,
+            self.texture,
+        )
+
+        self.light_positions = p3d.PTA_LVecBase4f([p3d.LVecBase4(0)] * max_lights)
+        self.rects = p3d.PTA_LVecBase4f([p3d.LVecBase4(0)] * max_lights)
+        self.params = p3d.PTA_LVecBase4f([p3d.LVecBase4(0)] * max_lights)
+        self.origins = p3d.PTA_LVecBase4f([p3d.LVecBase4(0)] * max_lights)
+        self.tiles: dict[LightNodeType, TileType] = {}
+        self._display_regions: dict[LightNodeType, list[p3d.DisplayRegion]] = {}
+        self._face_cameras: dict[LightNodeType, list[p3d.NodePath[p3d.Camera]]] = {}
+        self._keys: dict[LightNodeType, Any] = {}
+        self._last_render: dict[LightNodeType, int] = {}
+        self._layout_key: Any = None
+        self._frame = 0
+        self._num_renders = 0
+        self._to_gl_view = p3d.LMatrix4.convert_mat(p3d.CS_default, p3d.CS_yup_right)
+        self._from_gl_view = p3d.LMatrix4.convert_mat(p3d.CS_yup_right, p3d.CS_default)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'lights': len(self.tiles),
+            'renders': self._num_renders,
+        }
+
+    def set_active(self, active: bool) -> None:
+        self.buffer.set_active(active)
+
+    def set_shadow_state(self, shadow_state: p3d.RenderState) -> None:
+        '''Use shadow_state for cameras created by the atlas and lights added to it later'''
+        self.shadow_state = shadow_state
+        for cameras in self._face_cameras.values():
+            for cameranp in cameras:
+                cameranp.node().set_initial_state(shadow_state)
+
+    def apply(self, render_node: p3d.NodePath[p3d.PandaNode]) -> None:
+        render_node.set_shader_input('shadow_atlas', self.texture)
+        render_node.set_shader_input('shadow_atlas_lights', self.light_positions)
+        render_node.set_shader_input('shadow_atlas_rects', self.rects)
+        render_node.set_shader_input('shadow_atlas_params', self.params)
+        render_node.set_shader_input('shadow_atlas_origins', self.origins)
+        render_node.set_shader_input('shadow_atlas_view_to_world', p3d.LMatrix4.ident_mat())
+
+    def _remove_light(self, lightnp: LightNodeType) -> None:
+        for dispregion in self._display_regions.pop(lightnp, []):
+            self.buffer.remove_display_region(dispregion)
+        for camera in self._face_cameras.pop(lightnp, []):
+            camera.remove_node()
+        self._keys.pop(lightnp, None)
+        self._last_render.pop(lightnp, None)
+        self.tiles.pop(lightnp, None)
+
+    def _clear_layout(self) -> None:
+        for lightnp in list(self.tiles):
+            self._remove_light(lightnp)
+
+    def destroy(self) -> None:
+        self._clear_layout()
+        self.buffer.engine.remove_window(self.buffer)
+        self._layout_key = None
+
+    def get_casters(self) -> list[LightNodeType]:
+        attrib = self.render_node.get_attrib(p3d.LightAttrib)
+        if attrib is None:
+            return []
+        return [
+            lightnp
+            for lightnp in attrib.get_on_lights()
+            if isinstance(lightnp.node(), (p3d.DirectionalLight, p3d.Spotlight, p3d.PointLight))
+            and lightnp.node().is_shadow_caster()
+        ]
+
+    def get_tile_size(
+        self,
+        lightnp: LightNodeType,
+        camera_node: p3d.NodePath[p3d.Camera],
+        current_size: int | None = None,
+    ) -> int:
+        '''Pick a tile size from how large a light's bounds appear from the camera
+
+        A light keeps current_size until its ideal size is TILE_SIZE_HYSTERESIS octaves past it,
+        so lights near a size boundary do not flip between sizes every frame.
+        '''
+        max_size = self.size // 2
+        if isinstance(lightnp.node(), p3d.DirectionalLight):
+            return max_size
+
+        sphere = p3d.BoundingSphere()
+        sphere.extend_by(get_light_bounds(lightnp, self.render_node))
+        dist = (sphere.get_center() - camera_node.get_pos(self.render_node)).length()
+        importance = min(sphere.get_radius() / max(dist, 1e-6), 1.0)
+        level = math.log2(max(max_size * importance, 1.0))
+        if current_size is not None:
+            current_level = math.log2(current_size)
+            low = current_level - TILE_SIZE_HYSTERESIS
+            high = current_level + 1 + TILE_SIZE_HYSTERESIS
+            if low <= level < high:
+                return current_size
+        return max(2 ** math.floor(level), self.size // MIN_TILE_FRACTION)
+
+    def _make_display_region(
+        self,
+        rect: tuple[float, float, float, float],
+        camera: p3d.NodePath[p3d.Camera],
+    ) -> p3d.DisplayRegion:
+        x, y, width, height = rect
+        dispregion = self.buffer.make_display_region(
+            x / self.size,
+            (x + width) / self.size,
+            y / self.size,
+            (y + height) / self.size,
+        )
+        dispregion.disable_clears()
+        dispregion.set_clear_depth_active(True)
+        dispregion.set_clear_depth(1.0)
+        dispregion.set_camera(camera)
+        return dispregion
+
+    def _add_light(self, lightnp: LightNodeType, tile: TileType) -> None:
+        light = lightnp.node()
+        if isinstance(light, p3d.PointLight):
+            # Render each face with a camera that stays aligned to render_node's axes
+            cameras = []
+            dispregions = []
+            for face in range(len(POINT_LIGHT_FACES)):
+                lens = p3d.PerspectiveLens()
+                lens.set_fov(90, 90)
+                camera = p3d.Camera(f'{light.name}_shadow_face{face}', lens)
+                camera.set_initial_state(self.shadow_state)
+                cameranp = self.render_node.attach_new_node(camera)
+                cameras.append(cameranp)
+                dispregions.append(
+                    self._make_display_region(get_face_rect(tile, face), cameranp)
+                )
+            self._face_cameras[lightnp] = cameras
+            self._display_regions[lightnp] = dispregions
+        else:
+            state = light.get_initial_state()
+            if not state.has_attrib(p3d.ShaderAttrib):
+                state = state.compose(self.shadow_state)
+                state = state.remove_attrib(p3d.CullFaceAttrib)
+                light.set_initial_state(state)
+            x, y, tile_size = tile
+            self._display_regions[lightnp] = [
+                self._make_display_region((x, y, tile_size, tile_size), lightnp)
+            ]
+        self.tiles[lightnp] = tile
+
+    def _layout(self, casters: list[LightNodeType], sizes: list[int]) -> None:
+        # Lights that keep their tile size also keep their tile and its rendered shadow map
+        wanted = dict(zip(casters, sizes))
+        for lightnp, tile in list(self.tiles.items()):
+            if wanted.get(lightnp) != tile[2]:
+                self._remove_light(lightnp)
+
+        added = [(lightnp, size) for lightnp, size in wanted.items() if lightnp not in self.tiles]
+        tiles = allocate_tiles(
+            [size for _, size in added],
+            self.size,
+            list(self.tiles.values()),
+        )
+        if None in tiles and allocate_tiles(sizes, self.size).count(None) < tiles.count(None):
+            # The kept tiles fragment the atlas too much, lay every tile out again
+            self._clear_layout()
+            added = list(wanted.items())
+            tiles = allocate_tiles(sizes, self.size)
+
+        for (lightnp, _), tile in zip(added, tiles):
+            if tile is not None:
+                self._add_light(lightnp, tile)
+
+    def _place_face_cameras(self, lightnp: p3d.NodePath[p3d.PointLight]) -> None:
+        near, far = get_point_light_range(lightnp.node())
+        position = lightnp.get_pos(self.render_node)
+        for camera, (forward, up) in zip(self._face_cameras[lightnp], POINT_LIGHT_FACES):
+            camera.set_pos(position)
+            camera.look_at(position + p3d.LVector3(*forward), p3d.LVector3(*up))
+            camera.node().get_lens().set_near_far(near, far)
+
+    def get_update_interval(self, lightnp: LightNodeType) -> int:
+        '''Return the minimum number of frames between re-renders of a light's shadow map
+
+        Point lights render six faces, so ones with smaller (more distant) tiles are refreshed
+        less often.
+        '''
+        if not isinstance(lightnp.node(), p3d.PointLight):
+            return 1
+        return max((self.size // 2) // self.tiles[lightnp][2], 1)
+
+    @profiling.profiled('update_shadow_atlas')
+    def update(self, camera_node: p3d.NodePath[p3d.Camera]) -> None:
+        self._frame += 1
+        casters = self.get_casters()
+        sizes = [
+            self.get_tile_size(
+                lightnp,
+                camera_node,
+                self.tiles[lightnp][2] if lightnp in self.tiles else None,
+            )
+            for lightnp in casters
+        ]
+        # Keep the most important lights if there are more casters than shader slots
+        ranked = sorted(range(len(casters)), key=lambda i: -sizes[i])[:self.max_lights]
+        casters = [casters[i] for i in ranked]
+        sizes = [sizes[i] for i in ranked]
+
+        layout_key = tuple(zip(casters, sizes))
+        if layout_key != self._layout_key:
+            self._layout_key = layout_key
+            self._layout(casters, sizes)
+
+        if self.tiles:
+            self.caster_spheres.update(self.render_node)
+        version = self.caster_spheres.version
+        for idx in range(self.max_lights):
+            self.light_positions[idx] = p3d.LVecBase4(0)
+            self.rects[idx] = p3d.LVecBase4(0)
+            self.params[idx] = p3d.LVecBase4(0)
+            self.origins[idx] = p3d.LVecBase4(0)
+        render_to_view = self.render_node.get_mat(camera_node) * self._to_gl_view
+
+        any_active = False
+        for idx, (lightnp, tile) in enumerate(self.tiles.items()):
+            light = lightnp.node()
+            is_point = isinstance(light, p3d.PointLight)
+            if is_point:
+                key = (tuple(lightnp.get_pos(self.render_node)), get_point_light_range(light))
+            else:
+                key = (
+                    get_matrix_key(lightnp.get_mat(self.render_node)),
+                    get_matrix_key(light.get_lens().get_projection_mat()),
+                )
+
+            # Only re-render a tile when its light or the casters it can see have changed
+            prev = self._keys.get(lightnp)
+            if prev is None or prev[0] != key:
+                dirty = True
+            else:
+                bounds = get_light_bounds(lightnp, self.render_node)
+                dirty = self.caster_spheres.changed_in_bounds(prev[1], bounds)
+                if not dirty:
+                    self._keys[lightnp] = (key, version)
+            active = dirty and (
+                prev is None
+                or self._frame - self._last_render[lightnp] >= self.get_update_interval(lightnp)
+            )
+            if active:
+                if is_point:
+                    self._place_face_cameras(lightnp)
+                self._keys[lightnp] = (key, version)
+                self._last_render[lightnp] = self._frame
+                self._num_renders += 1
+                any_active = True
+            for dispregion in self._display_regions[lightnp]:
+                dispregion.set_active(active)
+
+            view_mat = lightnp.get_mat(camera_node) * self._to_gl_view
+            if isinstance(light, p3d.DirectionalLight):
+                direction = view_mat.xform_vec(-p3d.LVector3.forward())
+                direction.normalize()
+                self.light_positions[idx] = p3d.LVecBase4(direction, 0)
+            else:
+                self.light_positions[idx] = p3d.LVecBase4(view_mat.xform_point((0, 0, 0)), 1)
+
+            if is_point:
+                # Faces are sampled from where they were rendered, which lags behind the light
+                # while its updates are rate limited
+                position, (near, far) = self._keys[lightnp][0]
+                self.params[idx] = p3d.LVecBase4(near, far, 1, 0)
+                origin = render_to_view.xform_point(p3d.LPoint3(*position))
+                self.origins[idx] = p3d.LVecBase4(origin, 1)
+
+            x, y, tile_size = tile
+            self.rects[idx] = p3d.LVecBase4(
+                x / self.size,
+                y / self.size,
+                tile_size / self.size,
+                tile_size / self.size,
+            )
+
+        self.buffer.set_active(any_active)
+        self.render_node.set_shader_input(
+            'shadow_atlas_view_to_world',
+            self._from_gl_view * camera_node.get_mat(self.render_node),
+        )
+
+
+class ShadowUpdateScheduler:
+    '''Decides which shadow caster display regions to render each frame'''
+    def __init__(self, caster_spheres: CasterSpheres | None = None) -> None:
+        self.caster_spheres = caster_spheres if caster_spheres is not None else CasterSpheres()
+        self._keys: dict[p3d.DisplayRegion, Any] = {}
+        self._last_render: dict[p3d.DisplayRegion, int] = {}
+        self._frame = 0
+        self._num_renders = 0
+        self._num_skipped = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'renders': self._num_renders,
+            'skipped': self._num_skipped,
+        }
+
+    def _has_changed(
+        self,
+        dispregion: p3d.DisplayRegion,
+        lightnp: p3d.NodePath[p3d.LightLensNode],
+        render_node: p3d.NodePath[p3d.PandaNode],
+    ) -> bool:
+        lens = lightnp.node().get_lens(max(dispregion.get_lens_index(), 0))
+        light_mat = lightnp.get_mat(render_node)
+        light_key = (get_matrix_key(light_mat), get_matrix_key(lens.get_projection_mat()))
+        prev = self._keys.get(dispregion)
+        if prev is None or prev[0] != light_key:
+            changed = True
+        else:
+            bounds = lens.make_bounds()
+            bounds.xform(light_mat)
+            changed = self.caster_spheres.changed_in_bounds(prev[1], bounds)
+        self._keys[dispregion] = (light_key, self.caster_spheres.version)
+        return changed
+
+    @profiling.profiled('schedule_shadow_updates')
+    def update(
+        self,
+        regions: list[CasterRegionType],
+        render_node: p3d.NodePath[p3d.PandaNode],
+        policy: UpdatePolicyType,
+        interval: int,
+    ) -> None:
+        self._frame += 1
+        if policy == 'on_change' and regions:
+            self.caster_spheres.update(render_node)
+
+        windows: dict[p3d.GraphicsOutput, bool] = {}
+        for dispregion, lightnp in regions:
+            if policy == 'on_change':
+                active = self._has_changed(dispregion, lightnp, render_node)
+            elif policy == 'interval':
+                last_render = self._last_render.get(dispregion)
+                active = last_render is None or self._frame - last_render >= interval
+            else:
+                active = True
+
+            if active:
+                self._last_render[dispregion] = self._frame
+                self._num_renders += 1
+            else:
+                self._num_skipped += 1
+            dispregion.set_active(active)
+            window = dispregion.get_window()
+            windows[window] = windows.get(window, False) or active
+
+        # Inactive buffers keep the contents of their shadow maps instead of clearing them
+        for window, active in windows.items():
+            window.set_active(active)
+
+        live = {dispregion for dispregion, _ in regions}
+        self._keys = {i: key for i, key in self._keys.items() if i in live}
+        self._last_render = {i: frame for i, frame in self._last_render.items() if i in live}
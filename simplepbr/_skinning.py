@@ -0,0 +1,213 @@
+'''Skinning with a joint matrix palette texture
+
+Panda3D's hardware skinning uploads each vertex data's transform table to the p3d_TransformTable
+uniform array on every draw, which limits rigs to 100 joints. SkinningPalette instead converts
+the vertex data of Character nodes to reference joints by their index in a float texture, packs
+the skinning matrices of every joint (as the three columns of a 3x4 matrix) into that texture
+once per frame, and leaves the vertex shaders to fetch and blend them.
+'''
+from __future__ import annotations
+
+import array
+from typing import (
+    Final,
+)
+from typing_extensions import (
+    TypeAlias,
+)
+
+import panda3d.core as p3d
+
+from . import _profiling as profiling
+from ._clustering import (
+    _make_data_texture,
+    _resize_data_texture,
+)
+
+
+# Joints per row of the palette texture, the shader gets it via the PALETTE_JOINTS_PER_ROW define
+JOINTS_PER_ROW: Final = 256
+
+# Number of RGBA texels used for each joint in the palette texture
+TEXELS_PER_JOINT: Final = 3
+
+# Vertices are blended from at most this many joints
+MAX_INFLUENCES: Final = 4
+
+# (character, joint transforms, original vertex data of each converted geom)
+PaletteEntryType: TypeAlias = (
+    'tuple[p3d.NodePath[p3d.Character], list[p3d.VertexTransform], '
+    'list[tuple[p3d.Geom, p3d.GeomVertexData]]]'
+)
+
+
+def _get_palette_array_format() -> p3d.GeomVertexArrayFormat:
+    array_format = p3d.GeomVertexArrayFormat()
+    array_format.add_column(
+        p3d.InternalName.make('palette_index'),
+        MAX_INFLUENCES,
+        p3d.Geom.NT_float32,
+        p3d.Geom.C_other,
+    )
+    array_format.add_column(
+        p3d.InternalName.make('palette_weight'),
+        MAX_INFLUENCES,
+        p3d.Geom.NT_float32,
+        p3d.Geom.C_other,
+    )
+    return p3d.GeomVertexArrayFormat.register_format(array_format)
+
+
+def get_blend_influences(
+    blend: p3d.TransformBlend,
+) -> list[tuple[p3d.VertexTransform, float]]:
+    '''Return the MAX_INFLUENCES most heavily weighted transforms of a blend with their weights
+    normalized'''
+    influences = sorted(
+        (
+            (blend.get_transform(idx), blend.get_weight(idx))
+            for idx in range(blend.get_num_transforms())
+        ),
+        key=lambda influence: -influence[1],
+    )[:MAX_INFLUENCES]
+    total = sum(weight for _, weight in influences)
+    if total <= 0.0:
+        return []
+    return [(transform, weight / total) for transform, weight in influences]
+
+
+def convert_vertex_data(
+    vdata: p3d.GeomVertexData,
+    transforms: list[p3d.VertexTransform],
+) -> p3d.GeomVertexData | None:
+    '''Return a copy of animated vertex data that indexes into transforms (which new joints are
+    appended to) instead of using Panda3D's animation, or None if vdata is not animated by a
+    TransformBlendTable'''
+    blend_table = vdata.get_transform_blend_table()
+    if blend_table is None or not vdata.has_column('transform_blend'):
+        return None
+
+    slots = {transform: idx for idx, transform in enumerate(transforms)}
+    blend_values = []
+    for blend_idx in range(blend_table.get_num_blends()):
+        indices = [0.0] * MAX_INFLUENCES
+        weights = [0.0] * MAX_INFLUENCES
+        for idx, (transform, weight) in enumerate(
+            get_blend_influences(blend_table.get_blend(blend_idx))
+        ):
+            if transform not in slots:
+                slots[transform] = len(transforms)
+                transforms.append(transform)
+            indices[idx] = float(slots[transform])
+            weights[idx] = weight
+        blend_values.append(indices + weights)
+
+    values = array.array('f')
+    reader = p3d.GeomVertexReader(vdata, 'transform_blend')
+    while not reader.is_at_end():
+        values.extend(blend_values[reader.get_data1i()])
+
+    vformat = p3d.GeomVertexFormat(vdata.format)
+    vformat.remove_column(p3d.InternalName.make('transform_blend'))
+    vformat.set_animation(p3d.GeomVertexAnimationSpec())
+    vformat.add_array(_get_palette_array_format())
+    vformat.remove_empty_arrays()
+    registered = p3d.GeomVertexFormat.register_format(vformat)
+    array_index = registered.get_array_with(p3d.InternalName.make('palette_index'))
+
+    converted = p3d.GeomVertexData(vdata.convert_to(registered))
+    converted.clear_transform_blend_table()
+    palette_data = converted.modify_array(array_index)
+    palette_data.modify_handle().copy_data_from(values)
+    return converted
+
+
+class SkinningPalette:
+    '''Packs the joint matrices of every Character under a render node into one texture for
+    the palette skinning variant of the PBR and shadow shaders'''
+    def __init__(self) -> None:
+        self.texture = _make_data_texture(
+            'skinning_palette',
+            JOINTS_PER_ROW * TEXELS_PER_JOINT,
+            1,
+            p3d.Texture.F_rgba32,
+        )
+        self._entries: dict[p3d.Character, PaletteEntryType] = {}
+        self._num_uploads = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'characters': len(self._entries),
+            'joints': sum(len(entry[1]) for entry in self._entries.values()),
+            'uploads': self._num_uploads,
+        }
+
+    def _add_character(self, charnp: p3d.NodePath[p3d.Character]) -> PaletteEntryType:
+        transforms: list[p3d.VertexTransform] = []
+        originals = []
+        for geomnp in charnp.find_all_matches('**/+GeomNode'):
+            geomnode = geomnp.node()
+            for idx in range(geomnode.get_num_geoms()):
+                geom = geomnode.modify_geom(idx)
+                vdata = geom.get_vertex_data()
+                converted = convert_vertex_data(vdata, transforms)
+                if converted is not None:
+                    geom.set_vertex_data(converted)
+                    originals.append((geom, vdata))
+
+        charnp.set_shader_input('palette_skinning_enabled', 1.0)
+        return (charnp, transforms, originals)
+
+    @profiling.profiled('skinning_palette')
+    def update(self, render_node: p3d.NodePath[p3d.PandaNode]) -> None:
+        entries = {}
+        for charnp in render_node.find_all_matches('**/+Character'):
+            character = charnp.node()
+            entry = self._entries.pop(character, None)
+            if entry is None:
+                entry = self._add_character(charnp)
+            entries[character] = entry
+
+        # Characters that left the scene get their original vertex data back and are converted
+        # again if they return
+        for entry in self._entries.values():
+            self._restore_character(entry)
+        self._entries = entries
+
+        values = array.array('f')
+        mat = p3d.LMatrix4()
+        for character, (charnp, transforms, _) in entries.items():
+            # Joints are otherwise only updated when the character is culled, after this task
+            character.update()
+            charnp.set_shader_input('palette_offset', float(len(values) // 12))
+            for transform in transforms:
+                transform.get_matrix(mat)
+                values.extend(mat.get_col(0))
+                values.extend(mat.get_col(1))
+                values.extend(mat.get_col(2))
+
+        num_joints = len(values) // 12
+        rows = max(-(-num_joints // JOINTS_PER_ROW), 1)
+        values.extend([0.0] * (rows * JOINTS_PER_ROW - num_joints) * 12)
+        _resize_data_texture(self.texture, JOINTS_PER_ROW * TEXELS_PER_JOINT, rows)
+        self.texture.set_ram_image_as(values.tobytes(), 'RGBA')
+        self._num_uploads += 1
+
+    def apply(self, render_node: p3d.NodePath[p3d.PandaNode]) -> None:
+        '''Bind the palette texture to a render node'''
+        render_node.set_shader_input('skinning_palette', self.texture)
+        render_node.set_shader_input('palette_skinning_enabled', 0.0)
+        render_node.set_shader_input('palette_offset', 0.0)
+
+    def _restore_character(self, entry: PaletteEntryType) -> None:
+        charnp, _, originals = entry
+        for geom, vdata in originals:
+            geom.set_vertex_data(vdata)
+        charnp.clear_shader_input('palette_skinning_enabled')
+        charnp.clear_shader_input('palette_offset')
+
+    def clear(self) -> None:
+        '''Restore the original vertex data of converted characters'''
+        for entry in self._entries.values():
+            self._restore_character(entry)
+        self._entries = {}
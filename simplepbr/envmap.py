@@ -1,22 +1,138 @@
 from __future__ import annotations
 
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
 from pathlib import Path
+import struct
 import time
 import typing
 from typing_extensions import (
     Self,
+    TypeAlias,
 )
 
 import panda3d.core as p3d
 from direct.stdpy import threading
 
 from . import logging
+from . import _profiling as profiling
+from . import _envfile as envfile
 from . import _ibl_funcs_cpu as iblfuncs
+from . import _ibl_parallel as iblparallel
 
 
 DEFAULT_PREFILTERED_SIZE=64
 DEFAULT_PREFILTERED_SAMPLES=16
 
+# Bump these when the prefilter output or the .env layout changes to invalidate disk caches
+IBL_ALGORITHM_VERSION = 1
+ENV_FILE_VERSION = envfile.VERSION
+
+ENVMAP_WORKERS = p3d.ConfigVariableInt(
+    'simplepbr-envmap-workers',
+    0,
+    'Number of worker processes to use when preparing an EnvMap, '
+    'use 0 to prepare in threads of the current process',
+)
+
+ENVMAP_PROGRESSIVE = p3d.ConfigVariableBool(
+    'simplepbr-envmap-progressive',
+    False,
+    'Publish coarse results while preparing an EnvMap and refine them in the background',
+)
+
+RefineCallbackType: TypeAlias = 'Callable[[EnvMap, int, int], None]'
+
+
+def _create_filtered_env_map() -> p3d.Texture:
+    filtered_env_map = p3d.Texture('filtered_env_map')
+    filtered_env_map.setup_cube_map(1, p3d.Texture.T_float, p3d.Texture.F_rgba16)
+    filtered_env_map.set_clear_color(p3d.LColor(0, 0, 0, 0))
+    filtered_env_map.wrap_u = p3d.SamplerState.WM_clamp
+    filtered_env_map.wrap_v = p3d.SamplerState.WM_clamp
+    filtered_env_map.wrap_w = p3d.SamplerState.WM_clamp
+    filtered_env_map.minfilter = p3d.SamplerState.FT_linear
+    filtered_env_map.magfilter = p3d.SamplerState.FT_linear_mipmap_linear
+    return filtered_env_map
+
+
+def get_progressive_stages(
+    source_size: int,
+    prefiltered_size: int,
+    prefiltered_samples: int,
+) -> list[tuple[int, int, int]]:
+    '''Return the (prefiltered size, sample count, SH stride) used for each refinement stage'''
+    stages = []
+    for divisor in (4, 2):
+        stage = (
+            # Mip chains smaller than 16 would end with a 1x1 level
+            min(prefiltered_size, max(16, prefiltered_size // divisor)),
+            max(1, prefiltered_samples // divisor),
+            max(1, source_size * divisor // 256),
+        )
+        if not stages or stages[-1] != stage:
+            stages.append(stage)
+
+    final = (prefiltered_size, prefiltered_samples, 1)
+    if stages[-1][:2] == final[:2]:
+        stages.pop()
+    stages.append(final)
+    return stages
+
+
+def _to_filename(path: p3d.Filename | Path | str) -> p3d.Filename:
+    if isinstance(path, str):
+        return p3d.Filename.from_os_specific(path)
+
+    if not isinstance(path, p3d.Filename):
+        path = p3d.Filename(path)
+
+    return path
+
+
+def is_env_file_v2(path: p3d.Filename) -> bool:
+    vfs = p3d.VirtualFileSystem.get_global_ptr()
+    stream = vfs.open_read_file(path, False)
+    if stream is None:
+        return False
+    try:
+        header = p3d.StreamReader(stream, False).extract_bytes(len(envfile.MAGIC))
+    finally:
+        vfs.close_read_file(stream)
+    return envfile.is_env_file(header)
+
+
+def get_source_files(path: p3d.Filename) -> list[p3d.Filename]:
+    '''Return the files making up a cube map, expanding a # pattern into its faces'''
+    path = p3d.Filename(path)
+    path.set_pattern(True)
+    if not path.has_hash():
+        return [path]
+
+    return [path.get_filename_index(idx) for idx in range(6)]
+
+
+def hash_source_files(files: list[p3d.Filename]) -> str:
+    '''Return a digest of the contents of the given files'''
+    vfs = p3d.VirtualFileSystem.get_global_ptr()
+    digest = hashlib.sha256()
+    for filepath in files:
+        digest.update(vfs.read_file(filepath, True))
+    return digest.hexdigest()
+
+
+def make_cache_key(source_digest: str, prefiltered_size: int, prefiltered_samples: int) -> str:
+    '''Return a stable key for a prefiltered EnvMap built from the source with the given digest'''
+    backend = 'numpy' if iblfuncs.iblfuncs_np is not None else 'python'
+    key = (
+        f'{source_digest}:{prefiltered_size}:{prefiltered_samples}:'
+        f'{IBL_ALGORITHM_VERSION}:{ENV_FILE_VERSION}:{backend}'
+    )
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
 class EnvMap:
     def __init__(
         self, cubemap: p3d.Texture,
@@ -25,26 +141,25 @@ class EnvMap:
         prefiltered_samples: int=DEFAULT_PREFILTERED_SAMPLES,
         skip_prepare: bool=False,
         blocking_prepare: bool=False,
+        num_workers: int | None=None,
+        progressive: bool | None=None,
     ) -> None:
         self.cubemap: p3d.Texture = cubemap
         self.sh_coefficients: p3d.PTA_LVecBase3f = p3d.PTA_LVecBase3f.empty_array(9)
         for idx, _ in enumerate(self.sh_coefficients):
             self.sh_coefficients[idx] = p3d.LVecBase3(0, 0, 0)
 
-        self.filtered_env_map = p3d.Texture('filtered_env_map')
-        self.filtered_env_map.setup_cube_map(1, p3d.Texture.T_float, p3d.Texture.F_rgba16)
-        self.filtered_env_map.set_clear_color(p3d.LColor(0, 0, 0, 0))
-        self.filtered_env_map.wrap_u = p3d.SamplerState.WM_clamp
-        self.filtered_env_map.wrap_v = p3d.SamplerState.WM_clamp
-        self.filtered_env_map.wrap_w = p3d.SamplerState.WM_clamp
-        self.filtered_env_map.minfilter = p3d.SamplerState.FT_linear
-        self.filtered_env_map.magfilter = p3d.SamplerState.FT_linear_mipmap_linear
+        self.filtered_env_map = _create_filtered_env_map()
 
         self._prefiltered_size = prefiltered_size
         self._prefiltered_samples = prefiltered_samples
         self.is_prepared = p3d.AsyncFuture()
 
         self._blocking_prepare = blocking_prepare
+        self._num_workers = ENVMAP_WORKERS.value if num_workers is None else num_workers
+        self._source_digest: str | None = None
+        self._progressive = ENVMAP_PROGRESSIVE.value if progressive is None else progressive
+        self._refine_callbacks: list[RefineCallbackType] = []
 
         if not skip_prepare:
             self.prepare()
@@ -53,40 +168,149 @@ class EnvMap:
         return self.cubemap.name != 'env_map_fallback'
 
 
+    @property
+    def footprint(self) -> int:
+        '''Estimated size in bytes of the source and pre-filtered cube maps
+
+        This is computed from each texture's dimensions, format, and mipmaps, so it also covers
+        textures that only live in graphics memory.
+        '''
+        return sum(
+            tex.estimate_texture_memory()
+            for tex in (self.cubemap, self.filtered_env_map)
+        )
+
+    @property
+    def source_digest(self) -> str:
+        '''Digest of the source image files, or of the RAM image if they cannot be read'''
+        if self._source_digest is None:
+            vfs = p3d.VirtualFileSystem.get_global_ptr()
+            files = []
+            if self.cubemap.has_fullpath():
+                files = get_source_files(self.cubemap.fullpath)
+            if files and all(vfs.exists(i) for i in files):
+                self._source_digest = hash_source_files(files)
+            else:
+                self._source_digest = hashlib.sha256(
+                    memoryview(self.cubemap.get_ram_image())
+                ).hexdigest()
+        return self._source_digest
+
+    @source_digest.setter
+    def source_digest(self, value: str) -> None:
+        self._source_digest = value
+
     @property
     def hash(self) -> str:
-        name = hash(self.cubemap.fullpath)
-        return f'{name}{self._prefiltered_size}{self._prefiltered_samples}'
+        return make_cache_key(
+            self.source_digest,
+            self._prefiltered_size,
+            self._prefiltered_samples
+        )
+
+    def add_refine_callback(self, callback: RefineCallbackType) -> None:
+        '''Register a callback to run on the main thread after each progressive refinement
+        stage with the EnvMap, the stage index, and the number of stages'''
+        self._refine_callbacks.append(callback)
+
+    def remove_refine_callback(self, callback: RefineCallbackType) -> None:
+        if callback in self._refine_callbacks:
+            self._refine_callbacks.remove(callback)
+
+    def _notify_refined(self, stage: int, num_stages: int) -> None:
+        def donecb(_: p3d.AsyncFuture) -> None:
+            for callback in list(self._refine_callbacks):
+                callback(self, stage, num_stages)
+
+        # Done callbacks run on the main thread
+        future = p3d.AsyncFuture()
+        future.add_done_callback(donecb)
+        future.set_result(stage)
+
+    @profiling.profiled('envmap_sh')
+    def _calc_sh(self, executor: ProcessPoolExecutor | None, stride: int = 1) -> None:
+        starttime = time.perf_counter()
+        if executor is not None:
+            shcoeffs = iblparallel.get_sh_coeffs_from_cube_map(self.cubemap, executor)
+        else:
+            shcoeffs = iblfuncs.get_sh_coeffs_from_cube_map(self.cubemap, stride)
+        for idx, val in enumerate(shcoeffs):
+            self.sh_coefficients[idx] = val
+
+        tottime = (time.perf_counter() - starttime) * 1000
+        logging.info(
+            f'Spherical harmonics coefficients for {self.cubemap.name} '
+            f'calculated in {tottime:.3f}ms'
+        )
+
+    @profiling.profiled('envmap_filter')
+    def _filter_env_map(
+        self,
+        executor: ProcessPoolExecutor | None,
+        filtered: p3d.Texture,
+        size: int,
+        num_samples: int,
+    ) -> None:
+        starttime = time.perf_counter()
+        if executor is not None:
+            iblparallel.filter_env_map(
+                self.cubemap,
+                filtered,
+                executor,
+                size=size,
+                num_samples=num_samples,
+            )
+        else:
+            iblfuncs.filter_env_map(
+                self.cubemap,
+                filtered,
+                size=size,
+                num_samples=num_samples,
+            )
+
+        tottime = (time.perf_counter() - starttime) * 1000
+        logging.info(
+            f'Pre-filtered environment map for {self.cubemap.name} '
+            f'calculated in {tottime:.3f}ms'
+        )
+
+    def _refine(self, executor: ProcessPoolExecutor | None) -> None:
+        stages = get_progressive_stages(
+            self.cubemap.x_size,
+            self._prefiltered_size,
+            self._prefiltered_samples,
+        )
+        for stage, (size, num_samples, stride) in enumerate(stages):
+            # Only the final stage is worth the overhead of worker processes
+            stage_executor = executor if stage == len(stages) - 1 else None
+
+            # Filter into a new texture so the previous stage stays usable until the swap
+            filtered = _create_filtered_env_map()
+            self._filter_env_map(stage_executor, filtered, size, num_samples)
+            self._calc_sh(stage_executor, stride)
+            self.filtered_env_map = filtered
+            self._notify_refined(stage, len(stages))
 
     def prepare(self) -> p3d.AsyncFuture:
+        executor = None
+        if self._num_workers > 0:
+            executor = ProcessPoolExecutor(max_workers=self._num_workers)
+
         def calc_sh() -> None:
-            starttime = time.perf_counter()
-            shcoeffs = iblfuncs.get_sh_coeffs_from_cube_map(self.cubemap)
-            for idx, val in enumerate(shcoeffs):
-                self.sh_coefficients[idx] = val
-
-            tottime = (time.perf_counter() - starttime) * 1000
-            logging.info(
-                f'Spherical harmonics coefficients for {self.cubemap.name} '
-                f'calculated in {tottime:.3f}ms'
-            )
+            self._calc_sh(executor)
 
         def filter_env_map() -> None:
-            starttime = time.perf_counter()
-            iblfuncs.filter_env_map(
-                self.cubemap,
+            self._filter_env_map(
+                executor,
                 self.filtered_env_map,
-                size=self._prefiltered_size,
-                num_samples=self._prefiltered_samples,
+                self._prefiltered_size,
+                self._prefiltered_samples,
             )
 
-            tottime = (time.perf_counter() - starttime) * 1000
-            logging.info(
-                f'Pre-filtered environment map for {self.cubemap.name} '
-                f'calculated in {tottime:.3f}ms'
-            )
+        def refine() -> None:
+            self._refine(executor)
 
-        jobs = [
+        jobs = [refine] if self._progressive else [
             calc_sh,
             filter_env_map,
         ]
@@ -103,6 +327,8 @@ class EnvMap:
         def wait_threads(future: p3d.AsyncFuture) -> None:
             for thread in threads:
                 thread.join()
+            if executor is not None:
+                executor.shutdown()
             future.set_result(self)
         future = p3d.AsyncFuture()
         def donecb(_: p3d.AsyncFuture) -> None:
@@ -116,9 +342,62 @@ class EnvMap:
             thread.start()
         return future
 
-    def write(self, filepath: p3d.Filename) -> None:
+    def write(
+        self,
+        filepath: p3d.Filename | Path | str,
+        *,
+        include_source: bool = True,
+        compress: bool = True,
+    ) -> None:
+        '''Write the EnvMap to a version 2 .env file
+
+        Float data is stored as half floats. The source cube map can be left out when only the
+        spherical harmonics and pre-filtered environment map are needed.
+        '''
+        filepath = _to_filename(filepath)
+        filtered = self.filtered_env_map
+        num_mips = filtered.num_ram_mipmap_images
+        meta: dict[str, typing.Any] = {
+            'prefiltered_size': self._prefiltered_size,
+            'prefiltered_samples': self._prefiltered_samples,
+            'algorithm_version': IBL_ALGORITHM_VERSION,
+            'source_digest': self.source_digest,
+            'filtered': {
+                'size': filtered.x_size,
+                'format': filtered.format,
+                'num_mips': num_mips,
+            },
+        }
+        shcoeffs = [i for vec in self.sh_coefficients for i in vec]
+        chunks = [
+            (envfile.TAG_SH, struct.pack('<27f', *shcoeffs)),
+        ]
+        for level in range(num_mips):
+            component_type, data = envfile.get_texture_image(filtered, level)
+            meta['filtered']['component_type'] = component_type
+            chunks.append((envfile.get_mip_tag(level), data))
+
+        if include_source and self.cubemap.has_ram_image():
+            cubemap = self.cubemap
+            if cubemap.ram_image_compression != p3d.Texture.CM_off:
+                cubemap = cubemap.make_copy()
+                cubemap.compress_ram_image(p3d.Texture.CM_off)
+            component_type, data = envfile.get_texture_image(cubemap, 0)
+            meta['source'] = {
+                'name': cubemap.name,
+                'size': cubemap.x_size,
+                'format': cubemap.format,
+                'component_type': component_type,
+            }
+            chunks.append((envfile.TAG_SOURCE, data))
+
+        chunks.insert(0, (envfile.TAG_META, json.dumps(meta).encode('utf8')))
+        envfile.write_env_file(filepath, chunks, compress=compress)
+
+    def write_bam(self, filepath: p3d.Filename | Path | str) -> None:
+        '''Write the EnvMap to a version 1 (BAM) .env file'''
         bfile = p3d.BamFile()
-        bfile.open_write(filepath)
+        bfile.open_write(_to_filename(filepath))
         bfile.writer.set_file_texture_mode(p3d.BamWriter.BTM_rawdata)
 
         shcoeffs_data = p3d.Datagram()
@@ -129,15 +408,74 @@ class EnvMap:
         bfile.write_object(self.cubemap)
         bfile.write_object(self.filtered_env_map)
         bfile.writer.target.put_datagram(shcoeffs_data)
+        bfile.close()
+
+    @classmethod
+    def _from_env_file(cls, path: p3d.Filename, load_source: bool) -> Self:
+        with envfile.EnvFileReader(path) as reader:
+            meta = reader.meta
+            source_meta = meta.get('source')
+            if load_source and source_meta is not None:
+                cubemap = p3d.Texture(source_meta['name'])
+                cubemap.setup_cube_map(
+                    source_meta['size'],
+                    source_meta['component_type'],
+                    source_meta['format'],
+                )
+                cubemap.set_ram_image(reader.read_chunk(envfile.TAG_SOURCE))
+            else:
+                cubemap = p3d.Texture(path.get_basename_wo_extension())
+                cubemap.setup_cube_map(1, p3d.Texture.T_half_float, p3d.Texture.F_rgb16)
+
+            envmap = cls(
+                cubemap,
+                prefiltered_size=meta['prefiltered_size'],
+                prefiltered_samples=meta['prefiltered_samples'],
+                skip_prepare=True,
+            )
+            envmap.source_digest = meta['source_digest']
+
+            filtered_meta = meta['filtered']
+            filtered = envmap.filtered_env_map
+            if filtered_meta['num_mips'] > 0:
+                filtered.setup_cube_map(
+                    filtered_meta['size'],
+                    filtered_meta['component_type'],
+                    filtered_meta['format'],
+                )
+                filtered.magfilter = p3d.SamplerState.FT_linear
+                filtered.minfilter = p3d.SamplerState.FT_linear_mipmap_linear
+                for level in range(filtered_meta['num_mips']):
+                    filtered.set_ram_mipmap_image(
+                        level,
+                        p3d.CPTA_uchar(reader.read_chunk(envfile.get_mip_tag(level)))
+                    )
+
+            shcoeffs = struct.unpack('<27f', reader.read_chunk(envfile.TAG_SH))
+            for idx, _ in enumerate(envmap.sh_coefficients):
+                envmap.sh_coefficients[idx] = p3d.LVector3(*shcoeffs[idx * 3:idx * 3 + 3])
+
+        envmap.is_prepared.set_result(envmap)
+        return envmap
 
     @classmethod
-    def _from_bam(cls, path: p3d.Filename) -> Self:
+    def _from_bam(
+        cls,
+        path: p3d.Filename,
+        prefiltered_size: int = DEFAULT_PREFILTERED_SIZE,
+        prefiltered_samples: int = DEFAULT_PREFILTERED_SAMPLES,
+    ) -> Self:
         bfile = p3d.BamFile()
         bfile.open_read(path, True)
 
         reader = bfile.reader
         cubemap = typing.cast(p3d.Texture, reader.read_object())
-        envmap = cls(cubemap, skip_prepare=True)
+        envmap = cls(
+            cubemap,
+            prefiltered_size=prefiltered_size,
+            prefiltered_samples=prefiltered_samples,
+            skip_prepare=True,
+        )
         envmap.filtered_env_map = typing.cast(p3d.Texture, reader.read_object())
         dgram = p3d.Datagram()
         reader.source.get_datagram(dgram)
@@ -159,15 +497,20 @@ class EnvMap:
         prefiltered_samples: int = DEFAULT_PREFILTERED_SAMPLES,
         skip_prepare: bool=False,
         blocking_prepare: bool=False,
+        num_workers: int | None=None,
+        progressive: bool | None=None,
+        load_source: bool=True,
     ) -> Self:
-        if isinstance(path, Path):
-            path = p3d.Filename(path)
+        '''Load an EnvMap from cube map images or an .env file
 
-        if not isinstance(path, p3d.Filename):
-            path = p3d.Filename.from_os_specific(path)
+        load_source=False skips reading the source cube map from version 2 .env files.
+        '''
+        path = _to_filename(path)
 
         if path.get_extension() == 'env':
-            return cls._from_bam(path)
+            if is_env_file_v2(path):
+                return cls._from_env_file(path, load_source)
+            return cls._from_bam(path, prefiltered_size, prefiltered_samples)
 
         cubemap = p3d.TexturePool.load_cube_map(path)
         return cls(
@@ -176,6 +519,8 @@ class EnvMap:
             prefiltered_samples=prefiltered_samples,
             skip_prepare=skip_prepare,
             blocking_prepare=blocking_prepare,
+            num_workers=num_workers,
+            progressive=progressive,
         )
 
     @classmethod
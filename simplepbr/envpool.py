@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import json
+import os
 from pathlib import Path
 from typing import Union
 from typing_extensions import (
@@ -5,75 +8,350 @@ from typing_extensions import (
 )
 
 import panda3d.core as p3d
+from direct.stdpy import threading
 
 from .envmap import (
     EnvMap,
     DEFAULT_PREFILTERED_SIZE,
     DEFAULT_PREFILTERED_SAMPLES,
+    get_source_files,
+    hash_source_files,
+    make_cache_key,
 )
 from . import logging
 
 
+CACHE_INDEX_NAME = 'simplepbr-envpool-index.json'
+CACHE_INDEX_VERSION = 1
+
+ENVPOOL_BUDGET_MB = p3d.ConfigVariableInt(
+    'simplepbr-envpool-budget-mb',
+    0,
+    'Maximum size in megabytes of the textures held by EnvPool before least recently used '
+    'maps are evicted, use 0 for no limit',
+)
+
+FileStats = list[tuple[str, int, int]]
+
+
 class EnvPool:
     _ptr: Self | None = None
 
-    def __init__(self) -> None:
-        self._envmaps: dict[p3d.Filename, EnvMap] = {}
+    def __init__(self, budget: Union[int, None] = None) -> None:
+        '''The budget is in bytes and defaults to the simplepbr-envpool-budget-mb PRC variable'''
+        self._envmaps: OrderedDict[p3d.Filename, EnvMap] = OrderedDict()
+        self._index: Union[dict[str, dict], None] = None
+        self._pins: dict[EnvMap, int] = {}
+        self._pending: dict[p3d.Filename, p3d.AsyncFuture] = {}
+        self._index_lock = threading.Lock()
+        if budget is None:
+            budget = ENVPOOL_BUDGET_MB.value * 1024 * 1024
+        self._budget = budget
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def budget(self) -> int:
+        return self._budget
+
+    @budget.setter
+    def budget(self, value: int) -> None:
+        self._budget = value
+        self._evict()
+
+    @property
+    def footprint(self) -> int:
+        '''Total size in bytes of the textures held by the pool'''
+        return sum(envmap.footprint for envmap in self._envmaps.values())
+
+    def stats(self) -> dict[str, int]:
+        for filepath in list(self._pending):
+            self._collect_pending(filepath)
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'entries': len(self._envmaps),
+            'footprint': self.footprint,
+            'budget': self._budget,
+        }
+
+    def acquire(self, envmap: EnvMap) -> None:
+        '''Pin an EnvMap so it is not evicted while in use'''
+        self._pins[envmap] = self._pins.get(envmap, 0) + 1
+
+    def release(self, envmap: EnvMap) -> None:
+        '''Unpin an EnvMap previously pinned with acquire()'''
+        count = self._pins.get(envmap, 0) - 1
+        if count > 0:
+            self._pins[envmap] = count
+        else:
+            self._pins.pop(envmap, None)
+            self._evict()
+
+    def _evict(self) -> None:
+        if self._budget <= 0:
+            return
+
+        footprint = self.footprint
+        for filepath, envmap in list(self._envmaps.items()):
+            if footprint <= self._budget:
+                break
+            # Skip maps in use or still being prepared
+            if envmap in self._pins or not envmap.is_prepared.done():
+                continue
+
+            del self._envmaps[filepath]
+            footprint -= envmap.footprint
+            self._evictions += 1
+            p3d.TexturePool.release_texture(envmap.cubemap)
+            envmap.cubemap.release_all()
+            envmap.filtered_env_map.release_all()
+            logging.info(f'EnvPool: evicted {filepath} from RAM cache')
+
+    def _add(self, filepath: p3d.Filename, envmap: EnvMap) -> EnvMap:
+        self._envmaps[filepath] = envmap
+        self._evict()
+        if not envmap.is_prepared.done():
+            envmap.is_prepared.add_done_callback(lambda _: self._evict())
+        return envmap
+
+    def _get_cache_dir(self) -> p3d.Filename:
+        return p3d.ConfigVariableFilename('model-cache-dir').value
 
-    def _get_cache_path(self, envmap: EnvMap) -> p3d.Filename:
-        model_cache_dir = p3d.ConfigVariableFilename('model-cache-dir').value
-        cache_path = model_cache_dir / f'{envmap.hash}.env'
+    def _get_cache_path(self, envmap: Union[EnvMap, str]) -> p3d.Filename:
+        key = envmap if isinstance(envmap, str) else envmap.hash
+        cache_path = self._get_cache_dir() / f'{key}.env'
 
         return cache_path
 
+    def _get_index_path(self) -> p3d.Filename:
+        return self._get_cache_dir() / CACHE_INDEX_NAME
+
+    def _read_index(self) -> dict[str, dict]:
+        if self._index is None:
+            self._index = {}
+            index_path = self._get_index_path()
+            try:
+                with open(index_path.to_os_specific(), encoding='utf8') as indexfile:
+                    data = json.load(indexfile)
+                if data.get('version') == CACHE_INDEX_VERSION:
+                    self._index = data['entries']
+            except (OSError, ValueError, KeyError):
+                pass
+        return self._index
+
+    def _write_index(self) -> None:
+        index_path = self._get_index_path()
+        index_path.make_dir()
+        tmp_path = index_path.to_os_specific() + f'.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf8') as indexfile:
+                json.dump(
+                    {'version': CACHE_INDEX_VERSION, 'entries': self._read_index()},
+                    indexfile,
+                )
+            os.replace(tmp_path, index_path.to_os_specific())
+        except OSError as exc:
+            logging.warning(f'EnvPool: failed to write cache index {index_path}: {exc}')
+
+    def _resolve_source_files(self, filepath: p3d.Filename) -> Union[list[p3d.Filename], None]:
+        vfs = p3d.VirtualFileSystem.get_global_ptr()
+        model_path = p3d.get_model_path().value
+        resolved = []
+        for source in get_source_files(filepath):
+            source = p3d.Filename(source)
+            if not vfs.resolve_filename(source, model_path):
+                return None
+            resolved.append(source)
+        return resolved
+
+    def _get_file_stats(self, files: list[p3d.Filename]) -> FileStats:
+        vfs = p3d.VirtualFileSystem.get_global_ptr()
+        stats = []
+        for filepath in files:
+            vfile = vfs.get_file(filepath)
+            stats.append((str(filepath), vfile.get_timestamp(), vfile.get_file_size()))
+        return stats
+
+    def get_source_digest(self, filepath: p3d.Filename) -> Union[str, None]:
+        '''Return a digest of the source image files, reusing the on-disk index when the
+        files have not changed since they were last hashed'''
+        files = self._resolve_source_files(filepath)
+        if files is None:
+            return None
+
+        key = ';'.join(str(i) for i in files)
+        stats = [list(i) for i in self._get_file_stats(files)]
+        with self._index_lock:
+            entry = self._read_index().get(key)
+        if entry is not None and entry['files'] == stats:
+            return entry['digest']
+
+        digest = hash_source_files(files)
+        with self._index_lock:
+            self._read_index()[key] = {
+                'files': stats,
+                'digest': digest,
+            }
+            self._write_index()
+        return digest
+
     def _write_cache(self, future: p3d.AsyncFuture) -> None:
-        envmap = future.result()
-        envmap.write(self._get_cache_path(envmap))
+        self._write_envmap_cache(future.result())
 
-    def load(
-        self,
-        filepath: Union[p3d.Filename, Path, str],
-        prefiltered_size: int = DEFAULT_PREFILTERED_SIZE,
-        prefiltered_samples: int = DEFAULT_PREFILTERED_SAMPLES,
-    ) -> EnvMap:
+    def _write_envmap_cache(self, envmap: EnvMap) -> None:
+        cache_path = self._get_cache_path(envmap)
+        cache_path.make_dir()
+
+        # Write to a temporary file first so a partial file is never picked up as a cache hit
+        tmp_path = p3d.Filename(
+            cache_path.get_fullpath() + f'.{os.getpid()}.{id(envmap)}.tmp'
+        )
+        # The source cube map is not needed to use a cached EnvMap
+        envmap.write(tmp_path, include_source=False)
+        if not tmp_path.rename_to(cache_path):
+            tmp_path.unlink()
+            logging.warning(f'EnvPool: failed to write disk cache {cache_path}')
+
+    @staticmethod
+    def _to_filename(filepath: Union[p3d.Filename, Path, str]) -> p3d.Filename:
         if isinstance(filepath, Path):
             filepath = p3d.Filename(filepath)
 
         if not isinstance(filepath, p3d.Filename):
             filepath = p3d.Filename.from_os_specific(filepath)
 
-        if filepath in self._envmaps:
-            logging.info(f'EnvPool: loaded {filepath} from RAM cache')
-            return self._envmaps[filepath]
+        return filepath
 
+    def _load_envmap(
+        self,
+        filepath: p3d.Filename,
+        prefiltered_size: int,
+        prefiltered_samples: int,
+        num_workers: Union[int, None],
+        blocking_prepare: bool,
+    ) -> EnvMap:
         if filepath.get_extension() == 'env':
-            envmap = EnvMap.from_file_path(filepath)
-            self._envmaps[filepath] = envmap
-            return envmap
+            return EnvMap.from_file_path(filepath)
+
+        source_digest = self.get_source_digest(filepath)
+        if source_digest is not None:
+            cache_file = self._get_cache_path(
+                make_cache_key(source_digest, prefiltered_size, prefiltered_samples)
+            )
+            if cache_file.exists():
+                logging.info(f'EnvPool: loaded {filepath} from disk cache')
+                envmap = EnvMap.from_file_path(cache_file, load_source=False)
+                envmap.source_digest = source_digest
+                return envmap
 
         envmap = EnvMap.from_file_path(
             filepath,
             skip_prepare=True,
+            blocking_prepare=blocking_prepare,
             prefiltered_size=prefiltered_size,
             prefiltered_samples=prefiltered_samples,
+            num_workers=num_workers,
         )
-        cache_file = self._get_cache_path(envmap)
-
-        if cache_file.exists():
-            logging.info(f'EnvPool: loaded {filepath} from disk cache')
-            envmap = EnvMap.from_file_path(
-                cache_file,
-                prefiltered_size=prefiltered_size,
-                prefiltered_samples=prefiltered_samples,
-            )
+        if source_digest is not None:
+            envmap.source_digest = source_digest
+        envmap.prepare()
+        if blocking_prepare:
+            self._write_envmap_cache(envmap)
         else:
-            envmap.prepare()
             envmap.is_prepared.add_done_callback(self._write_cache)
 
-
-        self._envmaps[filepath] = envmap
         return envmap
 
+    def _collect_pending(self, filepath: p3d.Filename) -> None:
+        # Done callbacks only run when the task manager is polled, so the result of a finished
+        # load_async() may need to be added before the callback gets the chance
+        future = self._pending.get(filepath)
+        if future is None or not future.done():
+            return
+        del self._pending[filepath]
+        if not future.cancelled():
+            self._add(filepath, future.result())
+
+    def load(
+        self,
+        filepath: Union[p3d.Filename, Path, str],
+        prefiltered_size: int = DEFAULT_PREFILTERED_SIZE,
+        prefiltered_samples: int = DEFAULT_PREFILTERED_SAMPLES,
+        num_workers: Union[int, None] = None,
+    ) -> EnvMap:
+        filepath = self._to_filename(filepath)
+        # Share the EnvMap of an unfinished load_async() instead of preparing it a second time
+        pending = self._pending.get(filepath)
+        if pending is not None:
+            pending.wait()
+        self._collect_pending(filepath)
+
+        if filepath in self._envmaps:
+            logging.info(f'EnvPool: loaded {filepath} from RAM cache')
+            self._hits += 1
+            self._envmaps.move_to_end(filepath)
+            return self._envmaps[filepath]
+
+        self._misses += 1
+        envmap = self._load_envmap(
+            filepath,
+            prefiltered_size,
+            prefiltered_samples,
+            num_workers,
+            blocking_prepare=False,
+        )
+        return self._add(filepath, envmap)
+
+    def load_async(
+        self,
+        filepath: Union[p3d.Filename, Path, str],
+        prefiltered_size: int = DEFAULT_PREFILTERED_SIZE,
+        prefiltered_samples: int = DEFAULT_PREFILTERED_SAMPLES,
+        num_workers: Union[int, None] = None,
+    ) -> p3d.AsyncFuture:
+        '''Load an EnvMap in a background thread, returning a future that is done once the
+        EnvMap is prepared. Concurrent requests for the same file share the same future.'''
+        filepath = self._to_filename(filepath)
+        self._collect_pending(filepath)
+
+        if filepath in self._envmaps:
+            self._hits += 1
+            self._envmaps.move_to_end(filepath)
+            future = p3d.AsyncFuture()
+            future.set_result(self._envmaps[filepath])
+            return future
+
+        if filepath in self._pending:
+            return self._pending[filepath]
+
+        self._misses += 1
+        future = p3d.AsyncFuture()
+        self._pending[filepath] = future
+
+        def load_job() -> None:
+            try:
+                envmap = self._load_envmap(
+                    filepath,
+                    prefiltered_size,
+                    prefiltered_samples,
+                    num_workers,
+                    blocking_prepare=True,
+                )
+            except Exception as exc: # pylint:disable=broad-exception-caught
+                logging.warning(f'EnvPool: failed to load {filepath}: {exc}')
+                future.cancel()
+                return
+            future.set_result(envmap)
+
+        future.add_done_callback(lambda _: self._collect_pending(filepath))
+
+        thread = threading.Thread(target=load_job)
+        thread.start()
+        return future
+
     @classmethod
     def ptr(cls) -> Self:
         if cls._ptr is None:
@@ -8,6 +8,7 @@ import simplepbr
 from simplepbr.envmap import (
     DEFAULT_PREFILTERED_SIZE,
     DEFAULT_PREFILTERED_SAMPLES,
+    ENVMAP_WORKERS,
 )
 
 def main() -> None:
@@ -35,6 +36,24 @@ def main() -> None:
         default=DEFAULT_PREFILTERED_SAMPLES
     )
 
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='the number of worker processes to use, 0 to use threads in the current process',
+        default=ENVMAP_WORKERS.value
+    )
+
+    parser.add_argument(
+        '--skip-source',
+        action='store_true',
+        help='do not store the source cubemap, only the data needed for rendering',
+    )
+    parser.add_argument(
+        '--uncompressed',
+        action='store_true',
+        help='do not compress the env file',
+    )
+
     args = parser.parse_args()
 
     if args.verbose:
@@ -45,9 +64,14 @@ def main() -> None:
         prefiltered_size=args.prefiltered_size,
         prefiltered_samples=args.prefiltered_samples,
         blocking_prepare=True,
+        num_workers=args.workers,
     )
 
-    envmap.write(args.dst)
+    envmap.write(
+        args.dst,
+        include_source=not args.skip_source,
+        compress=not args.uncompressed,
+    )
 
 if __name__ == '__main__':
     main()
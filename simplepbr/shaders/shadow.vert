@@ -4,6 +4,14 @@ uniform mat4 p3d_ModelViewProjectionMatrix;
 #ifdef ENABLE_SKINNING
 uniform mat4 p3d_TransformTable[100];
 #endif
+#ifdef ENABLE_SKINNING_PALETTE
+uniform sampler2D skinning_palette;
+uniform float palette_skinning_enabled;
+uniform float palette_offset;
+#endif
+#ifdef ENABLE_INSTANCING
+uniform float instancing_enabled;
+#endif
 
 attribute vec4 p3d_Vertex;
 attribute vec4 p3d_Color;
@@ -12,11 +20,44 @@ attribute vec2 p3d_MultiTexCoord0;
 attribute vec4 transform_weight;
 attribute vec4 transform_index;
 #endif
+#ifdef ENABLE_SKINNING_PALETTE
+attribute vec4 palette_index;
+attribute vec4 palette_weight;
+#endif
+#ifdef ENABLE_INSTANCING
+attribute mat4 instance_matrix;
+attribute vec4 instance_color;
+#endif
 
 
 varying vec4 v_color;
 varying vec2 v_texcoord;
 
+#ifdef ENABLE_SKINNING_PALETTE
+vec4 fetch_palette_column(float joint, int column) {
+    int idx = int(palette_offset + joint + 0.5);
+    ivec2 coord = ivec2(
+        (idx % PALETTE_JOINTS_PER_ROW) * 3 + column,
+        idx / PALETTE_JOINTS_PER_ROW
+    );
+    return texelFetch(skinning_palette, coord, 0);
+}
+
+mat4 get_palette_matrix() {
+    // Each joint is stored as the three columns of a 3x4 matrix
+    vec4 columns[3];
+    for (int i = 0; i < 3; ++i) {
+        columns[i] = (
+            fetch_palette_column(palette_index.x, i) * palette_weight.x +
+            fetch_palette_column(palette_index.y, i) * palette_weight.y +
+            fetch_palette_column(palette_index.z, i) * palette_weight.z +
+            fetch_palette_column(palette_index.w, i) * palette_weight.w
+        );
+    }
+    return transpose(mat4(columns[0], columns[1], columns[2], vec4(0.0, 0.0, 0.0, 1.0)));
+}
+#endif
+
 void main() {
 #ifdef ENABLE_SKINNING
     mat4 skin_matrix = (
@@ -28,8 +69,19 @@ void main() {
     vec4 vert_pos4 = skin_matrix * p3d_Vertex;
 #else
     vec4 vert_pos4 = p3d_Vertex;
+#endif
+#ifdef ENABLE_SKINNING_PALETTE
+    if (palette_skinning_enabled > 0.5) {
+        vert_pos4 = get_palette_matrix() * p3d_Vertex;
+    }
 #endif
     v_color = p3d_Color;
+#ifdef ENABLE_INSTANCING
+    if (instancing_enabled > 0.5) {
+        vert_pos4 = instance_matrix * vert_pos4;
+        v_color *= instance_color;
+    }
+#endif
     v_texcoord = p3d_MultiTexCoord0;
     gl_Position = p3d_ModelViewProjectionMatrix * vert_pos4;
 }
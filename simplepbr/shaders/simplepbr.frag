@@ -29,7 +29,9 @@ uniform struct p3d_LightSourceParameters {
     vec3 spotDirection;
     float spotCosCutoff;
 #ifdef ENABLE_SHADOWS
+#ifndef ENABLE_SHADOW_ATLAS
     sampler2DShadow shadowMap;
+#endif
     mat4 shadowViewMatrix;
 #endif
 } p3d_LightSource[MAX_LIGHTS];
@@ -77,6 +79,33 @@ uniform float max_reflection_lod;
 uniform float global_shadow_bias;
 #endif
 
+#ifdef ENABLE_SHADOW_ATLAS
+uniform sampler2DShadow shadow_atlas;
+uniform vec4 shadow_atlas_lights[MAX_LIGHTS];
+uniform vec4 shadow_atlas_rects[MAX_LIGHTS];
+uniform vec4 shadow_atlas_params[MAX_LIGHTS];
+uniform vec4 shadow_atlas_origins[MAX_LIGHTS];
+uniform mat4 shadow_atlas_view_to_world;
+#endif
+
+#ifdef ENABLE_CASCADED_SHADOWS
+uniform sampler2DShadow csm_atlas;
+uniform mat4 csm_matrices[CSM_CASCADES];
+uniform vec4 csm_splits;
+uniform vec3 csm_light_direction;
+#endif
+
+#ifdef ENABLE_CLUSTERED_LIGHTS
+uniform mat4 p3d_ProjectionMatrix;
+uniform sampler2D clustered_light_data;
+uniform sampler2D clustered_cluster_data;
+uniform sampler2D clustered_light_indices;
+uniform vec3 cluster_grid;
+uniform vec2 cluster_slice_params;
+uniform vec4 clustered_shadow_lights[MAX_LIGHTS];
+uniform float clustered_lights_enabled;
+#endif
+
 const vec3 F0 = vec3(0.04);
 const float PI = 3.141592653589793;
 const float SPOTSMOOTH = 0.001;
@@ -154,6 +183,82 @@ float shadow_caster_contrib(sampler2DShadow shadowmap, vec4 shadowpos) {
 }
 #endif
 
+#ifdef ENABLE_SHADOW_ATLAS
+bool is_same_light(vec4 lightpos, vec4 atlaspos) {
+    if (lightpos.w != atlaspos.w) {
+        return false;
+    }
+    if (lightpos.w == 0.0) {
+        return dot(normalize(lightpos.xyz), atlaspos.xyz) > 0.9999;
+    }
+    return distance(lightpos.xyz, atlaspos.xyz) < 0.001;
+}
+
+// Point light tiles hold six faces in three columns and two rows, see _shadows.py
+float point_shadow_contrib(vec3 lightpos, vec4 rect, vec2 near_far) {
+    vec3 d = mat3(shadow_atlas_view_to_world) * (v_view_position - lightpos);
+    vec3 absd = abs(d);
+    vec3 forward;
+    vec3 up;
+    float face;
+    if (absd.x >= absd.y && absd.x >= absd.z) {
+        face = d.x > 0.0 ? 0.0 : 1.0;
+        forward = vec3(sign(d.x), 0.0, 0.0);
+        up = vec3(0.0, 0.0, 1.0);
+    } else if (absd.y >= absd.z) {
+        face = d.y > 0.0 ? 2.0 : 3.0;
+        forward = vec3(0.0, sign(d.y), 0.0);
+        up = vec3(0.0, 0.0, 1.0);
+    } else {
+        face = d.z > 0.0 ? 4.0 : 5.0;
+        forward = vec3(0.0, 0.0, sign(d.z));
+        up = vec3(0.0, 1.0, 0.0);
+    }
+    float dist = dot(d, forward);
+    if (dist > near_far.y) {
+        return 1.0;
+    }
+    vec2 uv = vec2(dot(d, cross(forward, up)), dot(d, up)) / dist * 0.5 + 0.5;
+    vec2 cell = vec2(mod(face, 3.0), floor(face / 3.0));
+    vec2 atlas_uv = rect.xy + (cell + clamp(uv, 0.0, 1.0)) * rect.zw / vec2(3.0, 2.0);
+    float n = near_far.x;
+    float f = near_far.y;
+    float depth = 0.5 * ((f + n) / (f - n) - 2.0 * f * n / ((f - n) * dist)) + 0.5;
+    return shadow_caster_contrib(shadow_atlas, vec4(atlas_uv, depth, 1.0));
+}
+
+float atlas_shadow_contrib(vec4 lightpos, vec4 shadowpos) {
+    // Atlas tiles are matched to lights by their view space position or direction
+    for (int j = 0; j < MAX_LIGHTS; ++j) {
+        vec4 rect = shadow_atlas_rects[j];
+        if (rect.z > 0.0 && is_same_light(lightpos, shadow_atlas_lights[j])) {
+            vec4 params = shadow_atlas_params[j];
+            if (params.z > 0.0) {
+                return point_shadow_contrib(shadow_atlas_origins[j].xyz, rect, params.xy);
+            }
+            vec3 coords = shadowpos.xyz / shadowpos.w;
+            if (any(lessThan(coords.xy, vec2(0.0))) || any(greaterThan(coords.xy, vec2(1.0)))) {
+                return 1.0;
+            }
+            return shadow_caster_contrib(shadow_atlas, vec4(rect.xy + coords.xy * rect.zw, coords.z, 1.0));
+        }
+    }
+    return 1.0;
+}
+#endif
+
+#ifdef ENABLE_CASCADED_SHADOWS
+float cascaded_shadow_contrib() {
+    float depth = -v_view_position.z;
+    for (int i = 0; i < CSM_CASCADES; ++i) {
+        if (depth < csm_splits[i]) {
+            return shadow_caster_contrib(csm_atlas, csm_matrices[i] * vec4(v_view_position, 1.0));
+        }
+    }
+    return 1.0;
+}
+#endif
+
 vec3 get_normalmap_data() {
 #ifdef CALC_NORMAL_Z
     vec2 normalXY = 2.0 * texture2D(p3d_TextureNormal, v_texcoord).rg - 1.0;
@@ -167,6 +272,47 @@ vec3 get_normalmap_data() {
 #endif
 }
 
+// Direct lighting from a single light
+vec3 light_contrib(vec3 n, vec3 v, vec3 l, vec3 lightcol, FunctionParamters func_params) {
+    vec3 h = normalize(l + v);
+    func_params.n_dot_l = clamp(dot(n, l), 0.0, 1.0);
+    func_params.n_dot_h = clamp(dot(n, h), 0.0, 1.0);
+    func_params.l_dot_h = clamp(dot(l, h), 0.0, 1.0);
+    func_params.v_dot_h = clamp(dot(v, h), 0.0, 1.0);
+
+    vec3 F = specular_reflection(func_params);
+    float V = visibility_occlusion(func_params); // V = G / (4 * n_dot_l * n_dot_v)
+    float D = microfacet_distribution(func_params);
+
+    vec3 diffuse_contrib = func_params.diffuse_color * diffuse_function();
+    vec3 spec_contrib = vec3(F * V * D);
+    return func_params.n_dot_l * lightcol * (diffuse_contrib + spec_contrib);
+}
+
+#ifdef ENABLE_CLUSTERED_LIGHTS
+// Returns the texel of clustered_cluster_data for the cluster containing this fragment
+ivec2 get_cluster_coord() {
+    vec4 clip_position = p3d_ProjectionMatrix * vec4(v_view_position, 1.0);
+    vec2 tile = (clip_position.xy / clip_position.w * 0.5 + 0.5) * cluster_grid.xy;
+    tile = clamp(floor(tile), vec2(0.0), cluster_grid.xy - 1.0);
+    float depth = max(-v_view_position.z, 1e-4);
+    float depth_slice = floor(log(depth) * cluster_slice_params.x + cluster_slice_params.y);
+    depth_slice = clamp(depth_slice, 0.0, cluster_grid.z - 1.0);
+    return ivec2(int(tile.x + tile.y * cluster_grid.x + 0.5), int(depth_slice + 0.5));
+}
+
+// Shadow casting point lights and spotlights are not clustered so they keep their shadows
+bool is_clustered_shadow_light(vec4 lightpos) {
+    for (int j = 0; j < MAX_LIGHTS; ++j) {
+        vec4 shadowpos = clustered_shadow_lights[j];
+        if (shadowpos.w > 0.0 && distance(lightpos.xyz, shadowpos.xyz) < 0.001) {
+            return true;
+        }
+    }
+    return false;
+}
+#endif
+
 vec3 irradiance_from_sh(vec3 normal) {
     return
         + sh_coeffs[0] * 0.282095
@@ -213,6 +359,14 @@ void main() {
 
     float n_dot_v = clamp(abs(dot(n, v)), 0.0, 1.0);
 
+    FunctionParamters func_params;
+    func_params.n_dot_v = n_dot_v;
+    func_params.roughness = alpha_roughness;
+    func_params.metallic =  metallic;
+    func_params.reflection0 = spec_color;
+    func_params.diffuse_color = diffuse_color;
+    func_params.specular_color = spec_color;
+
     for (int i = 0; i < p3d_LightSource.length(); ++i) {
         vec3 lightcol = p3d_LightSource[i].diffuse.rgb;
 
@@ -220,9 +374,16 @@ void main() {
             continue;
         }
 
+#ifdef ENABLE_CLUSTERED_LIGHTS
+        // Point lights and spotlights without shadows are handled by the cluster loop below,
+        // unless this node's lights differ from the clustered ones
+        if (clustered_lights_enabled > 0.5 && p3d_LightSource[i].position.w != 0.0 && !is_clustered_shadow_light(p3d_LightSource[i].position)) {
+            continue;
+        }
+#endif
+
         vec3 light_pos = p3d_LightSource[i].position.xyz - v_view_position * p3d_LightSource[i].position.w;
         vec3 l = normalize(light_pos);
-        vec3 h = normalize(l + v);
         float dist = length(light_pos);
         vec3 att_const = p3d_LightSource[i].attenuation;
         float attenuation_factor = 1.0 / (att_const.x + att_const.y * dist + att_const.z * dist * dist);
@@ -230,33 +391,54 @@ void main() {
         float spotcutoff = p3d_LightSource[i].spotCosCutoff;
         float shadowSpot = (spotcutoff > SPOTSMOOTH) ? smoothstep(spotcutoff-SPOTSMOOTH, spotcutoff+SPOTSMOOTH, spotcos) : 1.0;
 #ifdef ENABLE_SHADOWS
+#ifdef ENABLE_SHADOW_ATLAS
+        float shadow_caster = atlas_shadow_contrib(p3d_LightSource[i].position, v_shadow_pos[i]);
+#else
         float shadow_caster = shadow_caster_contrib(p3d_LightSource[i].shadowMap, v_shadow_pos[i]);
+#endif
+#ifdef ENABLE_CASCADED_SHADOWS
+        if (p3d_LightSource[i].position.w == 0.0 && dot(normalize(p3d_LightSource[i].position.xyz), csm_light_direction) > 0.9999) {
+            shadow_caster = cascaded_shadow_contrib();
+        }
+#endif
 #else
         float shadow_caster = 1.0;
 #endif
         float shadow = shadowSpot * shadow_caster * attenuation_factor;
 
-        FunctionParamters func_params;
-        func_params.n_dot_l = clamp(dot(n, l), 0.0, 1.0);
-        func_params.n_dot_v = n_dot_v;
-        func_params.n_dot_h = clamp(dot(n, h), 0.0, 1.0);
-        func_params.l_dot_h = clamp(dot(l, h), 0.0, 1.0);
-        func_params.v_dot_h = clamp(dot(v, h), 0.0, 1.0);
-        func_params.roughness = alpha_roughness;
-        func_params.metallic =  metallic;
-        func_params.reflection0 = spec_color;
-        func_params.diffuse_color = diffuse_color;
-        func_params.specular_color = spec_color;
-
-        vec3 F = specular_reflection(func_params);
-        float V = visibility_occlusion(func_params); // V = G / (4 * n_dot_l * n_dot_v)
-        float D = microfacet_distribution(func_params);
-
-        vec3 diffuse_contrib = diffuse_color * diffuse_function();
-        vec3 spec_contrib = vec3(F * V * D);
-        color.rgb += func_params.n_dot_l * lightcol * (diffuse_contrib + spec_contrib) * shadow;
+        color.rgb += light_contrib(n, v, l, lightcol, func_params) * shadow;
     }
 
+#ifdef ENABLE_CLUSTERED_LIGHTS
+    vec2 cluster_lights = texelFetch(clustered_cluster_data, get_cluster_coord(), 0).rg;
+    int first_light = int(cluster_lights.x + 0.5);
+    int num_lights = clustered_lights_enabled > 0.5 ? int(cluster_lights.y + 0.5) : 0;
+    for (int j = first_light; j < first_light + num_lights; ++j) {
+        ivec2 index_coord = ivec2(j % CLUSTER_INDEX_WIDTH, j / CLUSTER_INDEX_WIDTH);
+        int light_idx = int(texelFetch(clustered_light_indices, index_coord, 0).r + 0.5);
+
+        // Each light is stored as (position, radius), (color, spot cutoff), (spot direction),
+        // and (attenuation)
+        vec4 pos_radius = texelFetch(clustered_light_data, ivec2(0, light_idx), 0);
+        vec3 light_pos = pos_radius.xyz - v_view_position;
+        float dist = length(light_pos);
+        if (dist > pos_radius.w) {
+            continue;
+        }
+
+        vec4 color_cutoff = texelFetch(clustered_light_data, ivec2(1, light_idx), 0);
+        vec3 spot_dir = texelFetch(clustered_light_data, ivec2(2, light_idx), 0).xyz;
+        vec3 att_const = texelFetch(clustered_light_data, ivec2(3, light_idx), 0).xyz;
+        vec3 l = light_pos / max(dist, 1e-6);
+        float attenuation_factor = 1.0 / (att_const.x + att_const.y * dist + att_const.z * dist * dist);
+        float spotcos = dot(spot_dir, -l);
+        float spotcutoff = color_cutoff.w;
+        float shadowSpot = (spotcutoff > SPOTSMOOTH) ? smoothstep(spotcutoff-SPOTSMOOTH, spotcutoff+SPOTSMOOTH, spotcos) : 1.0;
+
+        color.rgb += light_contrib(n, v, l, color_cutoff.rgb, func_params) * shadowSpot * attenuation_factor;
+    }
+#endif
+
     // Indirect diffuse + specular (IBL)
     vec3 ibl_f = fresnelSchlickRoughness(n_dot_v, spec_color, perceptual_roughness);
     vec3 ibl_kd = (1.0 - ibl_f) * (1.0 - metallic);
@@ -264,9 +446,18 @@ void main() {
 
     vec3 world_view = normalize(camera_world_position - v_world_position);
     vec3 ibl_r = reflect(-world_view, world_normal);
-    vec2 env_brdf = texture2D(brdf_lut, vec2(n_dot_v, perceptual_roughness)).rg;
+    vec3 env_brdf = texture2D(brdf_lut, vec2(n_dot_v, perceptual_roughness)).rgb;
     vec3 ibl_spec_color = textureCubeLod(filtered_env_map, ibl_r, perceptual_roughness * max_reflection_lod).rgb;
     vec3 ibl_spec = ibl_spec_color * (ibl_f * env_brdf.x + env_brdf.y);
+#ifdef ENABLE_MULTISCATTER
+    // Energy compensation for multiple scattering (Kulla and Conty 2017), the
+    // blue channel of the LUT stores the average albedo for this roughness
+    float e_ss = env_brdf.x + env_brdf.y;
+    float e_avg = env_brdf.z;
+    vec3 f_avg = spec_color + (1.0 - spec_color) / 21.0;
+    vec3 f_ms = f_avg * f_avg * e_avg / (1.0 - f_avg * (1.0 - e_avg));
+    ibl_spec += ibl_spec_color * f_ms * (1.0 - e_ss);
+#endif
     color.rgb += (ibl_kd * ibl_diff  + ibl_spec) * ambient_occlusion;
 
     // Indirect diffuse (ambient light)
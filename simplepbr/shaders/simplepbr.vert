@@ -12,7 +12,9 @@ uniform struct p3d_LightSourceParameters {
     vec3 attenuation;
     vec3 spotDirection;
     float spotCosCutoff;
+#ifndef ENABLE_SHADOW_ATLAS
     sampler2DShadow shadowMap;
+#endif
     mat4 shadowViewMatrix;
 } p3d_LightSource[MAX_LIGHTS];
 #endif
@@ -21,6 +23,16 @@ uniform struct p3d_LightSourceParameters {
 uniform mat4 p3d_TransformTable[100];
 #endif
 
+#ifdef ENABLE_SKINNING_PALETTE
+uniform sampler2D skinning_palette;
+uniform float palette_skinning_enabled;
+uniform float palette_offset;
+#endif
+
+#ifdef ENABLE_INSTANCING
+uniform float instancing_enabled;
+#endif
+
 uniform mat4 p3d_ProjectionMatrix;
 uniform mat4 p3d_ModelViewMatrix;
 uniform mat4 p3d_ViewMatrix;
@@ -38,6 +50,14 @@ attribute vec2 p3d_MultiTexCoord0;
 attribute vec4 transform_weight;
 attribute vec4 transform_index;
 #endif
+#ifdef ENABLE_SKINNING_PALETTE
+attribute vec4 palette_index;
+attribute vec4 palette_weight;
+#endif
+#ifdef ENABLE_INSTANCING
+attribute mat4 instance_matrix;
+attribute vec4 instance_color;
+#endif
 
 
 varying vec3 v_view_position;
@@ -50,6 +70,31 @@ varying mat3 v_world_tbn;
 varying vec4 v_shadow_pos[MAX_LIGHTS];
 #endif
 
+#ifdef ENABLE_SKINNING_PALETTE
+vec4 fetch_palette_column(float joint, int column) {
+    int idx = int(palette_offset + joint + 0.5);
+    ivec2 coord = ivec2(
+        (idx % PALETTE_JOINTS_PER_ROW) * 3 + column,
+        idx / PALETTE_JOINTS_PER_ROW
+    );
+    return texelFetch(skinning_palette, coord, 0);
+}
+
+mat4 get_palette_matrix() {
+    // Each joint is stored as the three columns of a 3x4 matrix
+    vec4 columns[3];
+    for (int i = 0; i < 3; ++i) {
+        columns[i] = (
+            fetch_palette_column(palette_index.x, i) * palette_weight.x +
+            fetch_palette_column(palette_index.y, i) * palette_weight.y +
+            fetch_palette_column(palette_index.z, i) * palette_weight.z +
+            fetch_palette_column(palette_index.w, i) * palette_weight.w
+        );
+    }
+    return transpose(mat4(columns[0], columns[1], columns[2], vec4(0.0, 0.0, 0.0, 1.0)));
+}
+#endif
+
 void main() {
 #ifdef ENABLE_SKINNING
     mat4 skin_matrix = (
@@ -66,11 +111,30 @@ void main() {
     vec4 model_position = p3d_Vertex;
     vec3 model_normal = p3d_Normal;
     vec3 model_tangent = p3d_Tangent.xyz;
+#endif
+#ifdef ENABLE_SKINNING_PALETTE
+    if (palette_skinning_enabled > 0.5) {
+        mat4 palette_matrix = get_palette_matrix();
+        model_position = palette_matrix * p3d_Vertex;
+        mat3 palette_matrix3 = mat3(palette_matrix);
+        model_normal = palette_matrix3 * p3d_Normal;
+        model_tangent = palette_matrix3 * p3d_Tangent.xyz;
+    }
+#endif
+    vec4 vertex_color = p3d_Color;
+#ifdef ENABLE_INSTANCING
+    if (instancing_enabled > 0.5) {
+        model_position = instance_matrix * model_position;
+        mat3 instance_matrix3 = mat3(instance_matrix);
+        model_normal = instance_matrix3 * model_normal;
+        model_tangent = instance_matrix3 * model_tangent;
+        vertex_color *= instance_color;
+    }
 #endif
     vec4 view_position = p3d_ModelViewMatrix * model_position;
     v_view_position = (view_position).xyz;
     v_world_position = (p3d_ModelMatrix * model_position).xyz;
-    v_color = p3d_Color;
+    v_color = vertex_color;
     v_texcoord = (p3d_TextureMatrix * vec4(p3d_MultiTexCoord0, 0, 1)).xy;
 #ifdef ENABLE_SHADOWS
     for (int i = 0; i < p3d_LightSource.length(); ++i) {
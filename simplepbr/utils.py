@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import array
+from collections.abc import Sequence
 import math
 
 import panda3d.core as p3d
@@ -7,6 +9,19 @@ import panda3d.core as p3d
 from direct.showbase.ShowBase import ShowBase
 
 from . import _shaderutils as shaderutils
+from ._shaderutils import (
+    clear_shader_cache,
+    get_shader_cache_stats,
+)
+
+__all__ = [
+    'clear_shader_cache',
+    'get_shader_cache_stats',
+    'load_sdr_lut',
+    'make_instanced',
+    'make_skybox',
+    'sdr_lut_screenshot',
+]
 
 def make_skybox(cubemap: p3d.Texture) -> p3d.NodePath[p3d.GeomNode]:
     verts = [
@@ -53,6 +68,87 @@ def make_skybox(cubemap: p3d.Texture) -> p3d.NodePath[p3d.GeomNode]:
     return np
 
 
+def _get_instance_array_format() -> p3d.GeomVertexArrayFormat:
+    array_format = p3d.GeomVertexArrayFormat()
+    array_format.add_column(
+        p3d.InternalName.make('instance_matrix'),
+        4,
+        p3d.Geom.NT_float32,
+        p3d.Geom.C_matrix,
+    )
+    array_format.add_column(
+        p3d.InternalName.make('instance_color'),
+        4,
+        p3d.Geom.NT_float32,
+        p3d.Geom.C_color,
+    )
+    array_format.set_divisor(1)
+    return p3d.GeomVertexArrayFormat.register_format(array_format)
+
+
+def make_instanced(
+    nodepath: p3d.NodePath[p3d.PandaNode],
+    transforms: Sequence[p3d.LMatrix4],
+    colors: Sequence[p3d.LColor] | None = None,
+) -> None:
+    '''Draw the geometry under nodepath once per transform with hardware instancing
+
+    Transforms are in nodepath's coordinate space, and colors (if given) multiply the vertex
+    colors of each instance. This replaces any instances from a previous call. Requires the
+    Pipeline's enable_instancing option, and instances are culled as a whole by the bounds of
+    all of them.
+    '''
+    if colors is not None and len(colors) != len(transforms):
+        raise ValueError('colors must have one entry per transform')
+
+    array_format = _get_instance_array_format()
+    instance_matrix = p3d.InternalName.make('instance_matrix')
+    if colors is None:
+        colors = [p3d.LColor(1, 1, 1, 1)] * len(transforms)
+
+    for geomnp in nodepath.find_all_matches('**/+GeomNode'):
+        # Instance transforms apply in the space of each GeomNode
+        to_root = geomnp.get_mat(nodepath)
+        from_root = p3d.LMatrix4(to_root)
+        from_root.invert_in_place()
+        matrices = [to_root * mat * from_root for mat in transforms]
+
+        values = array.array('f')
+        for mat, color in zip(matrices, colors):
+            values.extend(value for row in mat for value in row)
+            values.extend(color)
+        instance_data = p3d.GeomVertexArrayData(array_format, p3d.Geom.UH_static)
+        instance_data.modify_handle().copy_data_from(values)
+
+        geomnode = geomnp.node()
+        local_bounds = p3d.BoundingSphere()
+        for idx in range(geomnode.get_num_geoms()):
+            geom = geomnode.modify_geom(idx)
+            local_bounds.extend_by(geom.get_bounds())
+            vdata = geom.modify_vertex_data()
+            array_index = vdata.format.get_array_with(instance_matrix)
+            if array_index < 0:
+                vformat = p3d.GeomVertexFormat(vdata.format)
+                array_index = vformat.add_array(array_format)
+                vdata.set_format(p3d.GeomVertexFormat.register_format(vformat))
+            vdata.set_array(array_index, instance_data)
+
+        if local_bounds.is_empty() or not matrices:
+            continue
+        center = local_bounds.get_center()
+        radius = local_bounds.get_radius()
+        bounds = p3d.BoundingBox()
+        for mat in matrices:
+            scale = max(mat.get_row3(i).length() for i in range(3))
+            offset = p3d.LVector3(radius * scale)
+            instance_center = mat.xform_point(center)
+            bounds.extend_by(p3d.BoundingBox(instance_center - offset, instance_center + offset))
+        geomnode.set_bounds(bounds)
+
+    nodepath.set_instance_count(len(transforms))
+    nodepath.set_shader_input('instancing_enabled', 1.0)
+
+
 def load_sdr_lut(filename: str) -> p3d.Texture:
     '''Load an SDR color LUT embedded in a screenshot'''
     path = p3d.Filename(filename)
@@ -19,3 +19,5 @@ def showbase(request):
     showbase = ShowBase()
     yield showbase
     showbase.destroy()
+    # Pipelines have no teardown, keep their update tasks from running in later tests
+    showbase.task_mgr.removeTasksMatching('simplepbr*')
@@ -0,0 +1,209 @@
+import array
+import math
+
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _clustering as clustering
+
+
+GRID = (4, 3, 8)
+
+
+@pytest.fixture
+def lens():
+    lens = p3d.PerspectiveLens()
+    lens.set_fov(90)
+    lens.set_near_far(1.0, 100.0)
+    return lens
+
+
+def get_clusters(cluster_values, index_values):
+    offsets_counts = array.array('f', cluster_values)
+    indices = array.array('f', index_values)
+    clusters = []
+    for idx in range(0, len(offsets_counts), 2):
+        offset, count = int(offsets_counts[idx]), int(offsets_counts[idx + 1])
+        clusters.append(sorted(int(i) for i in indices[offset:offset + count]))
+    return clusters
+
+
+def test_light_radius():
+    light = p3d.PointLight('light')
+    light.attenuation = (1, 0, 1)
+    assert clustering.get_light_radius(light) == pytest.approx(math.sqrt(255))
+
+    light.max_distance = 5
+    assert clustering.get_light_radius(light) == 5
+
+    light = p3d.PointLight('light')
+    assert clustering.get_light_radius(light) == math.inf
+
+    light.color = (0, 0, 0, 1)
+    assert clustering.get_light_radius(light) == 0
+
+
+def test_spot_bounds():
+    position = p3d.LVecBase3(0, 0, 0)
+    forward = p3d.LVecBase3(0, 1, 0)
+    for cos_cutoff in (0.2, 0.9):
+        center, radius = clustering.get_spot_bounds(position, forward, 10, cos_cutoff)
+        sin_cutoff = math.sqrt(1 - cos_cutoff ** 2)
+        rim = p3d.LVecBase3(10 * sin_cutoff, 10 * cos_cutoff, 0)
+        for point in (position, rim, forward * 10):
+            assert (point - center).length() <= radius + 1e-4
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_bin_lights(lens, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(clustering, 'np', None)
+
+    spheres = [
+        (0, 10, 0, 1), # In front of the camera
+        (0, -10, 0, 1), # Behind the camera
+        (0, 0.5, 0, 2), # Crosses the near plane
+        (200, 10, 0, 1), # Off to the side
+        (-9, 10, 0, 1), # Near the left edge
+    ]
+    visible, cluster_values, index_values = clustering.bin_lights(
+        spheres,
+        lens.get_projection_mat(),
+        lens.near,
+        lens.far,
+        GRID,
+    )
+    assert visible == [0, 2, 4]
+
+    clusters = get_clusters(cluster_values, index_values)
+    assert len(clusters) == GRID[0] * GRID[1] * GRID[2]
+    lights_per_cluster = [sum(i in lights for lights in clusters) for i in range(3)]
+
+    # The light crossing the near plane covers every tile of the nearest slices
+    assert lights_per_cluster[1] >= GRID[0] * GRID[1]
+    assert 0 < lights_per_cluster[0] < lights_per_cluster[1]
+
+    def cluster_index(column, row, depth_slice):
+        return (depth_slice * GRID[1] + row) * GRID[0] + column
+    scale, bias = clustering.get_depth_slice_params(lens.near, lens.far, GRID[2])
+    depth_slice = math.floor(math.log(10) * scale + bias)
+    assert 0 in clusters[cluster_index(1, 1, depth_slice)]
+    assert 2 in clusters[cluster_index(0, 1, depth_slice)]
+    assert 2 not in clusters[cluster_index(3, 1, depth_slice)]
+
+
+def test_bin_lights_numpy_matches_python(lens, monkeypatch):
+    pytest.importorskip('numpy')
+    spheres = [
+        (x * 3.0, 5.0 + y * 7.0, z * 2.0, 1.0 + (x + y + z) % 4)
+        for x in range(-4, 5)
+        for y in range(8)
+        for z in range(-2, 3)
+    ]
+    args = (spheres, lens.get_projection_mat(), lens.near, lens.far, GRID)
+    np_result = clustering.bin_lights(*args)
+
+    monkeypatch.setattr(clustering, 'np', None)
+    py_result = clustering.bin_lights(*args)
+
+    assert np_result[0] == py_result[0]
+    assert get_clusters(*np_result[1:]) == get_clusters(*py_result[1:])
+
+
+def test_manager_update():
+    render = p3d.NodePath('render')
+    camera = render.attach_new_node(p3d.Camera('camera', p3d.PerspectiveLens()))
+    camera.node().get_lens().set_near_far(1.0, 100.0)
+
+    for idx in range(10):
+        light = p3d.PointLight(f'point{idx}')
+        light.attenuation = (1, 0, 1)
+        lightnp = render.attach_new_node(light)
+        lightnp.set_pos(idx * 2 - 10, 20, 0)
+        render.set_light(lightnp)
+
+    spotlight = p3d.Spotlight('spot')
+    spotlight.attenuation = (1, 0, 1)
+    spotnp = render.attach_new_node(spotlight)
+    spotnp.set_pos(0, 30, 5)
+    render.set_light(spotnp)
+
+    # Only point lights and spotlights are clustered
+    sun = render.attach_new_node(p3d.DirectionalLight('sun'))
+    render.set_light(sun)
+    behind = p3d.PointLight('behind')
+    behind.attenuation = (1, 0, 1)
+    behindnp = render.attach_new_node(behind)
+    behindnp.set_pos(0, -50, 0)
+    render.set_light(behindnp)
+
+    manager = clustering.ClusteredLightManager()
+    manager.apply(render)
+    manager.update(render, camera)
+    assert manager.stats()['lights'] == 11
+    assert manager.light_data.y_size == 11
+
+    # Light positions are stored in the shader's (Y-up) view space
+    peeker = manager.light_data.peek()
+    positions = []
+    for row in range(manager.light_data.y_size):
+        position = p3d.LVecBase4()
+        peeker.fetch_pixel(position, 0, row)
+        positions.append(tuple(round(i, 3) for i in position))
+    assert (-10, 0, -20, round(math.sqrt(255), 3)) in positions
+    assert (0, 5, -30, round(math.sqrt(255), 3)) in positions
+
+    num_indices = manager.stats()['indices']
+    rows = math.ceil(num_indices / clustering.INDEX_TEXTURE_WIDTH)
+    assert manager.light_indices.y_size == rows
+
+    render.clear_light()
+    manager.update(render, camera)
+    assert manager.stats() == {'lights': 0, 'indices': 0}
+
+
+def get_enabled_input(nodepath):
+    attrib = nodepath.get_net_state().get_attrib(p3d.ShaderAttrib)
+    return attrib.get_shader_input_vector('clustered_lights_enabled')[0]
+
+
+def test_manager_node_states():
+    render = p3d.NodePath('render')
+    camera = render.attach_new_node(p3d.Camera('camera', p3d.PerspectiveLens()))
+    lamp = render.attach_new_node(p3d.PointLight('lamp'))
+    render.set_light(lamp)
+    caster = p3d.Spotlight('caster')
+    caster.set_shadow_caster(True)
+    casternp = render.attach_new_node(caster)
+    casternp.set_pos(0, 10, 0)
+    render.set_light(casternp)
+
+    lit = render.attach_new_node('lit')
+    dark = render.attach_new_node('dark')
+    dark.set_light_off()
+    child = dark.attach_new_node('child')
+
+    manager = clustering.ClusteredLightManager(max_lights=4)
+    manager.apply(render)
+    manager.update(render, camera)
+
+    # Shadow casters are left to the regular light loop
+    assert manager.stats()['lights'] == 1
+    assert tuple(manager.shadow_lights[0]) == pytest.approx((0, 0, -10, 1))
+    assert tuple(manager.shadow_lights[1]) == (0, 0, 0, 0)
+
+    assert get_enabled_input(lit) == 1
+    assert get_enabled_input(child) == 0
+
+    dark.clear_light()
+    manager.update(render, camera)
+    assert get_enabled_input(child) == 1
+
+    lit.set_light_off(lamp)
+    manager.update(render, camera)
+    assert get_enabled_input(lit) == 0
+
+    manager.clear()
+    assert get_enabled_input(lit) == 1
@@ -2,8 +2,10 @@ import os
 import time
 
 import panda3d.core as p3d
+import pytest
 
 import simplepbr
+from simplepbr.envmap import get_progressive_stages
 
 
 ASSETDIR = p3d.Filename.from_os_specific(
@@ -18,6 +20,17 @@ def test_envmap_bam_read():
     assert envmap.sh_coefficients[0] != p3d.LVector3(0, 0, 0)
 
 
+def test_envmap_footprint():
+    envmap = simplepbr.EnvMap.from_file_path(ASSETDIR / 'hdri' / 'cubemap.env')
+    footprint = envmap.footprint
+    assert footprint >= envmap.cubemap.get_ram_image_size()
+
+    # Textures only kept in graphics memory still count
+    envmap.cubemap.clear_ram_image()
+    envmap.filtered_env_map.clear_ram_image()
+    assert envmap.footprint == footprint
+
+
 def test_envmap_bam_write(tmpdir):
     envmap = simplepbr.EnvMap.create_empty()
     while not envmap.is_prepared.done():
@@ -27,3 +40,70 @@ def test_envmap_bam_write(tmpdir):
     outpath = tmpdir / 'cubemap.env'
     envmap.write(outpath)
     assert os.path.exists(outpath)
+
+
+def test_envmap_prepare_workers():
+    envmap = simplepbr.EnvMap.from_file_path(
+        ASSETDIR / 'hdri' / 'cubemap_#.hdr',
+        prefiltered_size=16,
+        prefiltered_samples=4,
+        blocking_prepare=True,
+        num_workers=2,
+    )
+    while not envmap.is_prepared.done():
+        p3d.AsyncTaskManager.get_global_ptr().poll()
+    assert envmap.sh_coefficients[0] != p3d.LVector3(0, 0, 0)
+    assert envmap.filtered_env_map.num_ram_mipmap_images == 4
+
+
+def test_envmap_prepare_progressive():
+    stages = []
+    envmap = simplepbr.EnvMap.from_file_path(
+        ASSETDIR / 'hdri' / 'cubemap_#.hdr',
+        prefiltered_size=32,
+        prefiltered_samples=4,
+        skip_prepare=True,
+        progressive=True,
+    )
+    envmap.add_refine_callback(lambda env, stage, num_stages: stages.append((stage, num_stages)))
+    envmap.prepare()
+    num_stages = len(get_progressive_stages(envmap.cubemap.x_size, 32, 4))
+    while not envmap.is_prepared.done() or len(stages) < num_stages:
+        p3d.AsyncTaskManager.get_global_ptr().poll()
+        time.sleep(0.01)
+
+    assert num_stages > 1
+    assert stages == [(i, num_stages) for i in range(num_stages)]
+    assert envmap.filtered_env_map.x_size == 32
+    assert envmap.sh_coefficients[0] != p3d.LVector3(0, 0, 0)
+    assert envmap.filtered_env_map.num_ram_mipmap_images == 4
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_envmap_v2_roundtrip(tmpdir, compress):
+    envmap = simplepbr.EnvMap.from_file_path(ASSETDIR / 'hdri' / 'cubemap.env')
+    outpath = p3d.Filename.from_os_specific(str(tmpdir / 'cubemap.env'))
+    envmap.write(outpath, compress=compress)
+
+    loaded = simplepbr.EnvMap.from_file_path(outpath)
+    assert loaded.is_prepared.done()
+    assert loaded.hash == envmap.hash
+    for coeff, expected_coeff in zip(loaded.sh_coefficients, envmap.sh_coefficients):
+        assert tuple(coeff) == pytest.approx(tuple(expected_coeff))
+    assert loaded.cubemap.x_size == envmap.cubemap.x_size
+    filtered = loaded.filtered_env_map
+    assert filtered.component_type == p3d.Texture.T_half_float
+    assert filtered.num_ram_mipmap_images == envmap.filtered_env_map.num_ram_mipmap_images
+
+    peeker = filtered.peek()
+    expected_peeker = envmap.filtered_env_map.peek()
+    color = p3d.LColor()
+    expected = p3d.LColor()
+    peeker.fetch_pixel(color, 3, 5, 2)
+    expected_peeker.fetch_pixel(expected, 3, 5, 2)
+    assert tuple(color) == pytest.approx(tuple(expected), rel=1e-2)
+
+    # The source cube map can be skipped when reading or writing
+    assert simplepbr.EnvMap.from_file_path(outpath, load_source=False).cubemap.x_size == 1
+    envmap.write(outpath, include_source=False)
+    assert simplepbr.EnvMap.from_file_path(outpath).cubemap.x_size == 1
@@ -1,8 +1,17 @@
 import os
+import shutil
+import time
 
 import panda3d.core as p3d
+import pytest
 
 import simplepbr
+from simplepbr import envpool
+from simplepbr.envmap import (
+    get_source_files,
+    hash_source_files,
+    make_cache_key,
+)
 
 
 ASSETDIR = p3d.Filename.from_os_specific(
@@ -15,3 +24,145 @@ def test_envpool_load_str():
     env = pool.load(ASSETDIR / 'hdri' / 'cubemap_#.hdr')
 
     assert env.cubemap
+
+
+def _wait_for_file(path):
+    for _ in range(600):
+        if path.exists():
+            return
+        p3d.AsyncTaskManager.get_global_ptr().poll()
+        time.sleep(0.1)
+    raise TimeoutError(f'{path} was not written')
+
+
+def _wait_for_future(future):
+    for _ in range(600):
+        if future.done():
+            return
+        p3d.AsyncTaskManager.get_global_ptr().poll()
+        time.sleep(0.1)
+    raise TimeoutError('future was not done')
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    path = p3d.Filename.from_os_specific(str(tmp_path))
+    page = p3d.load_prc_file_data('', f'model-cache-dir {path}')
+    yield path
+    p3d.unload_prc_file(page)
+
+
+def test_envmap_hash_stable():
+    path = ASSETDIR / 'hdri' / 'cubemap_#.hdr'
+    env1 = simplepbr.EnvMap.from_file_path(path, skip_prepare=True)
+    env2 = simplepbr.EnvMap.from_file_path(path, skip_prepare=True)
+    env3 = simplepbr.EnvMap.from_file_path(path, prefiltered_samples=8, skip_prepare=True)
+
+    # The key must not depend on per-process string hashing
+    files = get_source_files(env1.cubemap.fullpath)
+    assert env1.hash == make_cache_key(hash_source_files(files), 64, 16)
+    assert env1.hash == env2.hash
+    assert env1.hash != env3.hash
+
+
+def test_envpool_disk_cache_index(cache_dir, monkeypatch):
+    path = ASSETDIR / 'hdri' / 'cubemap_#.hdr'
+    env = simplepbr.EnvPool().load(path, prefiltered_size=16, prefiltered_samples=4)
+    cache_file = cache_dir / f'{env.hash}.env'
+    _wait_for_file(cache_file)
+    assert (cache_dir / envpool.CACHE_INDEX_NAME).exists()
+
+    # A cold start with unchanged sources should not rehash the source images
+    def fail_hash(files):
+        raise AssertionError('source files were rehashed')
+    monkeypatch.setattr(envpool, 'hash_source_files', fail_hash)
+    pool = simplepbr.EnvPool()
+    cached = pool.load(path, prefiltered_size=16, prefiltered_samples=4)
+    assert cached.is_prepared.done()
+    assert cached.hash == env.hash
+
+    # A changed timestamp forces a rehash
+    monkeypatch.undo()
+    rehashed = []
+    def count_hash(files):
+        rehashed.append(files)
+        return hash_source_files(files)
+    monkeypatch.setattr(envpool, 'hash_source_files', count_hash)
+    index = pool._read_index() # pylint:disable=protected-access
+    for entry in index.values():
+        entry['files'][0][1] -= 1
+    assert pool.get_source_digest(path) == env.source_digest
+    assert len(rehashed) == 1
+
+
+def test_envpool_lru_eviction(tmp_path):
+    paths = []
+    for name in 'abcd':
+        path = tmp_path / f'{name}.env'
+        shutil.copyfile((ASSETDIR / 'hdri' / 'cubemap.env').to_os_specific(), path)
+        paths.append(p3d.Filename.from_os_specific(str(path)))
+
+    footprint = simplepbr.EnvMap.from_file_path(paths[0]).footprint
+    assert footprint > 0
+    pool = simplepbr.EnvPool(budget=footprint * 2)
+
+    env_a = pool.load(paths[0])
+    pool.acquire(env_a)
+    pool.load(paths[1])
+    assert pool.load(paths[0]) is env_a
+    pool.load(paths[2])
+
+    # a is pinned, so b is the least recently used map that can be evicted
+    stats = pool.stats()
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 2
+    assert stats['hits'] == 1
+    assert stats['misses'] == 3
+    assert pool.load(paths[0]) is env_a
+
+    pool.release(env_a)
+    pool.load(paths[3])
+    assert pool.stats()['evictions'] == 2
+    assert pool.footprint <= pool.budget
+
+
+def test_envpool_load_async(tmp_path):
+    path = tmp_path / 'async.env'
+    shutil.copyfile((ASSETDIR / 'hdri' / 'cubemap.env').to_os_specific(), path)
+
+    pool = simplepbr.EnvPool()
+    future = pool.load_async(str(path))
+    assert pool.load_async(str(path)) is future
+
+    _wait_for_future(future)
+    envmap = future.result()
+    assert envmap.sh_coefficients[0] != p3d.LVector3(0, 0, 0)
+    assert pool.load(str(path)) is envmap
+    assert pool.load_async(str(path)).result() is envmap
+    stats = pool.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 2
+
+
+def test_envpool_load_while_pending(tmp_path, monkeypatch):
+    path = tmp_path / 'pending.env'
+    shutil.copyfile((ASSETDIR / 'hdri' / 'cubemap.env').to_os_specific(), path)
+
+    pool = simplepbr.EnvPool()
+    load_envmap = pool._load_envmap
+    calls = []
+
+    def slow_load_envmap(*args, **kwargs):
+        calls.append(args[0])
+        time.sleep(0.2)
+        return load_envmap(*args, **kwargs)
+
+    monkeypatch.setattr(pool, '_load_envmap', slow_load_envmap)
+    future = pool.load_async(str(path))
+    envmap = pool.load(str(path))
+    assert future.done()
+    assert future.result() is envmap
+    assert len(calls) == 1
+    stats = pool.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
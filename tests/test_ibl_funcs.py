@@ -0,0 +1,158 @@
+import os
+
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _ibl_funcs_cpu as iblfuncs
+
+
+ASSETDIR = p3d.Filename.from_os_specific(
+    os.path.join(os.path.dirname(__file__), 'assets')
+)
+
+
+@pytest.fixture
+def cubemap():
+    return p3d.TexturePool.load_cube_map(ASSETDIR / 'hdri' / 'cubemap_#.hdr')
+
+
+def test_sh_coeffs_numpy_matches_python(cubemap, monkeypatch):
+    pytest.importorskip('numpy')
+    assert iblfuncs.iblfuncs_np is not None
+    assert iblfuncs.iblfuncs_np.supports_texture(cubemap)
+    np_coeffs = iblfuncs.get_sh_coeffs_from_cube_map(cubemap)
+
+    monkeypatch.setattr(iblfuncs, 'iblfuncs_np', None)
+    py_coeffs = iblfuncs.get_sh_coeffs_from_cube_map(cubemap)
+
+    for np_coeff, py_coeff in zip(np_coeffs, py_coeffs):
+        assert tuple(np_coeff) == pytest.approx(tuple(py_coeff), rel=1e-4, abs=1e-6)
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_sh_coeffs_stride(cubemap, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(iblfuncs, 'iblfuncs_np', None)
+    full_coeffs = iblfuncs.get_sh_coeffs_from_cube_map(cubemap)
+    coarse_coeffs = iblfuncs.get_sh_coeffs_from_cube_map(cubemap, stride=2)
+
+    # A coarse projection should still be close for the low frequency DC term
+    assert tuple(coarse_coeffs[0]) == pytest.approx(tuple(full_coeffs[0]), rel=0.1)
+    assert coarse_coeffs != full_coeffs
+
+
+def _make_gradient_cube_map(dim):
+    np = pytest.importorskip('numpy')
+    from simplepbr import _ibl_funcs_np as iblfuncs_np # pylint:disable=import-outside-toplevel
+
+    vecs = iblfuncs_np.calc_vectors(dim)
+    vecs /= np.linalg.norm(vecs, axis=-1, keepdims=True)
+    texture = p3d.Texture('gradient')
+    texture.setup_cube_map(dim, p3d.Texture.T_float, p3d.Texture.F_rgb32)
+    texture.set_ram_image((vecs * 0.5 + 0.5)[..., ::-1].astype(np.float32).tobytes())
+    return texture
+
+
+def _get_mip_arrays(texture):
+    np = pytest.importorskip('numpy')
+    return [
+        np.frombuffer(memoryview(texture.get_ram_mipmap_image(i)), dtype=np.float32)
+        for i in range(texture.num_ram_mipmap_images)
+    ]
+
+
+def test_filter_env_map_numpy_constant():
+    np = pytest.importorskip('numpy')
+    texture = p3d.Texture('constant')
+    texture.setup_cube_map(16, p3d.Texture.T_float, p3d.Texture.F_rgb32)
+    texture.set_ram_image(np.full((6, 16, 16, 3), 0.25, dtype=np.float32).tobytes())
+
+    filtered = p3d.Texture()
+    iblfuncs.filter_env_map(texture, filtered, size=16, num_samples=16)
+
+    assert filtered.num_ram_mipmap_images == 4
+    for mip in _get_mip_arrays(filtered):
+        assert np.allclose(mip, 0.25)
+
+
+def test_filter_env_map_numpy_matches_python(monkeypatch):
+    np = pytest.importorskip('numpy')
+    texture = _make_gradient_cube_map(16)
+
+    np_filtered = p3d.Texture()
+    iblfuncs.filter_env_map(texture, np_filtered, size=16, num_samples=8)
+
+    monkeypatch.setattr(iblfuncs, 'iblfuncs_np', None)
+    py_filtered = p3d.Texture()
+    iblfuncs.filter_env_map(texture, py_filtered, size=16, num_samples=8)
+
+    # The NumPy path uses bilinear filtering while TexturePeeker.lookup() does not
+    for np_mip, py_mip in zip(_get_mip_arrays(np_filtered), _get_mip_arrays(py_filtered)):
+        assert np.abs(np_mip - py_mip).mean() < 0.02
+
+
+def test_parallel_matches_serial(cubemap):
+    np = pytest.importorskip('numpy')
+    from concurrent.futures import ProcessPoolExecutor # pylint:disable=import-outside-toplevel
+    from simplepbr import _ibl_parallel as iblparallel # pylint:disable=import-outside-toplevel
+
+    serial_coeffs = iblfuncs.get_sh_coeffs_from_cube_map(cubemap)
+    serial_filtered = p3d.Texture()
+    iblfuncs.filter_env_map(cubemap, serial_filtered, size=16, num_samples=8)
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        parallel_coeffs = iblparallel.get_sh_coeffs_from_cube_map(cubemap, executor)
+        parallel_filtered = p3d.Texture()
+        iblparallel.filter_env_map(
+            cubemap,
+            parallel_filtered,
+            executor,
+            size=16,
+            num_samples=8,
+        )
+
+    for parallel_coeff, serial_coeff in zip(parallel_coeffs, serial_coeffs):
+        assert tuple(parallel_coeff) == pytest.approx(tuple(serial_coeff), rel=1e-4, abs=1e-6)
+
+    serial_mips = _get_mip_arrays(serial_filtered)
+    parallel_mips = _get_mip_arrays(parallel_filtered)
+    assert len(parallel_mips) == len(serial_mips)
+    for parallel_mip, serial_mip in zip(parallel_mips, serial_mips):
+        assert np.allclose(parallel_mip, serial_mip)
+
+
+def test_gen_brdf_lut_numpy_matches_python(monkeypatch):
+    np = pytest.importorskip('numpy')
+
+    progress = []
+    np_lut = iblfuncs.gen_brdf_lut(
+        8,
+        num_samples=16,
+        progress_cb=lambda *args: progress.append(args),
+    )
+    assert progress[-1] == (8, 8)
+
+    monkeypatch.setattr(iblfuncs, 'iblfuncs_np', None)
+    py_lut = iblfuncs.gen_brdf_lut(8, num_samples=16)
+
+    np_data = np.frombuffer(memoryview(np_lut.get_ram_image()), dtype=np.float32)
+    py_data = np.frombuffer(memoryview(py_lut.get_ram_image()), dtype=np.float32)
+    assert np.allclose(np_data, py_data, atol=1e-5)
+
+
+def test_gen_brdf_lut_multiscatter():
+    lut = iblfuncs.gen_brdf_lut(8, num_samples=16, multiscatter=True)
+    assert lut.num_components == 3
+
+    peeker = lut.peek()
+    color = p3d.LColor()
+    albedo_avgs = []
+    for ycoord in range(8):
+        peeker.fetch_pixel(color, 0, ycoord)
+        albedo_avgs.append(color.z)
+
+    assert albedo_avgs[0] == pytest.approx(1.0)
+    assert all(0.0 < albedo_avg <= 1.0 for albedo_avg in albedo_avgs)
+    assert albedo_avgs == sorted(albedo_avgs, reverse=True)
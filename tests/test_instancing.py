@@ -0,0 +1,50 @@
+import array
+
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import utils
+
+
+@pytest.fixture
+def prop():
+    root = p3d.NodePath('root')
+    model = p3d.Loader.get_global_ptr().load_sync('models/box')
+    return root.attach_new_node(model)
+
+
+def get_instance_data(prop):
+    vdata = prop.find('**/+GeomNode').node().get_geom(0).get_vertex_data()
+    array_index = vdata.format.get_array_with('instance_matrix')
+    values = array.array('f')
+    values.frombytes(bytes(memoryview(vdata.get_array(array_index))))
+    return vdata, array_index, values
+
+
+def test_make_instanced(prop):
+    transforms = [p3d.LMatrix4.translate_mat(idx * 10, 0, 0) for idx in range(3)]
+    colors = [p3d.LColor(1, 0, 0, 1)] * 3
+    utils.make_instanced(prop, transforms, colors)
+
+    vdata, array_index, values = get_instance_data(prop)
+    assert vdata.format.get_array(array_index).divisor == 1
+    assert vdata.get_array(array_index).get_num_rows() == 3
+    assert list(values[52:56]) == [20, 0, 0, 1]
+    assert list(values[56:60]) == [1, 0, 0, 1]
+    assert prop.get_instance_count() == 3
+
+    bounds = prop.find('**/+GeomNode').node().get_bounds()
+    assert bounds.contains(p3d.LPoint3(0.5, 0.5, 0.5))
+    assert bounds.contains(p3d.LPoint3(20.5, 0.5, 0.5))
+
+    # Calling again replaces the instances
+    num_arrays = vdata.get_num_arrays()
+    utils.make_instanced(prop, transforms[:2])
+    vdata, array_index, values = get_instance_data(prop)
+    assert vdata.get_num_arrays() == num_arrays
+    assert vdata.get_array(array_index).get_num_rows() == 2
+    assert list(values[36:40]) == [1, 1, 1, 1]
+    assert prop.get_instance_count() == 2
+
+    with pytest.raises(ValueError):
+        utils.make_instanced(prop, transforms, colors[:1])
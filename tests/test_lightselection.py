@@ -0,0 +1,115 @@
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _lightselection as lightselection
+
+
+def make_point_light(render, name, pos):
+    light = p3d.PointLight(name)
+    light.attenuation = (1, 0, 1)
+    lightnp = render.attach_new_node(light)
+    lightnp.set_pos(pos)
+    render.set_light(lightnp)
+    return lightnp
+
+
+def make_object(render, name, pos):
+    cardmaker = p3d.CardMaker(name)
+    cardmaker.set_frame(-0.5, 0.5, -0.5, 0.5)
+    nodepath = render.attach_new_node(cardmaker.generate())
+    nodepath.set_pos(pos)
+    return nodepath
+
+
+def get_net_lights(nodepath):
+    attrib = nodepath.get_net_state().get_attrib(p3d.LightAttrib)
+    return {i.name for i in attrib.get_on_lights()}
+
+
+@pytest.fixture
+def render():
+    return p3d.NodePath('render')
+
+
+def test_influence(render):
+    point = make_point_light(render, 'point', (0, 0, 0))
+    info = lightselection.get_light_info(point, render)
+    near = lightselection.get_influence(info, p3d.LPoint3(2, 0, 0), 1)
+    far = lightselection.get_influence(info, p3d.LPoint3(5, 0, 0), 1)
+    assert near == pytest.approx(0.5)
+    assert 0 < far < near
+    assert lightselection.get_influence(info, p3d.LPoint3(100, 0, 0), 1) == 0
+
+    spotlight = p3d.Spotlight('spot')
+    spotlight.attenuation = (1, 0, 1)
+    spotlight.get_lens().set_fov(30)
+    spotnp = render.attach_new_node(spotlight)
+    info = lightselection.get_light_info(spotnp, render)
+    assert lightselection.get_influence(info, p3d.LPoint3(0, 5, 0), 1) > 0
+    assert lightselection.get_influence(info, p3d.LPoint3(0, -5, 0), 1) == 0
+    assert lightselection.get_influence(info, p3d.LPoint3(5, 5, 0), 1) == 0
+
+
+def test_select_lights(render):
+    for idx in range(6):
+        make_point_light(render, f'light{idx}', (idx * 4, 0, 0))
+    sun = render.attach_new_node(p3d.DirectionalLight('sun'))
+    render.set_light(sun)
+    ambient = render.attach_new_node(p3d.AmbientLight('ambient'))
+    render.set_light(ambient)
+
+    left = make_object(render, 'left', (1, 0, 0))
+    right = make_object(render, 'right', (19, 0, 0))
+    custom = make_object(render, 'custom', (10, 0, 0))
+    custom.set_light_off()
+
+    selector = lightselection.LightSelector()
+    selector.update(render, 3)
+    assert get_net_lights(left) == {'sun', 'ambient', 'light0', 'light1'}
+    assert get_net_lights(right) == {'sun', 'ambient', 'light5', 'light4'}
+    assert get_net_lights(custom) == set()
+    assert selector.stats() == {'objects': 2, 'rankings': 2}
+
+    # Rankings are cached until objects or lights change
+    selector.update(render, 3)
+    assert selector.stats()['rankings'] == 2
+
+    left.set_x(9)
+    selector.update(render, 3)
+    assert selector.stats()['rankings'] == 3
+    assert get_net_lights(left) == {'sun', 'ambient', 'light2', 'light3'}
+
+    render.find('light5').set_x(40)
+    selector.update(render, 3)
+    assert selector.stats()['rankings'] == 5
+    assert get_net_lights(right) == {'sun', 'ambient', 'light4', 'light3'}
+
+    selector.clear()
+    assert not left.has_attrib(p3d.LightAttrib)
+    assert not right.has_attrib(p3d.LightAttrib)
+    assert custom.has_attrib(p3d.LightAttrib)
+
+
+def test_select_lights_ancestor_state(render):
+    sun = render.attach_new_node(p3d.DirectionalLight('sun'))
+    render.set_light(sun)
+    model = render.attach_new_node('model')
+    lamp = make_point_light(model, 'lamp', (0, 0, 0))
+    render.clear_light(lamp)
+    model.set_light_off(sun)
+    model.set_light(lamp)
+    card = make_object(model, 'card', (1, 0, 0))
+    other = make_object(render, 'other', (1, 0, 0))
+
+    selector = lightselection.LightSelector()
+    selector.update(render, 3)
+    assert get_net_lights(card) == {'lamp'}
+    assert get_net_lights(other) == {'sun'}
+
+    model.set_light_off()
+    selector.update(render, 3)
+    assert get_net_lights(card) == set()
+
+    model.clear_light()
+    selector.update(render, 3)
+    assert get_net_lights(card) == {'sun'}
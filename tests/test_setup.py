@@ -1,9 +1,15 @@
+import os
+import shutil
+
 import pytest #pylint:disable=wrong-import-order
 
 import panda3d.core as p3d
 
 import simplepbr
 
+
+ASSETDIR = os.path.join(os.path.dirname(__file__), 'assets')
+
 def test_setup_defaults(showbase):
     simplepbr.init(
         render_node=showbase.render,
@@ -61,3 +67,431 @@ def test_setup(showbase,
     )
 
     pipeline.verify_shaders()
+
+
+@pytest.mark.parametrize('showbase', ['', 'gl-version 3 2'], indirect=True)
+def test_setup_multiscatter(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_multiscatter=True,
+    )
+    pipeline.verify_shaders()
+
+    pipeline.enable_multiscatter = False
+    pipeline.verify_shaders()
+
+
+def test_setup_env_map_async(showbase, tmp_path):
+    path = tmp_path / 'pipeline.env'
+    shutil.copyfile(os.path.join(ASSETDIR, 'hdri', 'cubemap.env'), path)
+
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    empty_map = showbase.render.get_shader_input('filtered_env_map').get_texture()
+
+    # The previous map stays bound until the new one is loaded
+    pipeline.env_map = str(path)
+    future = simplepbr.EnvPool.ptr().load_async(str(path))
+    assert showbase.render.get_shader_input('filtered_env_map').get_texture() == empty_map
+
+    while not future.done():
+        showbase.task_mgr.step()
+    showbase.task_mgr.step()
+    assert (
+        showbase.render.get_shader_input('filtered_env_map').get_texture()
+        == future.result().filtered_env_map
+    )
+
+
+def test_setup_env_map_progressive(showbase):
+    envmap = simplepbr.EnvMap.from_file_path(
+        os.path.join(ASSETDIR, 'hdri', 'cubemap_#.hdr'),
+        prefiltered_size=32,
+        prefiltered_samples=4,
+        progressive=True,
+    )
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        env_map=envmap,
+    )
+
+    while not envmap.is_prepared.done():
+        showbase.task_mgr.step()
+    showbase.task_mgr.step()
+
+    # Each refinement swaps in a new texture which the pipeline rebinds
+    assert (
+        showbase.render.get_shader_input('filtered_env_map').get_texture()
+        == envmap.filtered_env_map
+    )
+    assert pipeline.env_map is envmap
+
+
+def test_setup_precompile_variants(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    progress = []
+    future = pipeline.precompile_variants(
+        [
+            {},
+            {'enable_fog': not pipeline.enable_fog},
+            {'max_lights': 2, 'use_normal_maps': True},
+        ],
+        time_budget=0,
+        progress_cb=lambda done, total: progress.append((done, total)),
+    )
+    while not future.done():
+        showbase.task_mgr.step()
+
+    # The shadow and tonemap shaders are shared between these variants
+    assert future.result() == 5
+    assert progress == [(i, 9) for i in range(1, 10)]
+
+    stats = simplepbr.utils.get_shader_cache_stats()
+    pipeline.enable_fog = not pipeline.enable_fog
+    assert simplepbr.utils.get_shader_cache_stats()['misses'] == stats['misses']
+
+    with pytest.raises(ValueError):
+        pipeline.precompile_variants([{'not_an_option': True}])
+
+
+def test_setup_batch_update(showbase, monkeypatch):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    calls = []
+    recompile_pbr = pipeline._recompile_pbr # pylint:disable=protected-access
+    resetup_tonemap = pipeline._resetup_tonemap # pylint:disable=protected-access
+    monkeypatch.setattr(pipeline, '_recompile_pbr', lambda: calls.append('pbr') or recompile_pbr())
+    monkeypatch.setattr(
+        pipeline,
+        '_resetup_tonemap',
+        lambda: calls.append('tonemap') or resetup_tonemap()
+    )
+
+    with pipeline.batch_update():
+        pipeline.enable_fog = not pipeline.enable_fog
+        pipeline.max_lights = 4
+        pipeline.use_normal_maps = not pipeline.use_normal_maps
+        pipeline.msaa_samples = 0
+        pipeline.sdr_lut_factor = 0.5
+        assert not calls
+    assert calls == ['tonemap', 'pbr']
+
+    calls.clear()
+    pipeline.defer_updates = True
+    pipeline.enable_fog = not pipeline.enable_fog
+    pipeline.max_lights = 2
+    assert not calls
+    showbase.task_mgr.step()
+    assert calls == ['pbr']
+
+
+def test_setup_caster_discovery_cached(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    light = p3d.DirectionalLight('sun')
+    light.set_shadow_caster(True, 64, 64)
+    light_np = showbase.render.attach_new_node(light)
+    showbase.task_mgr.step()
+    scans = pipeline.num_caster_scans
+
+    # No rescans while windows and buffers stay the same
+    for _ in range(5):
+        showbase.task_mgr.step()
+    assert pipeline.num_caster_scans == scans
+
+    # Stand-in for the shadow buffer Panda3D creates for a caster
+    shadow_buffer = showbase.win.make_texture_buffer('shadow', 64, 64)
+    shadow_buffer.make_display_region().camera = light_np
+    # New buffers are only added to the engine when the next frame is rendered
+    showbase.task_mgr.step()
+    showbase.task_mgr.step()
+    assert pipeline.num_caster_scans == scans + 1
+    assert light.get_initial_state().has_attrib(p3d.ShaderAttrib)
+
+    pipeline.invalidate_casters()
+    showbase.task_mgr.step()
+    assert pipeline.num_caster_scans == scans + 2
+    showbase.graphics_engine.remove_window(shadow_buffer)
+
+
+def test_setup_stats(showbase):
+    page = p3d.load_prc_file_data('', 'simplepbr-profile true')
+    try:
+        pipeline = simplepbr.init(
+            render_node=showbase.render,
+            window=showbase.win,
+            camera_node=showbase.cam,
+        )
+        showbase.task_mgr.step()
+        pipeline.max_lights = 3
+    finally:
+        p3d.unload_prc_file(page)
+
+    stats = pipeline.stats()
+    for name in ('update', 'recompile_pbr', 'setup_tonemapping', 'make_shader'):
+        assert stats['profile'][name]['count'] >= 1
+        assert stats['profile'][name]['time'] > 0
+    assert stats['shader_cache']['entries'] > 0
+    assert stats['caster_scans'] == pipeline.num_caster_scans
+
+    # Nothing is recorded once profiling is off again
+    profile = stats['profile']
+    showbase.task_mgr.step()
+    assert pipeline.stats()['profile'] == profile
+
+
+@pytest.mark.parametrize('showbase', ['gl-version 3 2'], indirect=True)
+def test_setup_clustered_lighting(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_clustered_lighting=True,
+    )
+    pipeline.verify_shaders()
+
+    for idx in range(20):
+        light = p3d.PointLight(f'light{idx}')
+        light.attenuation = (1, 0, 1)
+        lightnp = showbase.render.attach_new_node(light)
+        lightnp.set_pos(idx - 10, 20, 0)
+        showbase.render.set_light(lightnp)
+
+    showbase.task_mgr.step()
+    assert pipeline.stats()['clustered_lights']['lights'] == 20
+
+    pipeline.enable_clustered_lighting = False
+    pipeline.verify_shaders()
+    assert pipeline.stats()['clustered_lights'] is None
+
+
+def test_setup_clustered_lighting_requires_330(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_clustered_lighting=True,
+        use_330=False,
+    )
+    pipeline.verify_shaders()
+    assert pipeline.stats()['clustered_lights'] is None
+
+
+def test_setup_light_selection(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        max_lights=2,
+        enable_light_selection=True,
+    )
+
+    for idx in range(4):
+        lightnp = showbase.render.attach_new_node(p3d.PointLight(f'light{idx}'))
+        showbase.render.set_light(lightnp)
+    model = showbase.render.attach_new_node(p3d.GeomNode('model'))
+    model.node().set_bounds(p3d.BoundingSphere((0, 0, 0), 1))
+
+    showbase.task_mgr.step()
+    assert pipeline.stats()['light_selection'] == {'objects': 1, 'rankings': 1}
+    assert len(model.get_attrib(p3d.LightAttrib).get_on_lights()) == 2
+
+    pipeline.enable_light_selection = False
+    assert pipeline.stats()['light_selection'] is None
+    assert not model.has_attrib(p3d.LightAttrib)
+
+
+@pytest.mark.parametrize('showbase', ['', 'gl-version 3 2'], indirect=True)
+def test_setup_cascaded_shadows(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    sun = showbase.render.attach_new_node(p3d.DirectionalLight('sun'))
+    showbase.render.set_light(sun)
+
+    cascades = pipeline.add_cascaded_shadows(sun, num_cascades=3, size=256)
+    pipeline.verify_shaders()
+    showbase.task_mgr.step()
+    assert pipeline.stats()['cascaded_shadows'] == {'cascades': 3, 'renders': [1, 1, 1]}
+    assert cascades.buffer.is_active()
+
+    pipeline.enable_shadows = False
+    pipeline.verify_shaders()
+    showbase.task_mgr.step()
+    assert not cascades.buffer.is_active()
+
+    pipeline.remove_cascaded_shadows()
+    pipeline.verify_shaders()
+    assert pipeline.stats()['cascaded_shadows'] is None
+
+
+@pytest.mark.parametrize('showbase', ['', 'gl-version 3 2'], indirect=True)
+def test_setup_shadow_atlas(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_shadow_atlas=True,
+        shadow_atlas_size=1024,
+    )
+    pipeline.verify_shaders()
+
+    spotlight = showbase.render.attach_new_node(p3d.Spotlight('spot'))
+    spotlight.node().set_shadow_caster(True)
+    showbase.render.set_light(spotlight)
+    showbase.task_mgr.step()
+    assert pipeline.stats()['shadow_atlas'] == {'lights': 1, 'renders': 1}
+
+    pipeline.enable_shadow_atlas = False
+    pipeline.verify_shaders()
+    assert pipeline.stats()['shadow_atlas'] is None
+
+
+def test_setup_point_light_shadows(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    lightnp = showbase.render.attach_new_node(p3d.PointLight('point'))
+    lightnp.node().set_shadow_caster(True)
+    showbase.render.set_light(lightnp)
+
+    # Stand in for a shadow buffer created by Panda3D, point light shadows are only rendered
+    # through the shadow atlas
+    buffer = showbase.win.make_texture_buffer('shadow', 64, 64)
+    dispregion = buffer.make_display_region()
+    dispregion.set_camera(lightnp)
+    showbase.task_mgr.step()
+    showbase.task_mgr.step()
+    assert not pipeline.enable_shadow_atlas
+    assert pipeline.stats()['shadow_atlas'] is None
+    assert not lightnp.node().is_shadow_caster()
+    assert not dispregion.is_active()
+    assert not buffer.is_active()
+
+    pipeline.enable_shadow_atlas = True
+    lightnp.node().set_shadow_caster(True)
+    showbase.task_mgr.step()
+    showbase.task_mgr.step()
+    pipeline.verify_shaders()
+    assert pipeline.stats()['shadow_atlas']['lights'] == 1
+
+
+def test_setup_shadow_update_policy(showbase):
+    configpage = p3d.load_prc_file_data('', 'simplepbr-shadow-update-policy on_change\n')
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+    p3d.ConfigPageManager.get_global_ptr().delete_explicit_page(configpage)
+    assert pipeline.shadow_update_policy == 'on_change'
+
+    # Stand in for a shadow buffer created by Panda3D
+    spotlight = showbase.render.attach_new_node(p3d.Spotlight('spot'))
+    spotlight.node().set_shadow_caster(True)
+    buffer = showbase.win.make_texture_buffer('shadow', 64, 64)
+    dispregion = buffer.make_display_region()
+    dispregion.set_camera(spotlight)
+
+    for _ in range(3):
+        showbase.task_mgr.step()
+    assert not dispregion.is_active()
+    assert not buffer.is_active()
+
+    # Casters in inactive display regions are still found
+    pipeline.invalidate_casters()
+    showbase.task_mgr.step()
+    assert spotlight.node() in pipeline.get_all_casters()
+    assert pipeline.stats()['shadow_updates'] == {'renders': 1, 'skipped': 2}
+
+    pipeline.shadow_update_policy = 'always'
+    showbase.task_mgr.step()
+    assert dispregion.is_active()
+    assert buffer.is_active()
+
+
+@pytest.mark.parametrize('showbase', ['', 'gl-version 3 2'], indirect=True)
+def test_setup_instancing(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+    )
+
+    # Stand in for a shadow buffer created by Panda3D
+    spotlight = showbase.render.attach_new_node(p3d.Spotlight('spot'))
+    spotlight.node().set_shadow_caster(True)
+    buffer = showbase.win.make_texture_buffer('shadow', 64, 64)
+    buffer.make_display_region().set_camera(spotlight)
+    showbase.task_mgr.step()
+    showbase.task_mgr.step()
+    prev_attrib = spotlight.node().get_initial_state().get_attrib(p3d.ShaderAttrib)
+
+    # Existing shadow casters switch to the instancing shadow shader
+    pipeline.enable_instancing = True
+    pipeline.verify_shaders()
+    attrib = spotlight.node().get_initial_state().get_attrib(p3d.ShaderAttrib)
+    assert attrib != prev_attrib
+    assert attrib.get_shader() == pipeline._create_shadow_shader_attrib().get_shader()
+
+
+@pytest.mark.parametrize('showbase', ['gl-version 3 2'], indirect=True)
+def test_setup_skinning_palette(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_skinning_palette=True,
+    )
+    pipeline.verify_shaders()
+
+    # Hidden so that only the palette is updated
+    model = showbase.loader.load_model('models/panda-model')
+    model.reparent_to(showbase.render)
+    model.hide()
+    showbase.task_mgr.step()
+    assert pipeline.stats()['skinning_palette'] == {
+        'characters': 1,
+        'joints': 26,
+        'uploads': 1,
+    }
+    vdata = model.find('**/+GeomNode').node().get_geom(0).get_vertex_data()
+    assert vdata.has_column('palette_index')
+
+    pipeline.enable_skinning_palette = False
+    assert pipeline.stats()['skinning_palette'] is None
+    vdata = model.find('**/+GeomNode').node().get_geom(0).get_vertex_data()
+    assert vdata.has_column('transform_blend')
+
+
+def test_setup_skinning_palette_requires_330(showbase):
+    pipeline = simplepbr.init(
+        render_node=showbase.render,
+        window=showbase.win,
+        camera_node=showbase.cam,
+        enable_skinning_palette=True,
+        use_330=False,
+    )
+    pipeline.verify_shaders()
+    assert pipeline.stats()['skinning_palette'] is None
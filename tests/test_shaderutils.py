@@ -0,0 +1,110 @@
+#pylint:disable=protected-access
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _shaderutils as shaderutils
+from simplepbr import utils
+
+
+def test_make_shader_cache():
+    utils.clear_shader_cache()
+    defines = {
+        'MAX_LIGHTS': 8,
+        'USE_330': False,
+    }
+    shader = shaderutils.make_shader('pbr', 'simplepbr.vert', 'simplepbr.frag', defines)
+
+    # Define order does not matter and the caller's defines are not modified
+    same_shader = shaderutils.make_shader(
+        'pbr',
+        'simplepbr.vert',
+        'simplepbr.frag',
+        {'USE_330': False, 'MAX_LIGHTS': 8},
+    )
+    assert same_shader is shader
+    assert defines == {'MAX_LIGHTS': 8, 'USE_330': False}
+
+    other_shader = shaderutils.make_shader(
+        'pbr',
+        'simplepbr.vert',
+        'simplepbr.frag',
+        {'MAX_LIGHTS': 4, 'USE_330': False},
+    )
+    assert other_shader is not shader
+    assert utils.get_shader_cache_stats() == {'hits': 1, 'misses': 2, 'entries': 2}
+
+    utils.clear_shader_cache()
+    assert utils.get_shader_cache_stats() == {'hits': 0, 'misses': 0, 'entries': 0}
+    assert shaderutils.make_shader(
+        'pbr',
+        'simplepbr.vert',
+        'simplepbr.frag',
+        defines
+    ) is not shader
+
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    path = p3d.Filename.from_os_specific(str(tmp_path))
+    page = p3d.load_prc_file_data(
+        '',
+        f'model-cache-dir {path}\n'
+        'simplepbr-shader-disk-cache true\n'
+    )
+    yield tmp_path
+    p3d.unload_prc_file(page)
+
+
+def test_shader_disk_cache(cache_dir, monkeypatch):
+    shader_cache_dir = cache_dir / shaderutils.SHADER_CACHE_DIR_NAME
+    stale_dir = shader_cache_dir / 'stale-version'
+    stale_dir.mkdir(parents=True)
+    (stale_dir / 'old.glsl').write_text('')
+    (shader_cache_dir / 'notes.txt').write_text('')
+    (cache_dir / 'other-cache').mkdir()
+
+    defines = {'MAX_LIGHTS': 8}
+    expected = shaderutils._load_shader_str('simplepbr.frag', dict(defines))
+    shaderstr = shaderutils.load_cached_shader_str('simplepbr.frag', defines, 'driver a')
+    assert shaderstr == expected
+
+    version_dir = shader_cache_dir / shaderutils.get_package_version()
+    assert len(list(version_dir.glob('*.glsl'))) == 1
+
+    # Only directories of other versions of this cache are pruned
+    assert not stale_dir.exists()
+    assert (shader_cache_dir / 'notes.txt').exists()
+    assert (cache_dir / 'other-cache').exists()
+
+    # Cache hits do not preprocess the source again
+    def fail_load(*args):
+        raise AssertionError('shader source was preprocessed')
+    monkeypatch.setattr(shaderutils, '_load_shader_str', fail_load)
+    assert shaderutils.load_cached_shader_str('simplepbr.frag', defines, 'driver a') == expected
+    monkeypatch.undo()
+
+    # The driver is part of the key
+    shaderutils.load_cached_shader_str('simplepbr.frag', defines, 'driver b')
+    assert len(list(version_dir.glob('*.glsl'))) == 2
+
+
+def test_shader_disk_cache_disabled(cache_dir):
+    page = p3d.load_prc_file_data('', 'simplepbr-shader-disk-cache false')
+    try:
+        shaderutils.load_cached_shader_str('simplepbr.frag', {})
+    finally:
+        p3d.unload_prc_file(page)
+    assert not (cache_dir / shaderutils.SHADER_CACHE_DIR_NAME).exists()
+
+
+def test_shader_disk_cache_no_cache_dir(cache_dir, monkeypatch):
+    # An empty model-cache-dir must not write into the current directory
+    monkeypatch.chdir(cache_dir)
+    page = p3d.load_prc_file_data('', 'model-cache-dir\n')
+    try:
+        assert shaderutils.get_shader_cache_dir() is None
+        shaderutils.load_cached_shader_str('simplepbr.frag', {})
+    finally:
+        p3d.unload_prc_file(page)
+    assert list(cache_dir.iterdir()) == []
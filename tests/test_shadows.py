@@ -0,0 +1,350 @@
+import math
+
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _shadows as shadows
+
+
+def test_cascade_splits():
+    splits = shadows.get_cascade_splits(1.0, 100.0, 4, 0.0)
+    assert splits == pytest.approx([1.0, 25.75, 50.5, 75.25, 100.0])
+
+    splits = shadows.get_cascade_splits(1.0, 100.0, 2, 1.0)
+    assert splits == pytest.approx([1.0, 10.0, 100.0])
+
+
+def test_slice_bounds():
+    tan_sq = 2.0 # 90 degree horizontal and vertical fov
+    for near, far in ((1.0, 5.0), (10.0, 11.0)):
+        center, radius = shadows.get_slice_bounds(near, far, tan_sq)
+        for dist in (near, far):
+            corner_dist = math.sqrt((dist - center) ** 2 + dist * dist * tan_sq)
+            assert corner_dist <= radius + 1e-4
+
+
+def test_cascaded_shadow_map(showbase):
+    render = showbase.render
+    camera = showbase.cam
+    camera.node().get_lens().set_near_far(1.0, 1000.0)
+    sun = render.attach_new_node(p3d.DirectionalLight('sun'))
+    sun.set_hpr(30, -60, 0)
+
+    with pytest.raises(ValueError):
+        shadows.CascadedShadowMap(
+            render.attach_new_node(p3d.PointLight('point')),
+            render,
+            showbase.win,
+            p3d.RenderState.make_empty(),
+        )
+
+    csm = shadows.CascadedShadowMap(
+        sun,
+        render,
+        showbase.win,
+        p3d.RenderState.make_empty(),
+        num_cascades=3,
+        size=512,
+        max_distance=50.0,
+        dynamic_cascades=1,
+    )
+    csm.update(camera)
+    assert csm.stats()['renders'] == [1, 1, 1]
+
+    # Points in a cascade's depth range map into that cascade's tile of the atlas
+    splits = shadows.get_cascade_splits(1.0, 50.0, 3, csm.split_lambda)
+    to_view = p3d.LMatrix4.convert_mat(p3d.CS_default, p3d.CS_yup_right)
+    for idx in range(3):
+        dist = (splits[idx] + splits[idx + 1]) * 0.5
+        view_pos = to_view.xform_point(p3d.LPoint3(0.1 * dist, dist, 0))
+        coords = p3d.LMatrix4(csm.matrices[idx]).xform(p3d.LVecBase4(view_pos, 1))
+        assert idx / 3 < coords.x < (idx + 1) / 3
+        assert 0 < coords.y < 1
+        assert 0 < coords.z < 1
+
+    # Distant cascades are only re-rendered once they have moved
+    camera.set_x(0.001)
+    csm.update(camera)
+    assert csm.stats()['renders'] == [2, 1, 1]
+    assert not csm.display_regions[2].is_active()
+
+    camera.set_x(20)
+    csm.update(camera)
+    assert csm.stats()['renders'] == [3, 2, 2]
+
+    csm.invalidate()
+    csm.update(camera)
+    assert csm.stats()['renders'] == [4, 3, 3]
+
+    # Casters moving within a still cascade re-render only that cascade
+    dist = (splits[2] + splits[3]) * 0.5
+    caster = render.attach_new_node(p3d.GeomNode('caster'))
+    caster.node().set_bounds(p3d.BoundingSphere((0, 0, 0), 1))
+    caster.set_pos(camera, 0, dist, 0)
+    csm.update(camera)
+    assert csm.stats()['renders'] == [5, 3, 4]
+
+    csm.update(camera)
+    assert csm.stats()['renders'] == [6, 3, 4]
+
+    caster.set_z(caster.get_z() + 1)
+    csm.update(camera)
+    assert csm.stats()['renders'] == [7, 3, 5]
+    caster.remove_node()
+
+    csm.destroy()
+    assert not render.find('**/csm_cascade0')
+
+
+def test_caster_spheres():
+    render = p3d.NodePath('render')
+    groups = [render.attach_new_node(f'group{idx}') for idx in range(3)]
+    casters = []
+    for idx, group in enumerate(groups):
+        group.set_x(idx * 10)
+        for _ in range(4):
+            caster = group.attach_new_node(p3d.GeomNode('caster'))
+            caster.node().set_bounds(p3d.BoundingSphere((0, 0, 0), 1))
+            casters.append(caster)
+
+    caster_spheres = shadows.CasterSpheres()
+    spheres = caster_spheres.update(render)
+    assert len(spheres) == 12
+    assert ((20, 0, 0), 1) in spheres
+    visits = caster_spheres.stats()['visits']
+    version = caster_spheres.version
+
+    # Unchanged scenes are not traversed again
+    assert caster_spheres.update(render) == spheres
+    assert caster_spheres.stats()['visits'] == visits
+    assert caster_spheres.version == version
+
+    # Only the changed path is revisited
+    casters[0].set_z(5)
+    spheres = caster_spheres.update(render)
+    assert ((0, 0, 5), 1) in spheres
+    assert caster_spheres.stats()['visits'] == visits + 3
+    assert caster_spheres.version == version + 1
+
+    # Moving a parent moves the cached spheres of its children
+    groups[2].set_x(100)
+    spheres = caster_spheres.update(render)
+    assert ((100, 0, 0), 1) in spheres
+    assert ((20, 0, 0), 1) not in spheres
+
+    groups[1].remove_node()
+    assert len(caster_spheres.update(render)) == 8
+
+
+def test_allocate_tiles():
+    tiles = shadows.allocate_tiles([256, 512, 256, 256, 256, 256], 1024)
+    assert tiles[1] == (0, 0, 512)
+    assert all(tile is not None and tile[2] == 256 for idx, tile in enumerate(tiles) if idx != 1)
+    assert len(set(tiles)) == len(tiles)
+
+    # Lights that do not fit are left without a tile
+    tiles = shadows.allocate_tiles([256, 512, 512, 512, 512], 1024)
+    assert tiles[0] is None
+    assert all(tile is not None for tile in tiles[1:])
+
+    # Reserved tiles are packed around
+    reserved = [(512, 0, 512), (0, 256, 256)]
+    tiles = shadows.allocate_tiles([512, 256, 256], 1024, reserved)
+    assert tiles[0] == (0, 512, 512)
+    assert sorted(tiles[1:]) == [(0, 0, 256), (256, 0, 256)]
+    assert shadows.allocate_tiles([256, 256], 1024, [(0, 0, 1024)]) == [None, None]
+
+
+def test_shadow_atlas(showbase):
+    render = showbase.render
+    camera = showbase.cam
+
+    near = render.attach_new_node(p3d.Spotlight('near'))
+    near.node().set_shadow_caster(True)
+    near.node().get_lens().set_near_far(1, 20)
+    near.set_pos(0, 10, 5)
+    far = render.attach_new_node(p3d.Spotlight('far'))
+    far.node().set_shadow_caster(True)
+    far.node().get_lens().set_near_far(1, 20)
+    far.set_pos(0, 500, 5)
+    unshadowed = render.attach_new_node(p3d.Spotlight('unshadowed'))
+    for lightnp in (near, far, unshadowed):
+        render.set_light(lightnp)
+
+    shadow_state = p3d.RenderState.make(p3d.ShaderAttrib.make(p3d.Shader.make(
+        p3d.Shader.SL_GLSL,
+        '#version 120\nvoid main() { gl_Position = vec4(0.0); }',
+        '#version 120\nvoid main() {}',
+    )))
+    atlas = shadows.ShadowAtlas(render, showbase.win, shadow_state, size=1024)
+    atlas.update(camera)
+    assert atlas.stats() == {'lights': 2, 'renders': 2}
+    assert atlas.tiles[near][2] > atlas.tiles[far][2]
+    assert near.node().get_initial_state().has_attrib(p3d.ShaderAttrib)
+
+    # The shader finds tiles by view space light position
+    rects = [tuple(i) for i in atlas.rects]
+    positions = [tuple(round(j, 3) for j in i) for i in atlas.light_positions]
+    idx = positions.index((0, 5, -10, 1))
+    assert rects[idx][2] == atlas.tiles[near][2] / 1024
+
+    # Tiles are only re-rendered when their light or casters change
+    atlas.update(camera)
+    assert atlas.stats()['renders'] == 2
+    assert not atlas.buffer.is_active()
+
+    caster = render.attach_new_node(p3d.GeomNode('caster'))
+    caster.node().set_bounds(p3d.BoundingSphere((0, 18, 5), 1))
+    atlas.update(camera)
+    assert atlas.stats()['renders'] == 3
+
+    far.set_x(1)
+    atlas.update(camera)
+    assert atlas.stats()['renders'] == 4
+
+    # Resizing one tile keeps the other tiles and their shadow maps
+    near_tile = atlas.tiles[near]
+    far_size = atlas.tiles[far][2]
+    far.set_y(15)
+    atlas.update(camera)
+    assert atlas.tiles[far][2] > far_size
+    assert atlas.tiles[near] == near_tile
+    assert atlas.stats()['renders'] == 5
+
+    # Small camera moves near a size boundary keep the current tile size
+    size = atlas.tiles[far][2]
+    assert atlas.get_tile_size(far, camera, size) == size
+    assert atlas.get_tile_size(far, camera, size * 2) == size * 2
+    assert atlas.get_tile_size(far, camera, size * 8) == size
+
+    atlas.destroy()
+
+
+def test_cube_faces():
+    lens = p3d.PerspectiveLens()
+    lens.set_fov(90, 90)
+    lens.set_near_far(0.5, 30)
+    camera = p3d.NodePath(p3d.Camera('face', lens))
+    directions = [
+        p3d.LVector3(x, y, z)
+        for x in (-3, 0.5, 2)
+        for y in (-1, 0.2, 4)
+        for z in (-5, 0.3, 1.5)
+    ]
+    for direction in directions:
+        face, u, v, dist = shadows.get_cube_face(direction)
+        forward, up = shadows.POINT_LIGHT_FACES[face]
+        camera.look_at(p3d.LPoint3(*forward), p3d.LVector3(*up))
+
+        # The face's camera projects the direction to the same coordinates
+        projected = p3d.LPoint3()
+        assert lens.project(camera.get_relative_point(p3d.NodePath(), direction), projected)
+        assert (projected.x * 0.5 + 0.5, projected.y * 0.5 + 0.5) == pytest.approx((u, v))
+        assert camera.get_relative_point(p3d.NodePath(), direction).y == pytest.approx(dist)
+
+
+def test_shadow_atlas_point_lights(showbase):
+    render = showbase.render
+    camera = showbase.cam
+
+    near = p3d.PointLight('near')
+    near.attenuation = (1, 0, 0.1)
+    near.set_shadow_caster(True)
+    nearnp = render.attach_new_node(near)
+    nearnp.set_pos(0, 5, 0)
+    far = p3d.PointLight('far')
+    far.attenuation = (1, 0, 0.1)
+    far.set_shadow_caster(True)
+    farnp = render.attach_new_node(far)
+    farnp.set_pos(0, 2000, 0)
+    render.set_light(nearnp)
+    render.set_light(farnp)
+
+    atlas = shadows.ShadowAtlas(render, showbase.win, p3d.RenderState.make_empty(), size=1024)
+    atlas.update(camera)
+    assert atlas.stats() == {'lights': 2, 'renders': 2}
+    assert len(render.find_all_matches('**/near_shadow_face*')) == 6
+    assert render.find('**/near_shadow_face3').get_pos() == (0, 5, 0)
+    assert atlas.get_update_interval(nearnp) == 1
+    assert atlas.get_update_interval(farnp) == 16
+
+    params = [tuple(i) for i in atlas.params]
+    radius = math.sqrt((256 - 1) / 0.1)
+    assert (1, pytest.approx(radius), 1, 0) in params
+    origins = [tuple(round(j, 3) for j in i) for i in atlas.origins]
+    assert (0, 0, -2000, 1) in origins
+
+    # Distant point lights are refreshed at a reduced rate
+    nearnp.set_x(1)
+    farnp.set_x(1)
+    atlas.update(camera)
+    assert atlas.stats()['renders'] == 3
+    # Faces are sampled from where they were last rendered
+    origins = [tuple(round(j, 3) for j in i) for i in atlas.origins]
+    assert (0, 0, -2000, 1) in origins
+    for _ in range(15):
+        atlas.update(camera)
+    assert atlas.stats()['renders'] == 4
+    origins = [tuple(round(j, 3) for j in i) for i in atlas.origins]
+    assert (1, 0, -2000, 1) in origins
+    assert render.find('**/far_shadow_face0').get_x() == 1
+
+    atlas.destroy()
+    assert not render.find('**/near_shadow_face0')
+
+
+def make_caster_region(showbase, name):
+    lightnp = showbase.render.attach_new_node(p3d.Spotlight(name))
+    lightnp.node().set_shadow_caster(True)
+    lightnp.node().get_lens().set_near_far(1, 20)
+    texture = shadows.make_shadow_texture(name)
+    buffer = shadows.make_shadow_buffer(showbase.win, name, 64, 64, texture)
+    dispregion = buffer.make_display_region()
+    dispregion.set_camera(lightnp)
+    return dispregion, lightnp
+
+
+def test_update_scheduler_on_change(showbase):
+    render = showbase.render
+    regions = [make_caster_region(showbase, f'light{idx}') for idx in range(2)]
+    scheduler = shadows.ShadowUpdateScheduler()
+
+    scheduler.update(regions, render, 'on_change', 1)
+    assert all(dispregion.is_active() for dispregion, _ in regions)
+    scheduler.update(regions, render, 'on_change', 1)
+    assert not any(dispregion.is_active() for dispregion, _ in regions)
+    assert not any(dispregion.window.is_active() for dispregion, _ in regions)
+    assert scheduler.stats() == {'renders': 2, 'skipped': 2}
+
+    # Casters moving into a light's frustum and the light moving both trigger a render
+    caster = render.attach_new_node(p3d.GeomNode('caster'))
+    caster.node().set_bounds(p3d.BoundingSphere((0, 10, 0), 1))
+    scheduler.update(regions, render, 'on_change', 1)
+    assert [dispregion.is_active() for dispregion, _ in regions] == [True, True]
+
+    regions[1][1].set_h(180)
+    scheduler.update(regions, render, 'on_change', 1)
+    assert [dispregion.is_active() for dispregion, _ in regions] == [False, True]
+
+    caster.set_y(-20)
+    scheduler.update(regions, render, 'on_change', 1)
+    assert [dispregion.is_active() for dispregion, _ in regions] == [True, True]
+
+    scheduler.update(regions, render, 'always', 1)
+    assert all(dispregion.window.is_active() for dispregion, _ in regions)
+
+    for dispregion, _ in regions:
+        dispregion.window.engine.remove_window(dispregion.window)
+
+
+def test_update_scheduler_interval(showbase):
+    dispregion, lightnp = make_caster_region(showbase, 'light')
+    scheduler = shadows.ShadowUpdateScheduler()
+
+    active = []
+    for _ in range(7):
+        scheduler.update([(dispregion, lightnp)], showbase.render, 'interval', 3)
+        active.append(dispregion.is_active())
+    assert active == [True, False, False, True, False, False, True]
+
+    dispregion.window.engine.remove_window(dispregion.window)
@@ -0,0 +1,104 @@
+import array
+
+import panda3d.core as p3d
+import pytest
+
+from simplepbr import _skinning as skinning
+
+
+@pytest.fixture
+def render():
+    return p3d.NodePath('render')
+
+
+def load_posed_panda(render):
+    loader = p3d.Loader.get_global_ptr()
+    model = render.attach_new_node(loader.load_sync('models/panda-model'))
+    anim = p3d.NodePath(loader.load_sync('models/panda-walk4'))
+    charnp = model.find('**/+Character')
+    control = charnp.node().get_bundle(0).bind_anim(
+        anim.find('**/+AnimBundleNode').node().get_bundle(),
+        -1,
+    )
+    control.pose(7)
+    return charnp
+
+
+def test_blend_influences():
+    blend = p3d.TransformBlend()
+    transforms = [p3d.UserVertexTransform(f'joint{idx}') for idx in range(5)]
+    for idx, transform in enumerate(transforms):
+        blend.add_transform(transform, idx + 1)
+
+    influences = skinning.get_blend_influences(blend)
+    assert [i[0] for i in influences] == transforms[:0:-1]
+    assert [i[1] for i in influences] == pytest.approx([5 / 14, 4 / 14, 3 / 14, 2 / 14])
+
+
+def test_skinning_palette(render):
+    charnp = load_posed_panda(render)
+    charnp.node().update()
+    geomnode = charnp.find('**/+GeomNode').node()
+    original = geomnode.get_geom(0).get_vertex_data()
+    expected = original.animate_vertices(True, p3d.Thread.get_current_thread())
+
+    palette = skinning.SkinningPalette()
+    palette.update(render)
+    assert palette.stats() == {'characters': 1, 'joints': 26, 'uploads': 1}
+    attrib = charnp.get_attrib(p3d.ShaderAttrib)
+    assert attrib.get_shader_input_vector('palette_skinning_enabled')[0] == 1
+
+    vdata = geomnode.get_geom(0).get_vertex_data()
+    assert vdata.get_transform_blend_table() is None
+    assert not vdata.has_column('transform_blend')
+
+    # Blending the palette matrices matches Panda3D's CPU animation
+    values = array.array('f')
+    values.frombytes(bytes(palette.texture.get_ram_image_as('RGBA')))
+    vertex = p3d.GeomVertexReader(vdata, 'vertex')
+    indices = p3d.GeomVertexReader(vdata, 'palette_index')
+    weights = p3d.GeomVertexReader(vdata, 'palette_weight')
+    animated = p3d.GeomVertexReader(expected, 'vertex')
+    while not vertex.is_at_end():
+        position = p3d.LVecBase4(vertex.get_data3(), 1)
+        result = p3d.LVecBase3(0)
+        for joint, weight in zip(indices.get_data4(), weights.get_data4()):
+            offset = int(joint) * 12
+            for axis in range(3):
+                column = p3d.LVecBase4(*values[offset + axis * 4:offset + axis * 4 + 4])
+                result[axis] += column.dot(position) * weight
+        assert result.almost_equal(animated.get_data3(), 1e-3)
+
+    palette.update(render)
+    assert palette.stats()['uploads'] == 2
+
+    palette.clear()
+    assert geomnode.get_geom(0).get_vertex_data() == original
+    attrib = charnp.get_attrib(p3d.ShaderAttrib)
+    assert not attrib.has_shader_input('palette_skinning_enabled')
+
+
+def test_skinning_palette_reattach(render):
+    charnp = load_posed_panda(render)
+    model = charnp.get_parent()
+    geomnode = charnp.find('**/+GeomNode').node()
+    original = geomnode.get_geom(0).get_vertex_data()
+
+    palette = skinning.SkinningPalette()
+    palette.update(render)
+    assert geomnode.get_geom(0).get_vertex_data() != original
+
+    # Characters that leave the scene are restored
+    model.detach_node()
+    palette.update(render)
+    assert palette.stats()['characters'] == 0
+    assert geomnode.get_geom(0).get_vertex_data() == original
+    assert not charnp.get_attrib(p3d.ShaderAttrib).has_shader_input('palette_skinning_enabled')
+
+    # and converted again when they come back
+    model.reparent_to(render)
+    palette.update(render)
+    assert palette.stats() == {'characters': 1, 'joints': 26, 'uploads': 3}
+    attrib = charnp.get_attrib(p3d.ShaderAttrib)
+    assert attrib.get_shader_input_vector('palette_skinning_enabled')[0] == 1
+    assert geomnode.get_geom(0).get_vertex_data().has_column('palette_index')